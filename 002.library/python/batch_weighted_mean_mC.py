@@ -0,0 +1,256 @@
+"""
+Tom Ellis, July 2021
+
+Weighted mean methylation for a whole folder of allc files from the methylpy
+pipeline, using `weighted_mean_mC_from_allc.py` on each file.
+
+Files are processed in parallel on a pool of worker processes. Only the main
+process writes to disk: results are collected, sorted by filename, and written
+to a temporary file that is then renamed to `output`, so the summary file is
+never left half-written and the row order does not depend on which worker
+finishes first.
+
+Each file is recorded in a manifest (see `checkpoint.py`) as soon as it is
+done. If a job is rerun, files that are already in the manifest and have not
+changed since are not summarised again. If a file cannot be summarised (for
+example if it is truncated), the error is printed and the other files carry
+on; output is written for every file that finished, and the script then exits
+with an error listing the files that failed.
+
+Parameters
+----------
+input: str
+    Folder containing allc files or cytosine stores (see `cytosine_store.py`),
+    or a glob pattern matching them.
+output: str
+    Path to the CSV file to write.
+workers: int
+    Number of worker processes.
+chunksize: int
+    Number of rows of each allc file to read at once.
+manifest: str
+    Folder in which to record finished files. Defaults to `output` with
+    '.manifest' appended.
+qc: str
+    Optional path to a CSV file of quality-control metrics for every file,
+    calculated in the same pass as the weighted means (see `QCCounter` in
+    `weighted_mean_mC_from_allc.py`). Finished files are recorded in a
+    separate manifest, `qc` with '.manifest' appended.
+levels: str
+    Optional path to a CSV file of estimators based on the methylation level
+    of each cytosine (see `SiteLevelCounter`), also calculated in the same
+    pass, with its own manifest. The manifest records `min_coverage`,
+    `non_conversion` and `alpha`, and files are summarised again if these
+    change.
+min_coverage, non_conversion, alpha:
+    Options for `SiteLevelCounter`.
+
+Returns
+-------
+CSV file with a header, and rows giving the name of each input file, followed
+by weighted-mean methylation levels for the CG, CHG and CHH sequence contexts
+on autosomes and organelles. If `qc` is given, a second CSV file with columns
+file, metric, group and value. If `levels` is given, a CSV file with columns
+file, chr_type, estimator, CG, CHG and CHH.
+"""
+
+import argparse
+import os
+import traceback
+from glob import glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from weighted_mean_mC_from_allc import sum_allc_reads, format_weighted_means, stream_allc, GenomeWideCounter
+from weighted_mean_mC_from_allc import QCCounter, format_qc, QC_HEADER
+from weighted_mean_mC_from_allc import SiteLevelCounter, format_site_levels, LEVELS_HEADER, MIN_COVERAGE, METHYLATION_ALPHA
+from cytosine_store import is_store
+from checkpoint import Manifest
+
+HEADER = "file,chr_type,CG,CHG,CHH,coverage\n"
+
+def list_allc_files(input):
+    """
+    List allc files and cytosine stores in a folder, or matching a glob
+    pattern, in sorted order.
+    """
+    if os.path.isdir(input):
+        stores = [p for p in glob(os.path.join(input, '*')) if is_store(p)]
+        input = os.path.join(input, 'allc_*.tsv.gz')
+        files = sorted(glob(input) + stores)
+    else:
+        files = sorted(glob(input))
+    if len(files) == 0:
+        raise ValueError("No allc files found matching {}".format(input))
+    return files
+
+def summarise_allc(path, chunksize=1000000):
+    """
+    Lines of the summary CSV for a single allc file.
+    """
+    sums = sum_allc_reads(path, chunksize)
+    return format_weighted_means(os.path.basename(path), sums)
+
+# Header and formatting function for each optional output.
+EXTRA_OUTPUTS = {
+    'qc'     : (QC_HEADER, format_qc),
+    'levels' : (LEVELS_HEADER, format_site_levels)
+}
+
+def summarise_allc_extras(path, chunksize=1000000, qc=False, levels=None):
+    """
+    Lines of the summary CSV and of optional extra CSVs for a single allc
+    file, from one pass over the file.
+
+    Parameters
+    ----------
+    path: str
+        Path to an allc file.
+    chunksize: int
+        Number of rows of the allc file to read at once.
+    qc: bool
+        If True, include quality-control metrics from `QCCounter`.
+    levels: dict
+        Optional keyword arguments for `SiteLevelCounter`, to include its
+        estimators.
+
+    Returns
+    -------
+    Tuple of the lines of the summary CSV, and a dictionary of lines for
+    'qc' and 'levels' where requested.
+    """
+    counters = {'means' : GenomeWideCounter()}
+    if qc:
+        counters['qc'] = QCCounter()
+    if levels is not None:
+        counters['levels'] = SiteLevelCounter(**levels)
+    stream_allc(path, counters.values(), chunksize)
+    filename = os.path.basename(path)
+    extras = {k: EXTRA_OUTPUTS[k][1](filename, counters[k].result()) for k in counters.keys() if k != 'means'}
+    return format_weighted_means(filename, counters['means'].result()), extras
+
+def extra_lines(manifest, path, options):
+    """
+    Lines of an optional output recorded in its manifest for `path`, or None
+    if `path` is not done or was summarised with different options.
+    """
+    record = manifest.result(path)
+    if not isinstance(record, dict) or record.get('options') != options:
+        return None
+    return record['lines']
+
+def write_atomic(path, lines):
+    """
+    Write lines to a temporary file next to `path`, then rename it to `path`.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as out:
+        out.writelines(lines)
+    os.replace(tmp, path)
+
+def batch_weighted_means(files, output, workers=1, chunksize=1000000, manifest=None, qc=None,
+                         levels=None, min_coverage=MIN_COVERAGE, non_conversion=None, alpha=METHYLATION_ALPHA):
+    """
+    Weighted mean methylation for a list of allc files, written to a single CSV.
+
+    Parameters
+    ----------
+    files: list
+        Paths to allc files.
+    output: str
+        Path to the CSV file to write.
+    workers: int
+        Number of worker processes.
+    chunksize: int
+        Number of rows of each allc file to read at once.
+    manifest: str
+        Folder in which to record finished files. Defaults to `output` with
+        '.manifest' appended.
+    qc: str
+        Optional path to a CSV file of quality-control metrics to write.
+    levels: str
+        Optional path to a CSV file of estimators from `SiteLevelCounter` to
+        write.
+    min_coverage, non_conversion, alpha:
+        Options for `SiteLevelCounter`.
+
+    Returns
+    -------
+    List of files that could not be summarised. Results for all other files
+    are written to `output`, and to `qc` and `levels` if they are given.
+    """
+    files = sorted(files, key=os.path.basename)
+    names = [os.path.basename(f) for f in files]
+    if len(set(names)) < len(names):
+        raise ValueError("Two or more allc files have the same name, which would give duplicate rows in the output.")
+
+    if manifest is None:
+        manifest = output + '.manifest'
+    manifest = Manifest(manifest)
+    # Each optional output has its own manifest, so it can be added later.
+    extra_paths = {k: v for k, v in [('qc', qc), ('levels', levels)] if v is not None}
+    extra_manifests = {k: Manifest(v + '.manifest') for k, v in extra_paths.items()}
+    # Options are recorded with each optional output, so that changing them
+    # means files are summarised again.
+    level_options = {'min_coverage' : min_coverage, 'non_conversion' : non_conversion, 'alpha' : alpha}
+    extra_options = {'qc' : {}, 'levels' : level_options}
+    to_do = [
+        f for f in files
+        if not manifest.is_done(f) or any(extra_lines(m, f, extra_options[k]) is None for k, m in extra_manifests.items())
+    ]
+    print("{} files have already been summarised; {} to go.".format(len(files) - len(to_do), len(to_do)))
+
+    # Record each file as soon as it finishes, so a rerun can skip it. An
+    # error in one file does not stop the others being recorded.
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if len(extra_manifests) == 0:
+            futures = {pool.submit(summarise_allc, f, chunksize): f for f in to_do}
+        else:
+            futures = {
+                pool.submit(summarise_allc_extras, f, chunksize, 'qc' in extra_paths, level_options if 'levels' in extra_paths else None): f
+                for f in to_do
+            }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception:
+                print("Could not summarise {}:\n{}".format(futures[future], traceback.format_exc()))
+                failed.append(futures[future])
+                continue
+            if len(extra_manifests) == 0:
+                manifest.add(futures[future], result)
+            else:
+                lines, extras = result
+                manifest.add(futures[future], lines)
+                for k, m in extra_manifests.items():
+                    m.add(futures[future], {'options' : extra_options[k], 'lines' : extras[k]})
+
+    # Write results for every file that has finished.
+    lines = [HEADER] + [line for f in files if manifest.is_done(f) for line in manifest.result(f)]
+    write_atomic(output, lines)
+    for k, m in extra_manifests.items():
+        done = [extra_lines(m, f, extra_options[k]) for f in files]
+        write_atomic(extra_paths[k], [EXTRA_OUTPUTS[k][0]] + [line for x in done if x is not None for line in x])
+    return sorted(failed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Weighted-mean methylation for a folder of allc files')
+    parser.add_argument('-i', '--input', help = 'Folder containing allc files, or a glob pattern matching them.', required = True)
+    parser.add_argument('-o', '--output', help = 'Path to the CSV file to write.', required = True)
+    parser.add_argument('-w', '--workers', help = 'Number of worker processes.', type = int, default = 1)
+    parser.add_argument('--chunksize', help = 'Number of rows of each allc file to read at once.', type = int, default = 1000000)
+    parser.add_argument('--manifest', help = 'Folder in which to record finished files. Defaults to the output path plus ".manifest".', required = False)
+    parser.add_argument('--qc', help = 'Optional path to a CSV file of quality-control metrics for every file.', required = False)
+    parser.add_argument('--levels', help = 'Optional path to a CSV file of estimators based on the methylation level of each cytosine for every file.', required = False)
+    parser.add_argument('--min_coverage', help = 'Cytosines with fewer reads than this are ignored by the estimators in --levels. Default is {}.'.format(MIN_COVERAGE), type = int, default = MIN_COVERAGE)
+    parser.add_argument('--non_conversion', help = 'Optional non-conversion rate for the binomial test of each cytosine. Defaults to the rate on the chloroplast of each file.', type = float, required = False)
+    parser.add_argument('--alpha', help = 'Significance level for the binomial test of each cytosine. Default is {}.'.format(METHYLATION_ALPHA), type = float, default = METHYLATION_ALPHA)
+    args = parser.parse_args()
+
+    files = list_allc_files(args.input)
+    print("Summarising {} allc files using {} workers.".format(len(files), args.workers))
+    failed = batch_weighted_means(
+        files, args.output, args.workers, args.chunksize, args.manifest, args.qc,
+        args.levels, args.min_coverage, args.non_conversion, args.alpha
+    )
+    if len(failed) > 0:
+        raise SystemExit("{} of {} files could not be summarised:\n{}".format(len(failed), len(files), '\n'.join(failed)))
@@ -0,0 +1,37 @@
+"""
+Tom Ellis, August 2021
+
+Benchmarks for the summarisation and GWAS scripts, run on synthetic data so
+that they can be run anywhere without access to the cluster or the real data.
+
+The package has four modules:
+1. `synthetic.py`: generators for allc files, methylpy HDF5 files, TE
+    annotations, and genotype directories with kinship matrices and
+    phenotypes, at sizes set by `SCALES`, from a toy data set up to the size
+    of the A. thaliana genome and the 1001 Genomes panel.
+2. `measure.py`: run a function or command in a fresh process and record its
+    wall time and peak memory.
+3. `cases.py`: the code path measured by each benchmark.
+4. `run_benchmarks.py`: script to generate data, run benchmarks and save the
+    results as JSON.
+
+Library modules import each other by name, so the library folders are added to
+the module search path when the package is imported.
+
+Example
+-------
+python3 002.library/python/benchmarks/run_benchmarks.py --scale toy --output benchmarks_toy.json
+"""
+
+import os
+import sys
+
+LIBRARY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT = os.path.dirname(os.path.dirname(LIBRARY))
+# `meth_from_wma_araport.py` is kept with the comparison to the old HDF5 data.
+HDF5_LIBRARY = os.path.join(PROJECT, '005.results', '004.compare_old_data', 'library')
+PERL_LIBRARY = os.path.join(os.path.dirname(LIBRARY), 'perl')
+
+for path in [LIBRARY, HDF5_LIBRARY]:
+    if path not in sys.path:
+        sys.path.append(path)
@@ -0,0 +1,94 @@
+"""
+Tom Ellis, August 2021
+
+Code paths measured by the benchmarks.
+
+Each case is a function taking a dictionary of paths to synthetic inputs (from
+`run_benchmarks.prepare_inputs`) and a folder for any output, and runs one
+summarisation path from start to finish. Library functions are called
+directly, and each case imports only the modules it needs, so that its time
+and memory include those imports but not modules used by other cases. Scripts
+that are normally run from the command line, and the Perl script, are run as
+commands, whose memory is reported separately (see `measure.py`).
+
+`CASES` gives the function for each case, the inputs it needs and a short
+description.
+"""
+
+import os
+import shutil
+import sys
+from benchmarks import LIBRARY, PERL_LIBRARY
+from benchmarks.measure import run_command
+
+def allc_weighted_mean(inputs, out):
+    from weighted_mean_mC_from_allc import sum_allc_reads
+    sum_allc_reads(inputs['allc'])
+
+def allc_all_estimators(inputs, out):
+    from weighted_mean_mC_from_allc import stream_allc, GenomeWideCounter, QCCounter, SiteLevelCounter
+    stream_allc(inputs['allc'], [GenomeWideCounter(), QCCounter(), SiteLevelCounter()])
+
+def allc_build_store(inputs, out):
+    from cytosine_store import build_store
+    build_store(inputs['allc'], os.path.join(out, 'allc.cstore'))
+
+def store_weighted_mean(inputs, out):
+    from weighted_mean_mC_from_allc import sum_allc_reads
+    sum_allc_reads(inputs['store'])
+
+def te_python(inputs, out):
+    run_command([
+        sys.executable, os.path.join(LIBRARY, 'methylation_on_TEs.py'),
+        '-i', inputs['allc'], '-a', inputs['te_annotation'], '-o', os.path.join(out, 'te_python.txt')
+    ])
+
+def te_perl(inputs, out):
+    # The Perl script takes a folder, the annotation, an output folder and a
+    # pattern matching the file name, and writes a file of the same name.
+    run_command([
+        'perl', os.path.join(PERL_LIBRARY, '001.methylation_levels.pl'),
+        os.path.dirname(inputs['allc']), inputs['te_annotation'], out, os.path.basename(inputs['allc'])
+    ])
+
+def hdf5_genome_wide(inputs, out):
+    import h5py
+    from meth_from_wma_araport import genome_wide_methylation
+    with h5py.File(inputs['hdf5'], 'r') as f:
+        genome_wide_methylation(f)
+
+def hdf5_sliding_windows(inputs, out):
+    import h5py
+    from meth_from_wma_araport import sliding_window_methylation
+    with h5py.File(inputs['hdf5'], 'r') as f:
+        sliding_window_methylation(f, 1000)
+
+def hdf5_summary(inputs, out):
+    import h5py
+    from meth_from_wma_araport import summarise_methylation
+    with h5py.File(inputs['hdf5'], 'r') as f:
+        summarise_methylation(f, windows = [1000], downsample = [None, 0.5], seed = 1)
+
+def singletrait(inputs, out):
+    # Start without cached kinship matrices, as for a new set of accessions.
+    cache = os.path.join(out, 'gwas_cache')
+    if os.path.exists(cache):
+        shutil.rmtree(cache)
+    run_command([
+        sys.executable, os.path.join(LIBRARY, 'singletrait.py'),
+        '-p', inputs['phenotypes'], '-g', inputs['genotypes'], '-o', os.path.join(out, 'gwas'),
+        '--cache', cache, '--no_plots'
+    ])
+
+CASES = {
+    'allc_weighted_mean'   : (allc_weighted_mean,   ['allc'], "sum_allc_reads on an allc file, as in weighted_mean_mC_from_allc.py"),
+    'allc_all_estimators'  : (allc_all_estimators,  ['allc'], "Weighted means, QC metrics and per-site estimators in one pass over an allc file"),
+    'allc_build_store'     : (allc_build_store,     ['allc'], "Convert an allc file to a cytosine store"),
+    'store_weighted_mean'  : (store_weighted_mean,  ['store'], "sum_allc_reads on a cytosine store"),
+    'te_python'            : (te_python,            ['allc', 'te_annotation'], "methylation_on_TEs.py"),
+    'te_perl'              : (te_perl,              ['allc', 'te_annotation'], "The Perl TE script 001.methylation_levels.pl"),
+    'hdf5_genome_wide'     : (hdf5_genome_wide,     ['hdf5'], "genome_wide_methylation on a methylpy HDF5 file"),
+    'hdf5_sliding_windows' : (hdf5_sliding_windows, ['hdf5'], "sliding_window_methylation with 1 kb windows"),
+    'hdf5_summary'         : (hdf5_summary,         ['hdf5'], "summarise_methylation with 1 kb windows and downsampling to one half"),
+    'singletrait'          : (singletrait,          ['genotypes', 'phenotypes'], "singletrait.py on one trait, without cached kinship"),
+}
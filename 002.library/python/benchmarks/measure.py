@@ -0,0 +1,117 @@
+"""
+Tom Ellis, August 2021
+
+Measure the wall time and peak memory of a function or a command.
+
+Each measurement is made in a fresh process started with the 'spawn' method,
+so that memory used by earlier benchmarks, or by the parent process, is not
+counted, and imports are repeated as they would be for a real run.
+
+Peak memory is the maximum resident set size, reported separately for the
+process itself and for the largest command it runs with `run_command`, since
+memory used by a command is not included in that of the process that starts
+it. On Linux, `ru_maxrss` carries over the memory of the process that started
+a new one, so the peak for the process itself is read from `VmHWM` in
+`/proc/self/status` instead. The peak for a command may still include the
+memory of the benchmark process when it started the command, which is small
+if the case only imports what it needs. Memory already used when the function
+is called, such as by the interpreter, is reported as the baseline.
+
+Example
+-------
+measure(sum_allc_reads, 'allc_toy.tsv.gz')
+measure(run_command, ['perl', '001.methylation_levels.pl', ...])
+"""
+
+import multiprocessing as mp
+import os
+import queue as queue_module
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+# Peak memory of each command run by `run_command` in this process.
+_command_rss_mb = []
+
+def ru_maxrss_mb(ru_maxrss):
+    """
+    Convert `ru_maxrss` to megabytes. Linux reports kilobytes, macOS bytes.
+    """
+    return ru_maxrss / 1024 ** 2 if sys.platform == 'darwin' else ru_maxrss / 1024
+
+def max_rss_mb():
+    """
+    Peak resident set size of this process in megabytes.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return ru_maxrss_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def run_command(command):
+    """
+    Run a command, raising an error if it fails, and record its peak memory.
+    """
+    process = subprocess.Popen(command, stdout = subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    _command_rss_mb.append(ru_maxrss_mb(usage.ru_maxrss))
+
+def _measure_in_child(target, args, kwargs, queue):
+    try:
+        baseline = max_rss_mb()
+        start = time.perf_counter()
+        target(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        queue.put({
+            'seconds'             : seconds,
+            'peak_rss_mb'         : max_rss_mb(),
+            'command_peak_rss_mb' : max(_command_rss_mb) if len(_command_rss_mb) > 0 else None,
+            'baseline_rss_mb'     : baseline
+        })
+    except Exception:
+        queue.put({'error' : traceback.format_exc()})
+
+def measure(target, *args, **kwargs):
+    """
+    Run a function in a fresh process and measure its wall time and peak
+    memory.
+
+    Parameters
+    ----------
+    target: function
+        Function to run. This must be importable by name from a module, so it
+        can be found by the new process.
+    args, kwargs:
+        Arguments passed to `target`.
+
+    Returns
+    -------
+    Dictionary with entries 'seconds', 'peak_rss_mb' and 'baseline_rss_mb'
+    for the process running `target`, and 'command_peak_rss_mb' for the
+    largest command it ran with `run_command` (None if it ran none), or
+    'error' giving the traceback if `target` raised an error or the process
+    died (for example if it ran out of memory).
+    """
+    context = mp.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target = _measure_in_child, args = (target, args, kwargs, queue))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout = 1)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                result = {'error' : 'Process exited with code {}.'.format(process.exitcode)}
+                break
+    process.join()
+    return result
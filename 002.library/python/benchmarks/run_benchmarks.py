@@ -0,0 +1,230 @@
+"""
+Tom Ellis, August 2021
+
+Generate synthetic data and time each summarisation and GWAS path on it,
+saving the results as JSON so that runs on different versions of the code can
+be compared.
+
+Synthetic inputs are written to `data` and reused by later runs with the same
+sizes and seed, so they only need to be generated once for each scale. Each
+benchmark runs in a fresh process (see `measure.py`), `repeats` times.
+
+Parameters
+----------
+scale: str
+    Size of the synthetic data: 'toy', 'small', 'medium' or 'full' (see
+    `SCALES` in `synthetic.py`).
+output: str
+    Path to the JSON file to write.
+data: str
+    Folder for synthetic inputs. Defaults to `benchmark_data/<scale>`.
+cases: list
+    Names of cases to run (see `CASES` in `cases.py`). Defaults to all cases.
+    The Perl case is skipped if `perl` is not installed.
+repeats: int
+    Number of times to run each case.
+seed: int
+    Seed for the synthetic data.
+n_cytosines, n_tes, n_accessions, n_snps: int
+    Optional sizes overriding those of `scale`.
+
+Returns
+-------
+JSON file with the sizes of the data, details of the machine and the version of
+the code, and for each case the time of each repeat in seconds, the shortest
+time, and the largest peak memory in megabytes of the benchmark process and,
+for cases that run a script or the Perl script as a command, of that command.
+
+Example
+-------
+python3 002.library/python/benchmarks/run_benchmarks.py --scale small --output benchmarks_small.json --repeats 3
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks import PROJECT
+from benchmarks.measure import measure
+# Benchmark processes import this script again as their main module, so
+# modules that use a lot of memory (such as `synthetic.py`, which imports
+# NumPy) are only imported where they are used.
+
+INPUT_FILES = {
+    'allc'          : 'allc_synthetic.tsv.gz',
+    'store'         : 'allc_synthetic.cstore',
+    'hdf5'          : 'allc_synthetic.hdf5',
+    'te_annotation' : 'te_annotation.txt',
+    'genotypes'     : 'genotypes',
+    'phenotypes'    : 'phenotypes.csv'
+}
+
+def prepare_inputs(directory, params, seed, needed):
+    """
+    Generate synthetic inputs, reusing any already in `directory` that were
+    generated with the same sizes and seed.
+
+    Parameters
+    ----------
+    directory: str
+        Folder for synthetic inputs.
+    params: dict
+        Sizes of the data, as in `SCALES`.
+    seed: int
+        Seed for the random number generator.
+    needed: list
+        Names of the inputs to generate, from `INPUT_FILES`.
+
+    Returns
+    -------
+    Dictionary giving the path to each input in `INPUT_FILES`.
+    """
+    from benchmarks.synthetic import write_allc, write_methylpy_hdf5, write_te_annotation, write_genotypes, write_phenotypes
+    from cytosine_store import build_store
+    os.makedirs(directory, exist_ok = True)
+    paths = {k: os.path.join(directory, v) for k, v in INPUT_FILES.items()}
+    record_path = os.path.join(directory, 'params.json')
+    record = {'params' : params, 'seed' : seed}
+    if os.path.exists(record_path):
+        with open(record_path) as f:
+            if json.load(f) != record:
+                print("Sizes or seed have changed; regenerating inputs in {}.".format(directory))
+                for path in paths.values():
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+    with open(record_path, 'w') as f:
+        json.dump(record, f)
+
+    needed = set(needed)
+    # Some inputs are made from others.
+    if 'store' in needed:
+        needed.add('allc')
+    if 'phenotypes' in needed:
+        needed.add('genotypes')
+    generators = [
+        ('allc', lambda: write_allc(paths['allc'], params['n_cytosines'], seed)),
+        ('store', lambda: build_store(paths['allc'], paths['store'])),
+        ('hdf5', lambda: write_methylpy_hdf5(paths['hdf5'], params['n_cytosines'], seed = seed)),
+        ('te_annotation', lambda: write_te_annotation(paths['te_annotation'], params['n_tes'], seed)),
+        ('genotypes', lambda: write_genotypes(paths['genotypes'], params['n_accessions'], params['n_snps'], seed = seed)),
+        ('phenotypes', lambda: write_phenotypes(paths['phenotypes'], paths['genotypes'], seed = seed))
+    ]
+    for k, generate in generators:
+        done = os.path.exists(os.path.join(paths[k], 'kinship_ibs_binary_mac5.h5py')) if k == 'genotypes' else os.path.exists(paths[k])
+        if k in needed and not done:
+            print("Generating {}.".format(paths[k]))
+            generate()
+    return paths
+
+def input_size(path):
+    """
+    Size of a file, or of all files in a folder, in bytes.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def git_commit():
+    """
+    Hash of the current commit of the project, or None if it is not known.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd = PROJECT, capture_output = True, text = True, check = True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(cases, inputs, out, repeats = 1):
+    """
+    Run each case `repeats` times and summarise the results.
+
+    Parameters
+    ----------
+    cases: list
+        Names of cases in `CASES`.
+    inputs: dict
+        Paths to inputs from `prepare_inputs`.
+    out: str
+        Folder for output written by each case.
+    repeats: int
+        Number of times to run each case.
+
+    Returns
+    -------
+    List of dictionaries for each case.
+    """
+    from benchmarks.cases import CASES
+    results = []
+    for name in cases:
+        target, _, description = CASES[name]
+        result = {'case' : name, 'description' : description, 'seconds' : []}
+        if name == 'te_perl' and shutil.which('perl') is None:
+            result['skipped'] = 'perl is not installed.'
+            results.append(result)
+            continue
+        print("Running {}.".format(name))
+        os.makedirs(out, exist_ok = True)
+        for _ in range(repeats):
+            m = measure(target, inputs, out)
+            if 'error' in m:
+                result['error'] = m['error']
+                print(m['error'])
+                break
+            result['seconds'].append(m['seconds'])
+            result['peak_rss_mb'] = max(result.get('peak_rss_mb', 0), m['peak_rss_mb'])
+            result['baseline_rss_mb'] = m['baseline_rss_mb']
+            if m['command_peak_rss_mb'] is not None:
+                result['command_peak_rss_mb'] = max(result.get('command_peak_rss_mb', 0), m['command_peak_rss_mb'])
+        if len(result['seconds']) > 0:
+            result['best_seconds'] = min(result['seconds'])
+            # For commands, the memory of interest is that of the command.
+            rss = result.get('command_peak_rss_mb', result['peak_rss_mb'])
+            print("{}: {:.2f} s, {:.0f} MB".format(name, result['best_seconds'], rss))
+        results.append(result)
+    return results
+
+if __name__ == '__main__':
+    from benchmarks.cases import CASES
+    from benchmarks.synthetic import SCALES
+    parser = argparse.ArgumentParser(description = 'Time summarisation and GWAS scripts on synthetic data')
+    parser.add_argument('-s', '--scale', help = 'Size of the synthetic data. Default is toy.', choices = list(SCALES.keys()), default = 'toy')
+    parser.add_argument('-o', '--output', help = 'Path to the JSON file to write.', required = True)
+    parser.add_argument('-d', '--data', help = 'Folder for synthetic inputs. Defaults to benchmark_data/<scale>.', required = False)
+    parser.add_argument('-c', '--cases', help = 'Names of cases to run. Defaults to all cases.', nargs = '+', choices = list(CASES.keys()), required = False)
+    parser.add_argument('-r', '--repeats', help = 'Number of times to run each case. Default is 1.', type = int, default = 1)
+    parser.add_argument('--seed', help = 'Seed for the synthetic data. Default is 1.', type = int, default = 1)
+    for k in SCALES['toy'].keys():
+        parser.add_argument('--' + k, help = 'Optional value of {} overriding the scale.'.format(k), type = int, required = False)
+    args = parser.parse_args()
+
+    params = dict(SCALES[args.scale])
+    params.update({k: getattr(args, k) for k in params.keys() if getattr(args, k) is not None})
+    cases = args.cases or list(CASES.keys())
+    data = args.data or os.path.join('benchmark_data', args.scale)
+    inputs = prepare_inputs(data, params, args.seed, [k for c in cases for k in CASES[c][1]])
+    results = run_benchmarks(cases, inputs, os.path.join(data, 'output'), args.repeats)
+
+    report = {
+        'scale'       : args.scale,
+        'params'      : params,
+        'seed'        : args.seed,
+        'created'     : datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'git_commit'  : git_commit(),
+        'python'      : platform.python_version(),
+        'platform'    : platform.platform(),
+        'cpu_count'   : os.cpu_count(),
+        'inputs'      : {k: input_size(v) for k, v in inputs.items() if os.path.exists(v)},
+        'results'     : results
+    }
+    tmp = args.output + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent = 1)
+    os.replace(tmp, args.output)
@@ -0,0 +1,351 @@
+"""
+Tom Ellis, August 2021
+
+Synthetic input files for benchmarks, with the same formats as the real data.
+
+Cytosines are spread over the chromosomes of the A. thaliana reference genome
+in proportion to their length, in the CG, CHG and CHH contexts in roughly the
+proportions seen in the genome. Coverage follows a negative binomial
+distribution. Each cytosine is either methylated or not, with a methylation
+level drawn from a beta distribution that depends on its context, and
+methylated reads are binomial given the level. The chloroplast is unmethylated
+apart from non-conversion. Genotypes are binary SNPs drawn from allele
+frequencies that differ between a few subpopulations, so the kinship matrix has
+some structure.
+
+All generators take a seed, and data are generated one block at a time, so
+memory does not depend on the size of the files.
+
+Example
+-------
+params = SCALES['toy']
+write_allc('allc_toy.tsv.gz', params['n_cytosines'], seed = 1)
+write_methylpy_hdf5('allc_toy.hdf5', params['n_cytosines'], seed = 1)
+write_genotypes('genotypes_toy', params['n_accessions'], params['n_snps'], seed = 1)
+"""
+
+import pandas as pd
+import numpy as np
+import h5py
+import gzip
+import os
+
+# Lengths of chromosomes in the TAIR10 reference genome.
+CHROMOSOME_LENGTHS = {
+    'Chr1' : 30427671,
+    'Chr2' : 19698289,
+    'Chr3' : 23459830,
+    'Chr4' : 18585056,
+    'Chr5' : 26975502,
+    'ChrC' : 154478,
+    'ChrM' : 366924
+}
+
+# Sizes of each data set. 'full' is roughly the number of cytosines covered in
+# a methylpy allc file, the number of annotated TEs in Araport11, and the size
+# of the 1001 Genomes SNP matrix.
+SCALES = {
+    'toy' : {
+        'n_cytosines'  : 200000,
+        'n_tes'        : 500,
+        'n_accessions' : 50,
+        'n_snps'       : 20000
+    },
+    'small' : {
+        'n_cytosines'  : 2000000,
+        'n_tes'        : 5000,
+        'n_accessions' : 200,
+        'n_snps'       : 200000
+    },
+    'medium' : {
+        'n_cytosines'  : 10000000,
+        'n_tes'        : 15000,
+        'n_accessions' : 500,
+        'n_snps'       : 1000000
+    },
+    'full' : {
+        'n_cytosines'  : 42000000,
+        'n_tes'        : 31189,
+        'n_accessions' : 1135,
+        'n_snps'       : 10709949
+    }
+}
+
+# Proportion of cytosines in each context, and for each context the proportion
+# of methylated cytosines and beta distributions of methylation levels for
+# methylated and unmethylated cytosines.
+CONTEXT_PROPORTIONS = {'CG' : 0.11, 'CHG' : 0.13, 'CHH' : 0.76}
+METHYLATION_MODEL = {
+    'CG'  : (0.25, (9, 1), (1, 30)),
+    'CHG' : (0.10, (5, 3), (1, 50)),
+    'CHH' : (0.05, (2, 6), (1, 100))
+}
+NON_CONVERSION = 0.003
+MEAN_COVERAGE = 10
+BLOCK = 1000000
+
+def chromosome_counts(n):
+    """
+    Number of cytosines on each chromosome, in proportion to its length.
+    """
+    lengths = np.array(list(CHROMOSOME_LENGTHS.values()))
+    counts = np.floor(n * lengths / lengths.sum()).astype(np.int64)
+    counts[0] += n - counts.sum()
+    return dict(zip(CHROMOSOME_LENGTHS.keys(), np.minimum(counts, lengths)))
+
+def simulate_cytosines(chrom, n, rng):
+    """
+    Simulate cytosines on one chromosome.
+
+    Parameters
+    ----------
+    chrom: str
+        Chromosome name, from `CHROMOSOME_LENGTHS`.
+    n: int
+        Number of cytosines.
+    rng: numpy.random.Generator
+        Random number generator.
+
+    Returns
+    -------
+    Dictionary of arrays for 'pos', 'strand', 'mc_class' (as bytes),
+    'mc_count', 'total' and 'signif', sorted by position.
+    """
+    pos = np.sort(rng.choice(CHROMOSOME_LENGTHS[chrom], size = n, replace = False)) + 1
+    contexts = list(CONTEXT_PROPORTIONS.keys())
+    context = rng.choice(len(contexts), size = n, p = list(CONTEXT_PROPORTIONS.values()))
+    # Trinucleotides as rows of three bytes: C, then G for CG or A, C or T for CH,
+    # then any base for CG, G for CHG or A, C or T for CHH.
+    seq = np.zeros((n, 3), dtype = np.uint8)
+    seq[:, 0] = ord('C')
+    H = np.frombuffer(b'ACT', dtype = np.uint8)
+    N = np.frombuffer(b'ACGT', dtype = np.uint8)
+    seq[:, 1] = np.where(context == 0, ord('G'), H[rng.integers(0, 3, n)])
+    seq[:, 2] = np.select([context == 0, context == 1], [N[rng.integers(0, 4, n)], np.uint8(ord('G'))], H[rng.integers(0, 3, n)])
+
+    level = np.full(n, NON_CONVERSION)
+    methylated = np.zeros(n, dtype = bool)
+    if chrom != 'ChrC':
+        for i, k in enumerate(contexts):
+            p_meth, meth_beta, unmeth_beta = METHYLATION_MODEL[k]
+            ix = np.where(context == i)[0]
+            methylated[ix] = rng.random(len(ix)) < p_meth
+            level[ix] = np.where(
+                methylated[ix],
+                rng.beta(*meth_beta, size = len(ix)),
+                rng.beta(*unmeth_beta, size = len(ix))
+            )
+    total = rng.negative_binomial(2, 2 / (2 + MEAN_COVERAGE), size = n) + 1
+    mc_count = rng.binomial(total, level)
+    return {
+        'pos'      : pos,
+        'strand'   : np.where(rng.random(n) < 0.5, '+', '-'),
+        'mc_class' : seq.view('S3').ravel(),
+        'mc_count' : mc_count,
+        'total'    : total,
+        'signif'   : (methylated & (mc_count >= 2)).astype(np.int8)
+    }
+
+def iter_cytosines(n_cytosines, seed):
+    """
+    Simulated cytosines for the whole genome, in blocks of up to `BLOCK`
+    cytosines that do not span chromosomes.
+
+    Returns
+    -------
+    Generator of tuples of chromosome name and a dictionary of arrays from
+    `simulate_cytosines`.
+    """
+    rng = np.random.default_rng(seed)
+    for chrom, n in chromosome_counts(n_cytosines).items():
+        cytosines = simulate_cytosines(chrom, n, rng)
+        for start in range(0, n, BLOCK):
+            yield chrom, {k: v[start:start + BLOCK] for k, v in cytosines.items()}
+
+def write_allc(path, n_cytosines, seed = 1):
+    """
+    Write a gzipped allc file in the format of the methylpy pipeline.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file to write.
+    n_cytosines: int
+        Number of cytosines.
+    seed: int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    Nothing; the file is written to `path`.
+    """
+    tmp = path + '.tmp'
+    with gzip.open(tmp, 'wt') as f:
+        for chrom, c in iter_cytosines(n_cytosines, seed):
+            pd.DataFrame({
+                'chr'      : chrom,
+                'pos'      : c['pos'],
+                'strand'   : c['strand'],
+                'seq'      : c['mc_class'].astype('U3'),
+                'mc_count' : c['mc_count'],
+                'total'    : c['total'],
+                'signif'   : c['signif']
+            }).to_csv(f, sep = '\t', header = False, index = False)
+    os.replace(tmp, path)
+
+def write_methylpy_hdf5(path, n_cytosines, chunk_size = 100000, seed = 1):
+    """
+    Write an HDF5 file in the format of the methylpy pipeline, with datasets
+    'chr', 'pos', 'mc_class', 'mc_count', 'total' and 'chunk_size'.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file to write.
+    n_cytosines: int
+        Number of cytosines.
+    chunk_size: int
+        Value of 'chunk_size' stored in the file, also used as the HDF5 chunk
+        length of each dataset.
+    seed: int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    Nothing; the file is written to `path`.
+    """
+    tmp = path + '.tmp'
+    dtypes = {'chr' : 'S4', 'pos' : np.int64, 'mc_class' : 'S3', 'mc_count' : np.int64, 'total' : np.int64}
+    chunks = (min(int(chunk_size), max(n_cytosines, 1)),)
+    with h5py.File(tmp, 'w') as f:
+        for k, dtype in dtypes.items():
+            f.create_dataset(k, shape = (n_cytosines,), dtype = dtype, chunks = chunks, compression = 'gzip')
+        f['chunk_size'] = np.array([chunk_size])
+        start = 0
+        for chrom, c in iter_cytosines(n_cytosines, seed):
+            stop = start + len(c['pos'])
+            f['chr'][start:stop] = np.full(stop - start, chrom.encode(), dtype = 'S4')
+            for k in ['pos', 'mc_class', 'mc_count', 'total']:
+                f[k][start:stop] = c[k]
+            start = stop
+    os.replace(tmp, path)
+
+def write_te_annotation(path, n_tes, seed = 1):
+    """
+    Write a TE annotation file in the format of the Araport11 transposon
+    annotation, with columns Transposon_Name, start, end and class.
+
+    Parameters
+    ----------
+    path: str
+        Path to the file to write.
+    n_tes: int
+        Number of TEs.
+    seed: int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    Nothing; the file is written to `path`.
+    """
+    rng = np.random.default_rng(seed)
+    chromosomes = [c for c in CHROMOSOME_LENGTHS.keys() if c[3:].isdigit()]
+    lengths = np.array([CHROMOSOME_LENGTHS[c] for c in chromosomes])
+    chrom = rng.choice(len(chromosomes), size = n_tes, p = lengths / lengths.sum())
+    width = np.minimum(np.round(rng.lognormal(7, 1, n_tes)).astype(np.int64) + 50, 20000)
+    start = (rng.random(n_tes) * (lengths[chrom] - width)).astype(np.int64) + 1
+    pd.DataFrame({
+        'Transposon_Name' : ['AT{}TE{:05d}'.format(chromosomes[c][3:], i) for i, c in enumerate(chrom)],
+        'start'           : start,
+        'end'             : start + width,
+        'class'           : rng.choice(['LTR', 'DNA', 'LINE', 'SINE', 'RC'], size = n_tes)
+    }).to_csv(path, sep = '\t', index = False)
+
+def write_genotypes(directory, n_accessions, n_snps, n_populations = 5, seed = 1):
+    """
+    Write a genotype directory for GWAS, with a binary SNP matrix
+    (`all_chromosomes_binary.hdf5`) and a kinship matrix
+    (`kinship_ibs_binary_mac5.h5py`), as read by `genotype_store.py`.
+
+    The kinship matrix is the proportion of SNPs at which each pair of
+    accessions shares an allele, accumulated one block of SNPs at a time.
+
+    Parameters
+    ----------
+    directory: str
+        Folder in which to write the files. This is created if it does not
+        exist.
+    n_accessions: int
+        Number of accessions.
+    n_snps: int
+        Number of SNPs, spread over the five nuclear chromosomes in proportion
+        to their length.
+    n_populations: int
+        Number of subpopulations with different allele frequencies.
+    seed: int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    Nothing; files are written to `directory`.
+    """
+    os.makedirs(directory, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    accessions = np.array([str(1000 + i).encode() for i in range(n_accessions)])
+    population = rng.integers(0, n_populations, n_accessions)
+
+    chromosomes = [c for c in CHROMOSOME_LENGTHS.keys() if c[3:].isdigit()]
+    lengths = np.array([CHROMOSOME_LENGTHS[c] for c in chromosomes])
+    counts = np.floor(n_snps * lengths / lengths.sum()).astype(np.int64)
+    counts[0] += n_snps - counts.sum()
+    ends = np.cumsum(counts)
+    chr_regions = np.stack([ends - counts, ends], axis = 1)
+
+    ibs = np.zeros((n_accessions, n_accessions))
+    block = max(1, BLOCK // max(n_accessions, 1) * 10)
+    snp_file = os.path.join(directory, 'all_chromosomes_binary.hdf5')
+    with h5py.File(snp_file + '.tmp', 'w') as f:
+        f['accessions'] = accessions
+        snps = f.create_dataset('snps', shape = (n_snps, n_accessions), dtype = np.int8, chunks = (min(1000, max(n_snps, 1)), n_accessions), compression = 'lzf')
+        positions = f.create_dataset('positions', shape = (n_snps,), dtype = np.int32)
+        positions.attrs['chr_regions'] = chr_regions
+        for (start, end), length in zip(chr_regions, lengths):
+            positions[start:end] = np.sort(rng.choice(length, size = end - start, replace = False)) + 1
+        for start in range(0, n_snps, block):
+            stop = min(start + block, n_snps)
+            # Allele frequencies with many rare variants, differing among subpopulations.
+            freq = rng.beta(0.5, 2, size = (stop - start, 1))
+            pop_freq = np.clip(freq + rng.normal(0, 0.1, size = (stop - start, n_populations)), 0, 1)
+            G = (rng.random((stop - start, n_accessions)) < pop_freq[:, population]).astype(np.int8)
+            snps[start:stop] = G
+            X = G.astype(np.float64)
+            ibs += X.T @ X + (1 - X).T @ (1 - X)
+    os.replace(snp_file + '.tmp', snp_file)
+
+    kinship_file = os.path.join(directory, 'kinship_ibs_binary_mac5.h5py')
+    with h5py.File(kinship_file + '.tmp', 'w') as f:
+        f['accessions'] = accessions
+        f['kinship'] = ibs / max(n_snps, 1)
+    os.replace(kinship_file + '.tmp', kinship_file)
+
+def write_phenotypes(path, directory, n_traits = 1, seed = 1):
+    """
+    Write a CSV file of normally distributed phenotypes for the accessions in
+    a genotype directory, with accession IDs in the first column.
+
+    Phenotypes depend on subpopulation through the kinship matrix, with
+    heritability of about one half.
+    """
+    rng = np.random.default_rng(seed)
+    with h5py.File(os.path.join(directory, 'kinship_ibs_binary_mac5.h5py'), 'r') as f:
+        accessions = f['accessions'][:]
+        K = f['kinship'][:]
+    vals, vecs = np.linalg.eigh(K)
+    genetic = vecs @ (np.sqrt(np.clip(vals, 0, None))[:, None] * rng.normal(size = (len(accessions), n_traits)))
+    genetic = (genetic - genetic.mean(axis = 0)) / genetic.std(axis = 0)
+    pheno = pd.DataFrame(
+        genetic + rng.normal(size = genetic.shape),
+        index = pd.Index([int(a) for a in accessions], name = 'accession'),
+        columns = ['trait{}'.format(i + 1) for i in range(n_traits)]
+    )
+    pheno.to_csv(path)
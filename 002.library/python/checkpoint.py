@@ -0,0 +1,95 @@
+"""
+Tom Ellis, July 2021
+
+Keep track of which input files have already been summarised, so that batch
+jobs that die part-way through can pick up where they left off.
+
+Each finished input file gets a small JSON record in a manifest folder, named
+after a hash of the absolute path of the input file. The record stores the
+path, size and modification time of the input file along with its result. A
+file counts as done only if its size and modification time still match, so
+files that are regenerated are summarised again.
+
+Records are written to a temporary file and renamed, so that several processes
+(for example tasks in a SLURM job array) can share one manifest safely.
+
+Example
+-------
+manifest = Manifest('004.output/003.methylation_levels/mean_mC_genome_wide.csv.manifest')
+for f in files:
+    if manifest.is_done(f):
+        continue
+    manifest.add(f, summarise(f))
+"""
+
+import hashlib
+import json
+import os
+
+def file_key(path):
+    """
+    Absolute path, size in bytes and modification time of a file.
+    """
+    info = os.stat(path)
+    return {
+        'path'  : os.path.abspath(path),
+        'size'  : info.st_size,
+        'mtime' : info.st_mtime
+    }
+
+class Manifest:
+    """
+    Folder of records for input files that have been summarised.
+
+    Parameters
+    ----------
+    folder: str
+        Folder in which to store records. This is created if it does not exist.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _record_path(self, path):
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.folder, name + '.json')
+
+    def get(self, path):
+        """
+        Record for `path`, or None if there is no record or the file has
+        changed since it was recorded.
+        """
+        record_path = self._record_path(path)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path) as f:
+            record = json.load(f)
+        key = file_key(path)
+        if record['size'] != key['size'] or record['mtime'] != key['mtime']:
+            return None
+        return record
+
+    def is_done(self, path):
+        """
+        True if `path` has been summarised and has not changed since.
+        """
+        return self.get(path) is not None
+
+    def result(self, path):
+        """
+        The result stored for `path`, or None if it is not done.
+        """
+        record = self.get(path)
+        return None if record is None else record['result']
+
+    def add(self, path, result):
+        """
+        Record that `path` has been summarised, with its (JSON-serialisable) result.
+        """
+        record = file_key(path)
+        record['result'] = result
+        record_path = self._record_path(path)
+        tmp = record_path + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, record_path)
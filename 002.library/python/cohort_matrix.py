@@ -0,0 +1,203 @@
+"""
+Tom Ellis, August 2021
+
+Collect counts of methylated and total reads on each region (e.g. each TE) for
+every sample into a single chunked HDF5 file, so that cohort-level summaries
+can read slices of one file instead of parsing hundreds of text files.
+
+The file contains:
+1. `regions`: names of the regions (one per row).
+2. `samples`: names of the samples (one per column). This grows as samples
+    are appended.
+3. `counts`: unsigned integer array of shape (regions, samples, 6), giving
+    reads in the order of the `contexts` attribute: mCG, mCHG, mCHH, cCG, cCHG,
+    cCHH (methylated and total reads in each context).
+`counts` is stored in blocks covering 1024 regions and 32 samples, so that
+reading all regions for a few samples, or all samples for a few regions, only
+touches a small part of the file.
+
+Parameters
+----------
+input: str
+    Glob pattern matching per-sample files from `methylation_on_TEs.py` (or
+    `002.library/perl/001.methylation_levels.pl`).
+output: str
+    Path to the HDF5 file. This is created if it does not exist, using the
+    regions in the first input file; otherwise samples are appended to it.
+
+Example
+-------
+append_samples('cohort_TEs.h5', sorted(glob('reads_on_each_TE/*.tsv.gz')))
+counts, regions, samples = read_cohort('cohort_TEs.h5', regions = ['AT1TE52125', 'AT1TE42190'])
+"""
+
+import pandas as pd
+import numpy as np
+import h5py
+import argparse
+import os
+from glob import glob
+from region_methylation import COUNT_COLUMNS
+
+REGION_BLOCK = 1024
+SAMPLE_BLOCK = 32
+
+def create_cohort(path, regions):
+    """
+    Create an empty cohort file for a list of regions.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file to create.
+    regions: list
+        Names of the regions.
+
+    Returns
+    -------
+    Nothing; the file is written to `path`.
+    """
+    regions = np.array(regions, dtype='S')
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('regions', data=regions)
+        f.create_dataset('samples', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(SAMPLE_BLOCK,))
+        counts = f.create_dataset(
+            'counts',
+            shape=(len(regions), 0, len(COUNT_COLUMNS)),
+            maxshape=(len(regions), None, len(COUNT_COLUMNS)),
+            dtype=np.uint32,
+            chunks=(min(REGION_BLOCK, max(len(regions), 1)), SAMPLE_BLOCK, len(COUNT_COLUMNS)),
+            compression='lzf'
+        )
+        counts.attrs['contexts'] = COUNT_COLUMNS
+
+def read_region_counts(path):
+    """
+    Import counts on each region for a single sample, as written by
+    `methylation_on_TEs.py`.
+
+    These files are named `.tsv.gz` but are usually plain text, so whether
+    they are compressed is checked from the first bytes of the file.
+
+    Returns
+    -------
+    DataFrame indexed by region name with columns `COUNT_COLUMNS`.
+    """
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    counts = pd.read_csv(path, sep="\t", index_col=0, compression='gzip' if gzipped else None)
+    return counts[COUNT_COLUMNS]
+
+def append_samples(path, files, names=None, block=SAMPLE_BLOCK):
+    """
+    Append per-sample region counts to a cohort file.
+
+    Samples are written in blocks, so the array only needs resizing once per
+    block. Samples that are already in the file are skipped, so the same
+    command can be rerun as new samples are finished.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file. If it does not exist, it is created with the
+        regions in the first file.
+    files: list
+        Paths to per-sample files readable by `read_region_counts`.
+    names: list
+        Names for each sample. Defaults to the file names.
+    block: int
+        Number of samples to write at once.
+
+    Returns
+    -------
+    List of names of samples that were added.
+    """
+    if names is None:
+        names = [os.path.basename(f) for f in files]
+    if len(set(names)) < len(names):
+        raise ValueError("Sample names are not unique.")
+    if len(files) == 0:
+        return []
+    if not os.path.exists(path):
+        create_cohort(path, read_region_counts(files[0]).index)
+
+    added = []
+    with h5py.File(path, 'a') as f:
+        regions = pd.Index(f['regions'][:].astype(str))
+        existing = set(f['samples'].asstr()[:])
+        to_add = [(x, n) for x, n in zip(files, names) if n not in existing]
+        for i in range(0, len(to_add), block):
+            batch = to_add[i:i + block]
+            values = np.zeros((len(regions), len(batch), len(COUNT_COLUMNS)), dtype=np.uint32)
+            for j, (x, n) in enumerate(batch):
+                counts = read_region_counts(x)
+                missing = regions.difference(counts.index)
+                if len(missing) > 0:
+                    raise ValueError("{} has no counts for {} regions in {}, such as {}.".format(x, len(missing), path, missing[0]))
+                values[:, j] = counts.reindex(regions).to_numpy()
+            # Write counts before listing the samples, so that a sample is
+            # only listed once its counts are on disk. Columns left by an
+            # interrupted run are overwritten.
+            n_samples = f['samples'].shape[0]
+            f['counts'].resize((len(regions), n_samples + len(batch), len(COUNT_COLUMNS)))
+            f['counts'][:, n_samples:] = values
+            f['samples'].resize((n_samples + len(batch),))
+            f['samples'][n_samples:] = [n for x, n in batch]
+            added += [n for x, n in batch]
+    return added
+
+def read_cohort(path, regions=None, samples=None):
+    """
+    Read a slice of a cohort file.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file.
+    regions: list
+        Optional names of regions to read. Defaults to all regions.
+    samples: list
+        Optional names of samples to read. Defaults to all samples.
+
+    Returns
+    -------
+    Tuple of:
+    0. Array of counts with shape (regions, samples, 6), with the last axis
+        following `COUNT_COLUMNS`.
+    1. Names of the regions, in the order of the rows.
+    2. Names of the samples, in the order of the columns.
+    Regions and samples are returned in the order they are stored in the file.
+    """
+    with h5py.File(path, 'r') as f:
+        all_regions = pd.Index(f['regions'][:].astype(str))
+        all_samples = pd.Index(f['samples'].asstr()[:])
+        row_ix = slice(None) if regions is None else np.sort(_positions(all_regions, regions, 'regions'))
+        # Counts may have columns beyond the listed samples if a run was interrupted.
+        col_ix = slice(0, len(all_samples)) if samples is None else np.sort(_positions(all_samples, samples, 'samples'))
+        # h5py can only take a list of indices along one axis at a time, so
+        # only read the rows or columns that are needed.
+        if regions is None:
+            counts = f['counts'][:, col_ix]
+        else:
+            counts = f['counts'][row_ix][:, col_ix]
+    return counts, list(all_regions[row_ix]), list(all_samples[col_ix])
+
+def _positions(index, names, label):
+    """
+    Positions of `names` in `index`, with an informative error for names
+    that are missing.
+    """
+    ix = index.get_indexer(names)
+    if (ix < 0).any():
+        raise KeyError("{} {} not in the cohort file.".format(label, list(np.asarray(names)[ix < 0][:5])))
+    return ix
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Collect per-sample region counts into a single cohort HDF5 file')
+    parser.add_argument('-i', '--input', help = 'Glob pattern matching per-sample count files.', required = True)
+    parser.add_argument('-o', '--output', help = 'Path to the HDF5 file to create or append to.', required = True)
+    args = parser.parse_args()
+
+    files = sorted(glob(args.input))
+    added = append_samples(args.output, files)
+    print("Added {} of {} samples to {}.".format(len(added), len(files), args.output))
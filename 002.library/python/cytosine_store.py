@@ -0,0 +1,201 @@
+"""
+Tom Ellis, August 2021
+
+Convert an allc file from the methylpy pipeline to a folder of binary NumPy
+arrays that can be memory-mapped, so that later analyses do not have to
+decompress and parse the text file again.
+
+The store has a subfolder for each chromosome, containing `.npy` files for:
+1. `pos`: positions of each cytosine (uint32)
+2. `context`: trinucleotide codes from `encode_trinucleotides` (uint8)
+3. `mC_reads`: methylated reads (uint16, or uint32 if any count is too large)
+4. `all_reads`: total reads (uint16 or uint32, as for mC_reads)
+5. `signif`: methylpy's call of whether each cytosine is methylated (int8;
+    1 or 0, or -1 if the allc file has no call)
+A file `meta.json` lists the chromosomes in the order they appear in the allc
+file, the number of cytosines on each, and the size and modification time of
+the allc file the store was built from.
+
+`read_allc` in `weighted_mean_mC_from_allc.py` accepts the path to a store in
+place of an allc file, so all functions that read allc files through it
+(`sum_allc_reads`, `aggregate_regions`, the batch driver and
+`methylation_on_TEs.py`) can use a store directly.
+
+Parameters
+----------
+input: str
+    Path to allc file from the methylpy pipeline
+output: str
+    Folder in which to create the store.
+chunksize: int
+    Number of rows of the allc file to read at once.
+
+Example
+-------
+build_store('allc_sample.tsv.gz', 'allc_sample.cstore')
+store = CytosineStore('allc_sample.cstore')
+chr1 = store.chromosome('Chr1')   # memory-mapped arrays
+chr1['all_reads'][:10]
+sum_allc_reads('allc_sample.cstore')
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+from weighted_mean_mC_from_allc import read_allc
+from checkpoint import file_key
+
+COLUMNS = ['pos', 'context', 'mC_reads', 'all_reads', 'signif']
+STORE_VERSION = 2
+
+def is_store(path):
+    """
+    True if `path` is a folder containing a cytosine store.
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+def build_store(path, store, chunksize=1000000):
+    """
+    Convert an allc file to a folder of memory-mappable arrays.
+
+    The allc file is read in chunks, and each column of each chunk is
+    appended to a temporary raw binary file for its chromosome, so memory
+    depends only on `chunksize`. Once the whole file has been read, the raw
+    files are copied into `.npy` files with the smallest suitable data type.
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped allc file from the methylpy pipeline.
+    store: str
+        Folder in which to create the store. Any existing store there is
+        replaced.
+    chunksize: int
+        Number of rows of the allc file to read at once.
+
+    Returns
+    -------
+    Nothing; the store is written to `store`.
+    """
+    tmp_store = store.rstrip('/') + '.tmp'
+    if os.path.exists(tmp_store):
+        shutil.rmtree(tmp_store)
+    os.makedirs(tmp_store)
+
+    raw_dtypes = {'pos' : np.uint32, 'context' : np.uint8, 'mC_reads' : np.uint32, 'all_reads' : np.uint32, 'signif' : np.int8}
+    raw_files = {}
+    n_cytosines = {}
+    max_reads = 0
+    for chunk in read_allc(path, chunksize):
+        max_reads = max(max_reads, int(chunk['all_reads'].max()), int(chunk['mC_reads'].max()))
+        for c, ix in chunk.groupby('chr', observed=True).indices.items():
+            if c not in raw_files.keys():
+                os.makedirs(os.path.join(tmp_store, c))
+                raw_files[c] = {k: open(os.path.join(tmp_store, c, k + '.raw'), 'wb') for k in COLUMNS}
+                n_cytosines[c] = 0
+            n_cytosines[c] += len(ix)
+            for k in COLUMNS:
+                raw_files[c][k].write(chunk[k].to_numpy()[ix].astype(raw_dtypes[k]).tobytes())
+
+    # Copy raw files to .npy files, in blocks so as not to load them whole.
+    count_dtype = np.uint16 if max_reads <= np.iinfo(np.uint16).max else np.uint32
+    dtypes = {'pos' : np.uint32, 'context' : np.uint8, 'mC_reads' : count_dtype, 'all_reads' : count_dtype, 'signif' : np.int8}
+    for c, files in raw_files.items():
+        for k in COLUMNS:
+            files[k].close()
+            raw_path = os.path.join(tmp_store, c, k + '.raw')
+            raw = np.memmap(raw_path, dtype=raw_dtypes[k], mode='r', shape=(n_cytosines[c],)) if n_cytosines[c] > 0 else np.zeros(0, raw_dtypes[k])
+            out = np.lib.format.open_memmap(os.path.join(tmp_store, c, k + '.npy'), mode='w+', dtype=dtypes[k], shape=(n_cytosines[c],))
+            for i in range(0, n_cytosines[c], int(chunksize)):
+                out[i:i + int(chunksize)] = raw[i:i + int(chunksize)]
+            out.flush()
+            del out, raw
+            os.remove(raw_path)
+
+    meta = {
+        'version'     : STORE_VERSION,
+        'source'      : file_key(path),
+        'chromosomes' : n_cytosines,
+        'dtypes'      : {k: np.dtype(v).name for k, v in dtypes.items()}
+    }
+    with open(os.path.join(tmp_store, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    if os.path.exists(store):
+        shutil.rmtree(store)
+    os.replace(tmp_store, store)
+
+class CytosineStore:
+    """
+    Read-only access to a store created by `build_store`.
+
+    Parameters
+    ----------
+    path: str
+        Folder containing the store.
+    mmap_mode: str
+        Passed to `np.load`. The default 'r' memory-maps arrays read-only, so
+        nothing is read from disk until it is used. Use None to load arrays
+        into memory.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        if not is_store(path):
+            raise ValueError("{} is not a cytosine store.".format(path))
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != STORE_VERSION:
+            raise ValueError("{} was built with a different version of build_store; please rebuild it.".format(path))
+        self.chromosomes = list(self.meta['chromosomes'].keys())
+
+    def __len__(self):
+        return sum(self.meta['chromosomes'].values())
+
+    def chromosome(self, chrom):
+        """
+        Dictionary of arrays for positions, trinucleotide codes, methylated
+        reads, total reads and methylpy calls on a single chromosome.
+        """
+        return {
+            k: np.load(os.path.join(self.path, chrom, k + '.npy'), mmap_mode=self.mmap_mode)
+            for k in COLUMNS
+        }
+
+    def iter_chunks(self, chunksize=1000000, chunks_to_test=None):
+        """
+        Iterate over the store in chunks of rows, in the same format as
+        `read_allc`.
+
+        Chunks do not span chromosomes, so some chunks may be shorter than
+        `chunksize`.
+
+        Returns
+        -------
+        Generator of DataFrames with columns 'chr' (categorical), 'pos',
+        'context', 'mC_reads', 'all_reads' and 'signif'.
+        """
+        chunksize = int(chunksize)
+        categories = pd.CategoricalDtype(self.chromosomes)
+        i = 0
+        for code, c in enumerate(self.chromosomes):
+            arrays = self.chromosome(c)
+            for start in range(0, self.meta['chromosomes'][c], chunksize):
+                if chunks_to_test is not None and i >= chunks_to_test:
+                    return
+                chunk = pd.DataFrame({k: arrays[k][start:start + chunksize] for k in COLUMNS})
+                chunk.insert(0, 'chr', pd.Categorical.from_codes(np.full(chunk.shape[0], code), dtype=categories))
+                i += 1
+                yield chunk
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Convert an allc file to a folder of memory-mappable arrays')
+    parser.add_argument('-i', '--input', help = 'Path to allc file from the methylpy pipeline', required = True)
+    parser.add_argument('-o', '--output', help = 'Folder in which to create the store.', required = True)
+    parser.add_argument('--chunksize', help = 'Number of rows of the allc file to read at once.', type = int, default = 1000000)
+    args = parser.parse_args()
+
+    build_store(args.input, args.output, args.chunksize)
@@ -0,0 +1,281 @@
+"""
+Tom Ellis, August 2021
+
+Look up accessions in a genotype directory used for GWAS, and return
+genotypes, kinship and phenotypes aligned to the same accessions.
+
+A genotype directory (as used for PyGWAS) contains:
+1. `all_chromosomes_binary.hdf5`: binary SNP matrix with datasets `snps`
+    (SNPs x accessions), `accessions` and `positions`, with the start and end
+    index of each chromosome in the attribute `chr_regions` of `positions`.
+2. `kinship_ibs_binary_mac5.h5py`: kinship matrix with datasets `kinship` and
+    `accessions`, which need not be in the same order as the SNP matrix.
+
+Accession names are read from each file once when the store is opened, and
+indexed, so looking up a panel of accessions does not touch the HDF5 files.
+Kinship matrices for a subset of accessions, and their eigendecompositions,
+are cached in a folder next to the genotype directory
+(`<genotype directory>.cache`) in files named after a hash of the accession
+list and the kinship file. Repeat runs on the same panel therefore neither read
+the full kinship matrix nor decompose it again. The decomposition is in the
+format returned by `numpy_sugar.linalg.economic_qs`, which glimix-core (and so
+limix) takes as `QS` in place of a kinship matrix, so it can be used by any
+mixed model fitted with those packages.
+
+Example
+-------
+store = GenotypeStore('/groups/nordborg/projects/the1001genomes/1001G_genotypes')
+acn_indices = store.align(pheno.index)
+QS = store.economic_qs(acn_indices)
+for start, G, positions in store.iter_snp_blocks(acn_indices):
+    ...
+"""
+
+import pandas as pd
+import numpy as np
+import h5py
+import hashlib
+import json
+import os
+from checkpoint import file_key
+
+SNP_FILE = 'all_chromosomes_binary.hdf5'
+KINSHIP_FILE = 'kinship_ibs_binary_mac5.h5py'
+
+def accession_key(accessions, source):
+    """
+    Hash of a list of accessions and the file they are taken from.
+
+    Parameters
+    ----------
+    accessions: list
+        Accession names as bytes, in order.
+    source: str
+        Path to the file the accessions are looked up in. Its size and
+        modification time are part of the hash, so the hash changes if the
+        file is replaced.
+
+    Returns
+    -------
+    Hexadecimal SHA1 hash.
+    """
+    key = file_key(source)
+    h = hashlib.sha1(json.dumps([key['path'], key['size'], key['mtime']]).encode())
+    h.update(b'\0'.join(accessions))
+    return h.hexdigest()
+
+def maf_filter(G, maf):
+    """
+    Minor allele frequency of each SNP, and the SNPs above a threshold.
+
+    Parameters
+    ----------
+    G: array
+        Binary SNP matrix with a row for each SNP and a column for each
+        accession.
+    maf: float
+        Minor allele frequency cut-off.
+
+    Returns
+    -------
+    Tuple of indices of SNPs with a minor allele frequency of at least `maf`,
+    and the minor allele frequency of those SNPs.
+    """
+    AC1 = G.sum(axis = 1)
+    AC0 = G.shape[1] - AC1
+    MAC = np.minimum(AC0, AC1)
+    MAF = MAC/G.shape[1]
+    SNP_indices = np.where(MAF >= float(maf))[0]
+    return SNP_indices, MAF[SNP_indices]
+
+class GenotypeStore:
+    """
+    Genotype and kinship files in a genotype directory, indexed by accession.
+
+    Parameters
+    ----------
+    directory: str
+        Genotype directory containing the SNP matrix and kinship matrix.
+    cache_dir: str
+        Folder in which to cache kinship matrices for subsets of accessions.
+        Defaults to `directory` with `.cache` appended. This is created when
+        it is first needed.
+    """
+    def __init__(self, directory, cache_dir = None):
+        self.snp_file = os.path.join(directory, SNP_FILE)
+        self.kinship_file = os.path.join(directory, KINSHIP_FILE)
+        self.cache_dir = cache_dir if cache_dir is not None else directory.rstrip('/') + '.cache'
+        with h5py.File(self.snp_file, 'r') as f:
+            self.accessions = pd.Index(f['accessions'][:])
+            self.chr_regions = f['positions'].attrs['chr_regions'][:]
+            self.n_snps = f['snps'].shape[0]
+        with h5py.File(self.kinship_file, 'r') as f:
+            self.kinship_accessions = pd.Index(f['accessions'][:])
+
+    def align(self, accessions):
+        """
+        Positions in the SNP matrix of accessions that are in both the SNP and
+        kinship matrices.
+
+        Parameters
+        ----------
+        accessions: list
+            Accession names, either as bytes or as anything `str` can convert
+            (such as integer accession IDs). Accessions that are not in both
+            files are ignored.
+
+        Returns
+        -------
+        Array of indices of accessions in the SNP matrix, in ascending order.
+        """
+        accessions = pd.Index([x if isinstance(x, bytes) else str(x).encode('UTF8') for x in accessions])
+        usable = self.accessions.isin(accessions) & self.accessions.isin(self.kinship_accessions)
+        return np.where(usable)[0]
+
+    def phenotypes(self, pheno, acn_indices):
+        """
+        Rows of a phenotype (or covariate) table in the order of `acn_indices`.
+
+        Parameters
+        ----------
+        pheno: DataFrame
+            Table indexed by accession name as bytes.
+        acn_indices: array
+            Indices of accessions in the SNP matrix, from `align`.
+
+        Returns
+        -------
+        DataFrame with a row for each accession, with NaN for accessions
+        missing from `pheno`.
+        """
+        return pheno.reindex(self.accessions[acn_indices])
+
+    def read_snps(self, acn_indices, start, stop):
+        """
+        Read a block of rows of the SNP matrix, for a subset of accessions.
+
+        Parameters
+        ----------
+        acn_indices: array
+            Indices of accessions in the SNP matrix, in ascending order.
+        start, stop: int
+            Indices of the first SNP, and one after the last SNP, to read.
+
+        Returns
+        -------
+        Binary SNP matrix with a row for each SNP and a column for each
+        accession.
+        """
+        with h5py.File(self.snp_file, 'r') as f:
+            return f['snps'][start:stop, acn_indices]
+
+    def iter_snp_blocks(self, acn_indices, block_size = 50000):
+        """
+        Read the SNP matrix in blocks of SNPs, for a subset of accessions.
+
+        Parameters
+        ----------
+        acn_indices: array
+            Indices of accessions in the SNP matrix, in ascending order.
+        block_size: int
+            Number of SNPs to read at once.
+
+        Returns
+        -------
+        Generator of tuples giving (1) the index of the first SNP in the
+        block, (2) a binary SNP matrix with a row for each SNP and a column
+        for each accession and (3) positions of the SNPs.
+        """
+        block_size = int(block_size)
+        with h5py.File(self.snp_file, 'r') as f:
+            for start in range(0, self.n_snps, block_size):
+                yield start, f['snps'][start:start + block_size, acn_indices], f['positions'][start:start + block_size]
+
+    def kinship(self, acn_indices):
+        """
+        Kinship matrix for a subset of accessions, in the order of the SNP
+        matrix.
+
+        The matrix is read from the cache if this set of accessions has been
+        used before, and otherwise read from the kinship file and cached.
+
+        Parameters
+        ----------
+        acn_indices: array
+            Indices of accessions in the SNP matrix, from `align`.
+
+        Returns
+        -------
+        Square array with a row and column for each accession.
+        """
+        accessions = np.array(self.accessions[acn_indices], dtype = 'S')
+        cached = self._read_cache('kinship', accessions)
+        if cached is not None:
+            return cached['kinship']
+
+        kin_indices = self.kinship_accessions.get_indexer(accessions)
+        if (kin_indices < 0).any():
+            raise KeyError("Accessions {} are not in {}.".format(list(accessions[kin_indices < 0][:5]), self.kinship_file))
+        # HDF5 needs indices in ascending order, so read sorted rows and reorder afterwards.
+        sorted_indices = np.sort(kin_indices)
+        with h5py.File(self.kinship_file, 'r') as f:
+            K = f['kinship'][sorted_indices, :][:, sorted_indices]
+        reorder = np.searchsorted(sorted_indices, kin_indices)
+        K = K[reorder][:, reorder]
+        self._write_cache('kinship', accessions, kinship = K)
+        return K
+
+    def economic_qs(self, acn_indices):
+        """
+        Eigendecomposition of the kinship matrix for a subset of accessions.
+
+        The decomposition is read from the cache if this set of accessions has
+        been used before, and otherwise computed from `kinship` and cached.
+
+        Parameters
+        ----------
+        acn_indices: array
+            Indices of accessions in the SNP matrix, from `align`.
+
+        Returns
+        -------
+        Tuple ((Q0, Q1), S0) as returned by `numpy_sugar.linalg.economic_qs`,
+        where Q0 holds eigenvectors with non-zero eigenvalues S0 and Q1 the
+        remaining eigenvectors. This can be passed as `QS` to
+        `glimix_core.lmm.LMM` and related models.
+        """
+        from numpy_sugar.linalg import economic_qs
+        accessions = np.array(self.accessions[acn_indices], dtype = 'S')
+        cached = self._read_cache('qs', accessions)
+        if cached is not None:
+            return (cached['Q0'], cached['Q1']), cached['S0']
+        (Q0, Q1), S0 = economic_qs(self.kinship(acn_indices))
+        self._write_cache('qs', accessions, Q0 = Q0, Q1 = Q1, S0 = S0)
+        return (Q0, Q1), S0
+
+    def _cache_file(self, prefix, accessions):
+        return os.path.join(self.cache_dir, '{}_{}.npz'.format(prefix, accession_key(accessions, self.kinship_file)))
+
+    def _read_cache(self, prefix, accessions):
+        """
+        Arrays cached for a list of accessions, or None if there are none.
+        """
+        cache_file = self._cache_file(prefix, accessions)
+        if not os.path.exists(cache_file):
+            return None
+        with np.load(cache_file) as cached:
+            if not np.array_equal(cached['accessions'], accessions):
+                return None
+            return {k: cached[k] for k in cached.files}
+
+    def _write_cache(self, prefix, accessions, **arrays):
+        """
+        Cache arrays for a list of accessions, writing to a temporary file
+        first so that other processes never see a partial file.
+        """
+        os.makedirs(self.cache_dir, exist_ok = True)
+        cache_file = self._cache_file(prefix, accessions)
+        tmp = cache_file + '.{}.tmp'.format(os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, accessions = accessions, **arrays)
+        os.replace(tmp, cache_file)
@@ -0,0 +1,211 @@
+"""
+Tom Ellis, August 2021
+
+Genome-wide significance thresholds for `singletrait.py` from permutations of
+the phenotype.
+
+For each permutation the phenotype is shuffled among accessions, the null
+model is refitted, and every SNP is tested; the largest -log10 p-value over
+the genome is kept. The threshold is the (1 - alpha) quantile of these maxima.
+
+Doing this with one `glimix_core` scan per permutation would mean scanning the
+genome N times. Instead, for a fixed ratio of genetic to residual variance the
+likelihood-ratio statistic of each SNP has a closed form in terms of
+genotypes and phenotypes rotated by the eigenvectors of the kinship matrix.
+The rotation does not depend on the phenotype, so each block of SNPs is
+rotated once, and the statistics for many permutations come from a few matrix
+products with a matrix of permuted phenotypes. These give the same statistics
+as `FastScanner.fast_scan` in glimix-core (which also holds the variance ratio
+at its null-model value). Blocks of SNPs are spread over a pool of processes,
+each of which reads its own blocks from the SNP matrix.
+
+Only normally distributed phenotypes are supported.
+
+Example
+-------
+nulls = {'CG' : permutation_models(y, M, QS, 1000, np.random.default_rng(1))}
+max_logp = permutation_test(store, acn_indices, [(ix, QS, nulls)], 0.05)
+threshold = permutation_threshold(max_logp['CG'])
+"""
+
+import numpy as np
+from scipy.stats import chi2
+from concurrent.futures import ProcessPoolExecutor
+from genotype_store import maf_filter
+
+PERMUTATION_BLOCK = 100
+
+def permutation_models(y, M, QS, n_permutations, rng):
+    """
+    Fit the null model to permutations of a phenotype.
+
+    Parameters
+    ----------
+    y: array
+        Phenotype values for each accession.
+    M: array
+        Matrix of covariates for each accession, including an intercept.
+    QS: tuple
+        Eigendecomposition of the kinship matrix from `economic_qs`.
+    n_permutations: int
+        Number of permutations.
+    rng: numpy.random.Generator
+        Random number generator used to permute `y`.
+
+    Returns
+    -------
+    Dictionary of arrays describing each null model in the rotated space,
+    with the permutations along the last axis:
+    - 'W': inverse of the variance of each rotated accession
+    - 'yW': rotated phenotypes multiplied by 'W'
+    - 'Mr': rotated covariates
+    - 'Minv': inverse of the weighted cross-product of the covariates
+    - 'MtWy': weighted cross-product of covariates and phenotypes
+    - 'rss0': weighted residual sum of squares under the null model
+    """
+    from glimix_core.lmm import LMM
+    (Q0, Q1), S0 = QS
+    Q = np.hstack([Q0, Q1])
+    n = len(y)
+    Mr = Q.T @ M
+    W = np.zeros((n, n_permutations))
+    yW = np.zeros((n, n_permutations))
+    for p in range(n_permutations):
+        y_perm = rng.permutation(y)
+        lmm = LMM(y_perm, M, QS, restricted = False)
+        lmm.fit(verbose = False)
+        W[:, p] = 1 / np.concatenate([lmm.v0 * S0 + lmm.v1, np.full(Q1.shape[1], lmm.v1)])
+        yW[:, p] = (Q.T @ y_perm) * W[:, p]
+    Minv = np.linalg.inv(np.einsum('nc,np,nd->pcd', Mr, W, Mr))
+    MtWy = Mr.T @ yW
+    yr = yW / W
+    rss0 = (yr * yW).sum(axis = 0) - np.einsum('cp,pcd,dp->p', MtWy, Minv, MtWy)
+    return {'W' : W, 'yW' : yW, 'Mr' : Mr, 'Minv' : Minv, 'MtWy' : MtWy, 'rss0' : rss0}
+
+def max_lrt(Gr, null):
+    """
+    Largest likelihood-ratio statistic over a block of SNPs for each
+    permutation.
+
+    Parameters
+    ----------
+    Gr: array
+        Genotypes (accessions x SNPs) rotated by the eigenvectors of the
+        kinship matrix, as `Q.T @ G`.
+    null: dict
+        Null models for permuted phenotypes from `permutation_models`.
+
+    Returns
+    -------
+    Array with the largest statistic over SNPs for each permutation.
+    """
+    n_permutations = null['W'].shape[1]
+    n, c = null['Mr'].shape
+    out = np.zeros(n_permutations)
+    if Gr.shape[1] == 0:
+        return out
+    Gr2 = Gr ** 2
+    # Permutations are done in batches to limit the size of the arrays of
+    # SNPs x covariates x permutations.
+    for start in range(0, n_permutations, PERMUTATION_BLOCK):
+        p = slice(start, start + PERMUTATION_BLOCK)
+        W = null['W'][:, p]
+        gy = Gr.T @ null['yW'][:, p]
+        gg = Gr2.T @ W
+        A = (Gr.T @ (null['Mr'][:, :, None] * W[:, None, :]).reshape(n, -1)).reshape(Gr.shape[1], c, -1)
+        # Remove the part of each SNP explained by the covariates
+        AMinv = np.einsum('mcp,pcd->mdp', A, null['Minv'][p])
+        gy = gy - np.einsum('mdp,dp->mp', AMinv, null['MtWy'][:, p])
+        gg = gg - np.einsum('mdp,mdp->mp', AMinv, A)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            rss1 = null['rss0'][p] - gy ** 2 / gg
+            lrt = n * np.log(null['rss0'][p] / rss1)
+        out[p] = np.where(gg > 1e-8, lrt, 0).max(axis = 0)
+    return out
+
+def lrt_to_logp(lrt):
+    """
+    -log10 p-values for likelihood-ratio statistics with one degree of
+    freedom.
+    """
+    return -chi2(1).logsf(lrt) / np.log(10)
+
+def permutation_threshold(max_logp, alpha = 0.05):
+    """
+    P-value threshold from the maximum -log10 p-value in each permutation.
+
+    Parameters
+    ----------
+    max_logp: array
+        Largest -log10 p-value over the genome for each permutation.
+    alpha: float
+        Genome-wide false-positive rate.
+
+    Returns
+    -------
+    P-value below which a SNP is significant at `alpha`.
+    """
+    return 10 ** -np.quantile(max_logp, 1 - alpha)
+
+_worker = {}
+
+def _init_worker(store, acn_indices, groups, maf):
+    """
+    Give each worker process the genotype store, the rotation and null models
+    for each group of traits, and the MAF cut-off.
+    """
+    _worker['store'] = store
+    _worker['acn_indices'] = acn_indices
+    _worker['groups'] = [
+        (ix, np.hstack(QS[0]), nulls) for ix, QS, nulls in groups
+    ]
+    _worker['maf'] = maf
+
+def _scan_block(start, block_size):
+    """
+    Largest statistic for each trait and permutation over one block of SNPs.
+    """
+    G_block = _worker['store'].read_snps(_worker['acn_indices'], start, start + block_size)
+    out = {}
+    for ix, Q, nulls in _worker['groups']:
+        G = G_block[:, ix]
+        SNP_indices, _ = maf_filter(G, _worker['maf'])
+        Gr = Q.T @ G[SNP_indices, :].transpose().astype(float)
+        for trait, null in nulls.items():
+            out[trait] = max_lrt(Gr, null)
+    return out
+
+def permutation_test(store, acn_indices, groups, maf, block_size = 50000, workers = 1):
+    """
+    Largest -log10 p-value over the genome for each permutation of each trait.
+
+    Parameters
+    ----------
+    store: GenotypeStore
+        Genotype store to read SNPs from.
+    acn_indices: array
+        Indices of accessions in the SNP matrix used by any trait.
+    groups: list
+        List of tuples for each set of accessions giving (1) indices of
+        `acn_indices` used by these traits, (2) the eigendecomposition of
+        their kinship matrix and (3) a dictionary of null models for each
+        trait from `permutation_models`.
+    maf: float
+        Minor allele frequency cut-off, applied as in `singletrait.py`.
+    block_size: int
+        Number of SNPs each worker reads at once.
+    workers: int
+        Number of worker processes.
+
+    Returns
+    -------
+    Dictionary giving an array of the largest -log10 p-value for each
+    permutation for each trait.
+    """
+    starts = range(0, store.n_snps, int(block_size))
+    result = {trait : np.zeros(null['W'].shape[1]) for ix, QS, nulls in groups for trait, null in nulls.items()}
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker, initargs = (store, acn_indices, groups, maf)) as pool:
+        for block in pool.map(_scan_block, starts, [int(block_size)] * len(starts)):
+            for trait, lrt in block.items():
+                result[trait] = np.maximum(result[trait], lrt)
+    return {trait : lrt_to_logp(lrt) for trait, lrt in result.items()}
@@ -0,0 +1,216 @@
+"""
+Tom Ellis, August 2021
+
+Manhattan and QQ plots for genome-wide results from `singletrait.py`, drawn
+quickly enough for millions of SNPs.
+
+Most SNPs in a genome-wide scan have large p-values and are drawn on top of one
+another, so plotting every point wastes most of the time. Here SNPs with
+-log10 p-values above `min_logp` are always drawn, and of the rest only one SNP
+is drawn for each pixel of the figure, which looks the same. QQ plots draw
+every SNP among the `top` smallest p-values, and otherwise one SNP at each of
+`n_quantiles` quantiles spaced evenly on the -log10 scale. Figures are drawn
+with the Agg backend, so no display is needed.
+
+`singletrait.py` draws these plots at the end of a run unless --no_plots is
+given; this script can draw them later from the HDF5 file of results.
+
+Parameters
+----------
+input: str
+    HDF5 file of results from `singletrait.py`.
+outDir: str
+    Directory in which to save plots.
+traits: list
+    Optional names of traits to plot. Defaults to every trait in the file.
+threshold: float
+    Optional significance threshold for p-values. Defaults to the permutation
+    threshold if there is one in the results file, and otherwise to a
+    Bonferroni threshold of 0.05 divided by the number of SNPs.
+min_logp: float
+    SNPs with -log10 p-values above this are never thinned.
+
+Returns
+-------
+Files `manhattanPlot_{trait}_{maf}.png` and `qqPlot_{trait}_{maf}.png` for each
+trait in `outDir`.
+
+Example
+-------
+plot_trait('gwas_results_0.05.h5', 'CG', 'gwas_plots')
+"""
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import argparse
+import os
+import h5py
+from gwas_results import read_results, traits as results_traits
+
+FIGSIZE = (12, 4)
+DPI = 150
+
+def thin_points(x, y, keep, width, height):
+    """
+    Keep one point for each pixel of a figure, plus all points in `keep`.
+
+    Parameters
+    ----------
+    x, y: array
+        Coordinates of each point.
+    keep: array
+        Boolean array of points to keep regardless.
+    width, height: int
+        Size of the plotting area in pixels.
+
+    Returns
+    -------
+    Boolean array of points to draw.
+    """
+    if len(x) == 0:
+        return keep
+    xbin = np.floor((x - x.min()) / max(np.ptp(x), 1e-12) * (width - 1)).astype(np.int64)
+    ybin = np.floor((y - y.min()) / max(np.ptp(y), 1e-12) * (height - 1)).astype(np.int64)
+    _, first = np.unique(xbin * height + ybin, return_index=True)
+    draw = keep.copy()
+    draw[first] = True
+    return draw
+
+def manhattan(results, path, threshold=None, min_logp=3):
+    """
+    Manhattan plot of p-values along the genome.
+
+    Parameters
+    ----------
+    results: DataFrame
+        Results with columns 'chr', 'pos' and 'pvalue', sorted by chromosome
+        and position.
+    path: str
+        File in which to save the plot.
+    threshold: float
+        Optional p-value at which to draw a horizontal line.
+    min_logp: float
+        SNPs with -log10 p-values above this are always drawn; others are
+        thinned to one per pixel.
+
+    Returns
+    -------
+    Nothing; the plot is saved to `path`.
+    """
+    chrom = results['chr'].to_numpy()
+    pos = results['pos'].to_numpy().astype(np.float64)
+    logp = -np.log10(results['pvalue'].to_numpy().astype(np.float64))
+    # Position along the genome, with chromosomes end to end.
+    chromosomes = np.unique(chrom)
+    lengths = np.array([pos[chrom == c].max() for c in chromosomes])
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    x = pos + offsets[np.searchsorted(chromosomes, chrom)]
+
+    fig, ax = plt.subplots(figsize=FIGSIZE, dpi=DPI)
+    width, height = int(FIGSIZE[0] * DPI), int(FIGSIZE[1] * DPI)
+    draw = thin_points(x, logp, logp > min_logp, width, height)
+    colours = np.where(np.searchsorted(chromosomes, chrom) % 2 == 0, '#1f4e79', '#7fa7c9')
+    ax.scatter(x[draw], logp[draw], c=colours[draw], s=4, linewidths=0, rasterized=True)
+    if threshold is not None:
+        ax.axhline(-np.log10(threshold), color='red')
+    ax.set_xticks(offsets + lengths / 2)
+    ax.set_xticklabels(chromosomes)
+    ax.set_xlim(0, x.max() if len(x) > 0 else 1)
+    ax.set_xlabel('Chromosome')
+    ax.set_ylabel('-log10(p-value)')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+def qqplot(pvalues, path, n_quantiles=1000, top=1000):
+    """
+    QQ plot of observed against expected p-values, on the -log10 scale.
+
+    Parameters
+    ----------
+    pvalues: array
+        P-values for each SNP.
+    path: str
+        File in which to save the plot.
+    n_quantiles: int
+        Number of quantiles, spaced evenly on the -log10 scale, at which to
+        draw points.
+    top: int
+        Number of the smallest p-values that are always drawn.
+
+    Returns
+    -------
+    Nothing; the plot is saved to `path`.
+    """
+    observed = np.sort(np.asarray(pvalues, dtype=np.float64))
+    n = len(observed)
+    # Ranks to draw: all of the smallest p-values, then quantiles of the rest.
+    ranks = np.unique(np.concatenate([
+        np.arange(min(top, n)),
+        np.round(np.logspace(0, np.log10(max(n, 1)), n_quantiles)).astype(np.int64) - 1
+    ]))
+    ranks = ranks[ranks < n]
+    expected = -np.log10((ranks + 0.5) / n)
+    observed = -np.log10(observed[ranks])
+
+    fig, ax = plt.subplots(figsize=(FIGSIZE[1], FIGSIZE[1]), dpi=DPI)
+    ax.scatter(expected, observed, s=4, c='#1f4e79', linewidths=0)
+    lim = max(expected.max(), observed.max()) if n > 0 else 1
+    ax.plot([0, lim], [0, lim], color='red', linewidth=1)
+    ax.set_xlabel('Expected -log10(p-value)')
+    ax.set_ylabel('Observed -log10(p-value)')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+def plot_trait(path, trait, outDir, threshold=None, min_logp=3):
+    """
+    Manhattan and QQ plots for one trait in a file of results.
+
+    Plots are saved as `manhattanPlot_{trait}_{maf}.png` and
+    `qqPlot_{trait}_{maf}.png` in `outDir`, where `maf` is the minor allele
+    frequency cut-off stored in the results file.
+
+    Parameters
+    ----------
+    path: str
+        HDF5 file of results from `singletrait.py`.
+    trait: str
+        Name of the trait to plot.
+    outDir: str
+        Directory in which to save plots.
+    threshold: float
+        Optional p-value at which to draw a line on the Manhattan plot.
+        Defaults to the permutation threshold for the trait if there is one,
+        and otherwise 0.05 divided by the number of SNPs.
+    min_logp: float
+        SNPs with -log10 p-values above this are never thinned.
+
+    Returns
+    -------
+    Nothing; plots are saved to `outDir`.
+    """
+    with h5py.File(path, 'r') as f:
+        maf = f.attrs['maf']
+        if threshold is None:
+            threshold = f[trait].attrs.get('permutation_threshold')
+    results = read_results(path, trait, columns=['chr', 'pos', 'pvalue'])
+    if threshold is None:
+        threshold = 0.05 / max(results.shape[0], 1)
+    manhattan(results, f'{outDir}/manhattanPlot_{trait}_{maf}.png', threshold=threshold, min_logp=min_logp)
+    qqplot(results['pvalue'], f'{outDir}/qqPlot_{trait}_{maf}.png')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Manhattan and QQ plots for results from singletrait.py')
+    parser.add_argument('-i', '--input', help = 'HDF5 file of results from singletrait.py.', required = True)
+    parser.add_argument('-o', '--outDir', help = 'Directory in which to save plots.', required = True)
+    parser.add_argument('-t', '--traits', help = 'Names of traits to plot. Defaults to every trait in the file.', nargs = '+', required = False)
+    parser.add_argument('--threshold', help = 'P-value at which to draw a line on Manhattan plots. Defaults to the permutation threshold if there is one, or else 0.05 divided by the number of SNPs.', type = float, required = False)
+    parser.add_argument('--min_logp', help = 'SNPs with -log10 p-values above this are never thinned. Default is 3.', type = float, default = 3)
+    args = parser.parse_args()
+
+    os.makedirs(args.outDir, exist_ok=True)
+    for trait in args.traits or results_traits(args.input):
+        plot_trait(args.input, trait, args.outDir, threshold=args.threshold, min_logp=args.min_logp)
@@ -0,0 +1,167 @@
+"""
+Tom Ellis, August 2021
+
+Write and read GWAS results from `singletrait.py` in a compact HDF5 format.
+
+All traits from one run go in a single file, with a group for each trait
+holding one dataset per column:
+1. `chr`: chromosome number (uint8)
+2. `pos`: position of the SNP (uint32)
+3. `pvalue`: p-value (float64, so that very small p-values keep their order)
+4. `maf`: minor allele frequency (float32)
+5. `mac`: minor allele count (uint32)
+6. `GVE`: effect size of the SNP (float32)
+Datasets are extended one block of SNPs at a time, so results never need to be
+held in memory for the whole genome. The number of accessions for each trait is
+stored in the attribute `n_accessions` of its group, and the minor allele
+frequency cut-off in the attribute `maf` of the file. If permutations were run,
+a trait's group also holds the largest -log10 p-value in each permutation
+(`permutation_max_logp`), with the false-positive rate and p-value threshold in
+its attributes `permutation_alpha` and `permutation_threshold`.
+
+`export_csv` writes the CSV file that `singletrait.py` used to produce for a
+trait, with columns chr, pos, pvalue, maf, mac and GVE.
+
+Example
+-------
+results = read_results('gwas_results_0.05.h5', 'CG')
+export_csv('gwas_results_0.05.h5', 'CG', 'CG_0.05.csv')
+"""
+
+import pandas as pd
+import numpy as np
+import h5py
+
+RESULT_DTYPES = {
+    'chr'    : np.uint8,
+    'pos'    : np.uint32,
+    'pvalue' : np.float64,
+    'maf'    : np.float32,
+    'mac'    : np.uint32,
+    'GVE'    : np.float32
+}
+RESULT_BLOCK = 65536
+
+def snp_chromosomes(chr_regions, snp_indices):
+    """
+    Chromosome number of each SNP, from its index in the SNP matrix.
+
+    Parameters
+    ----------
+    chr_regions: array
+        Start and end index of each chromosome in the SNP matrix, as in the
+        attribute `chr_regions` of the `positions` dataset.
+    snp_indices: array
+        Indices of SNPs in the SNP matrix.
+
+    Returns
+    -------
+    Array of chromosome numbers, counting from 1.
+    """
+    return np.searchsorted(chr_regions[:, 1], snp_indices, side = 'right') + 1
+
+class ResultsWriter:
+    """
+    Append results to an HDF5 file of GWAS results, one block at a time.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file. This is created if it does not exist.
+    traits: dict
+        Dictionary giving the number of accessions for each trait. Any
+        existing results for these traits in `path` are replaced.
+    maf: float
+        Minor allele frequency cut-off used for the scan.
+    """
+    def __init__(self, path, traits, maf):
+        self.path = path
+        self.file = h5py.File(path, 'a')
+        self.file.attrs['maf'] = maf
+        for trait, n_accessions in traits.items():
+            if trait in self.file:
+                del self.file[trait]
+            group = self.file.create_group(trait)
+            group.attrs['n_accessions'] = n_accessions
+            for k, dtype in RESULT_DTYPES.items():
+                group.create_dataset(k, shape = (0,), maxshape = (None,), dtype = dtype, chunks = (RESULT_BLOCK,), compression = 'lzf')
+
+    def append(self, trait, chrom, pos, pvalues, effsizes, SNPs_MAF):
+        """
+        Append results for a block of SNPs for one trait.
+        """
+        group = self.file[trait]
+        values = {
+            'chr'    : chrom,
+            'pos'    : pos,
+            'pvalue' : pvalues,
+            'maf'    : SNPs_MAF,
+            'mac'    : np.rint(SNPs_MAF * group.attrs['n_accessions']),
+            'GVE'    : effsizes
+        }
+        n = group['pvalue'].shape[0]
+        for k, v in values.items():
+            group[k].resize((n + len(v),))
+            group[k][n:] = np.asarray(v).astype(RESULT_DTYPES[k])
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_results(path, trait, columns = None):
+    """
+    Results for one trait.
+
+    Parameters
+    ----------
+    path: str
+        Path to the HDF5 file of results.
+    trait: str
+        Name of the trait.
+    columns: list
+        Optional list of columns to read. Defaults to all columns.
+
+    Returns
+    -------
+    DataFrame with a row for each SNP.
+    """
+    columns = list(RESULT_DTYPES.keys()) if columns is None else columns
+    with h5py.File(path, 'r') as f:
+        return pd.DataFrame({k: f[trait][k][:] for k in columns})
+
+def traits(path):
+    """
+    Names of the traits in a file of results.
+    """
+    with h5py.File(path, 'r') as f:
+        return list(f.keys())
+
+def write_permutations(path, trait, max_logp, alpha, threshold):
+    """
+    Save the largest -log10 p-value in each permutation of a trait, and the
+    resulting significance threshold.
+    """
+    with h5py.File(path, 'a') as f:
+        group = f[trait]
+        if 'permutation_max_logp' in group:
+            del group['permutation_max_logp']
+        group.create_dataset('permutation_max_logp', data = np.asarray(max_logp, dtype = np.float32))
+        group.attrs['permutation_alpha'] = alpha
+        group.attrs['permutation_threshold'] = threshold
+
+def export_csv(path, trait, csv_path, block = 1000000):
+    """
+    Write results for one trait to a CSV file, a block of SNPs at a time.
+    """
+    with h5py.File(path, 'r') as f:
+        group = f[trait]
+        n = group['pvalue'].shape[0]
+        for start in range(0, max(n, 1), block):
+            pd.DataFrame(
+                {k: group[k][start:start + block] for k in RESULT_DTYPES.keys()}
+            ).to_csv(csv_path, mode = 'w' if start == 0 else 'a', header = start == 0, index = False)
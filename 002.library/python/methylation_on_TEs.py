@@ -0,0 +1,56 @@
+"""
+Tom Ellis, July 2021, replacing a Perl script by Eriko Sasaki
+
+Count methylated and total reads in CG, CHG and CHH sequence contexts on each
+annotated TE, from an allc file from the methylpy pipeline. This gives the
+same output as `002.library/perl/001.methylation_levels.pl`.
+
+Rather than storing every cytosine in a hash and looking up each base of each
+TE, reads are counted on all TEs at once for each chunk of the allc file using
+`aggregate_regions` from `region_methylation.py`.
+
+Parameters
+----------
+input: str
+    Path to allc file from the methylpy pipeline
+annotation: str
+    Path to a tab-separated file of TEs giving TE name, start and end position
+    in the first three columns, such as
+    `001.data/002.reference_genome/Araport11_transposons_class.201606.txt`.
+    The chromosome is taken from the TE name (e.g. AT1TE52125 is on Chr1).
+output: str
+    Path to the output file.
+chunksize: int
+    Number of rows of the allc file to read at once.
+
+Returns
+-------
+A tab-separated file listing each annotated TE, with columns for the number of
+methylated and total reads in the CG, CHG and CHH contexts:
+`Locus mCG mCHG mCHH cCG cCHG cCHH`. As for the Perl script, the file is plain
+text, whatever the file extension.
+"""
+
+import argparse
+from weighted_mean_mC_from_allc import encode_trinucleotide, CONTEXT_LOOKUP
+from region_methylation import aggregate_regions, read_te_annotation, CONTEXTS, COUNT_COLUMNS
+
+# The Perl script only counts CG sites followed by A, C, G or T.
+TE_CONTEXT_LOOKUP = CONTEXT_LOOKUP.copy()
+TE_CONTEXT_LOOKUP[encode_trinucleotide('CGN')] = len(CONTEXTS)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Count methylated and total reads on each annotated TE')
+    parser.add_argument('-i', '--input', help = 'Path to allc file from the methylpy pipeline', required = True)
+    parser.add_argument('-a', '--annotation', help = 'Path to tab-separated file giving TE name, start and end.', required = True)
+    parser.add_argument('-o', '--output', help = 'Path to the output file.', required = True)
+    parser.add_argument('--chunksize', help = 'Number of rows of the allc file to read at once.', type = int, default = 1000000)
+    args = parser.parse_args()
+
+    tes = read_te_annotation(args.annotation)
+    counts = aggregate_regions(
+        args.input, {'TEs' : tes},
+        genome_wide = False, chunksize = args.chunksize, context_lookup = TE_CONTEXT_LOOKUP
+    )['TEs']
+    counts = counts[['name'] + COUNT_COLUMNS].rename(columns = {'name' : 'Locus'})
+    counts.to_csv(args.output, sep="\t", index=False, compression=None)
@@ -0,0 +1,336 @@
+"""
+Tom Ellis, July 2021
+
+Count methylated and total reads in CG, CHG and CHH sequence contexts over any
+number of sets of regions of the genome (TEs, genes, BED files, windows), plus
+genome-wide sums, from a single pass over an allc file.
+
+Each set of regions is a DataFrame with columns 'name', 'chr', 'start' and
+'end', where regions include cytosines from `start` up to but not including
+`end`, in the 1-based coordinates used in allc files. Functions
+`read_te_annotation`, `read_bed`, `read_gff` and `tile_windows` create these
+from common file formats.
+
+The allc file is read in chunks. Within each chunk, cytosines on each
+chromosome are sorted by position and cumulative sums of reads in each
+context are taken. The number of reads in each region that overlaps the chunk
+is the difference in cumulative sums between the positions where the start
+and end of the region would be inserted, found for all regions at once with
+`np.searchsorted`. Regions may overlap each other and chunk boundaries.
+
+Parameters
+----------
+input: str
+    Path to allc file from the methylpy pipeline.
+output: str
+    Prefix for output files. A tab-separated file '<output>_<name>.tsv' is
+    written for each set of regions, plus '<output>_genome_wide.csv' if
+    requested.
+te: str
+    Optional annotation file of TEs, as used by `methylation_on_TEs.py`.
+gff: str
+    Optional GFF3 file of gene models. Rows whose feature type is 'gene' are
+    used.
+bed: str
+    Optional BED file. Can be given multiple times.
+windows: int
+    Optional window size in base pairs for windows tiling the TAIR10
+    genome. Can be given multiple times.
+genome_wide: flag
+    If set, also write genome-wide weighted means as for
+    `weighted_mean_mC_from_allc.py`.
+chunksize: int
+    Number of rows of the allc file to read at once.
+
+Returns
+-------
+For each set of regions, a table with a row for each region giving its name,
+chromosome, start and end, followed by columns mCG, mCHG, mCHH, cCG, cCHG
+and cCHH giving methylated (m) and total (c) reads in each context.
+
+Example
+-------
+tes   = read_te_annotation('001.data/002.reference_genome/Araport11_transposons_class.201606.txt')
+genes = read_gff('001.data/002.reference_genome/Araport11_GFF3_genes_transposons.201606.gff')
+output = aggregate_regions(
+    'allc_sample.tsv.gz',
+    {'TEs' : tes, 'genes' : genes, 'windows_1kb' : tile_windows(1000)}
+)
+output['TEs'].head()
+output['genome_wide']
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import os
+from weighted_mean_mC_from_allc import read_allc, GenomeWideCounter, format_weighted_means, CONTEXT_LOOKUP
+
+CONTEXTS = ['CG', 'CHG', 'CHH']
+COUNT_COLUMNS = ['m' + k for k in CONTEXTS] + ['c' + k for k in CONTEXTS]
+
+# Lengths of the TAIR10 autosomes.
+TAIR10_LENGTHS = {
+    'Chr1' : 30427671,
+    'Chr2' : 19698289,
+    'Chr3' : 23459830,
+    'Chr4' : 18585056,
+    'Chr5' : 26975502
+}
+
+def read_te_annotation(path):
+    """
+    Import TE names and positions from an annotation file.
+
+    Only TEs whose name contains 'AT1' to 'AT5' are kept, and the chromosome
+    is taken from that number.
+
+    Parameters
+    ----------
+    path: str
+        Tab-separated file giving TE name, start and end position in the
+        first three columns.
+
+    Returns
+    -------
+    DataFrame with columns 'name', 'chr', 'start' and 'end'.
+    """
+    annotation = pd.read_csv(path, sep="\t", header=None, usecols=[0, 1, 2], dtype=str)
+    annotation.columns = ['name', 'start', 'end']
+    chrom = annotation['name'].str.extract('AT([1-5])', expand=False)
+    annotation = annotation.loc[chrom.notna()]
+    return pd.DataFrame({
+        'name'  : annotation['name'].to_numpy(),
+        'chr'   : 'Chr' + chrom.loc[annotation.index].to_numpy(),
+        'start' : annotation['start'].astype(np.int64).to_numpy(),
+        'end'   : annotation['end'].astype(np.int64).to_numpy()
+    })
+
+def read_bed(path):
+    """
+    Import regions from a BED file.
+
+    BED files use 0-based, half-open coordinates, so one is added to the
+    start and end to match allc positions. If there is no name column, regions
+    are named 'chr:start-end' in BED coordinates.
+
+    Parameters
+    ----------
+    path: str
+        Path to a BED file, optionally gzipped.
+
+    Returns
+    -------
+    DataFrame with columns 'name', 'chr', 'start' and 'end'.
+    """
+    bed = pd.read_csv(path, sep="\t", header=None, comment='#', dtype=str)
+    bed = bed.loc[~bed[0].str.startswith(('track', 'browser'))]
+    start = bed[1].astype(np.int64).to_numpy()
+    end   = bed[2].astype(np.int64).to_numpy()
+    if bed.shape[1] > 3:
+        name = bed[3].to_numpy()
+    else:
+        name = bed[0] + ':' + bed[1] + '-' + bed[2]
+    return pd.DataFrame({
+        'name'  : np.asarray(name),
+        'chr'   : bed[0].to_numpy(),
+        'start' : start + 1,
+        'end'   : end + 1
+    })
+
+def read_gff(path, feature='gene'):
+    """
+    Import features of a single type from a GFF3 file, such as Araport11 gene
+    models.
+
+    Parameters
+    ----------
+    path: str
+        Path to a GFF3 file, optionally gzipped.
+    feature: str
+        Value of the third (type) column of rows to keep.
+
+    Returns
+    -------
+    DataFrame with columns 'name' (taken from the ID attribute), 'chr',
+    'start' and 'end'.
+    """
+    gff = pd.read_csv(
+        path, sep="\t", header=None, comment='#', dtype=str,
+        usecols=[0, 2, 3, 4, 8], names=['chr', 'type', 'start', 'end', 'attributes']
+    )
+    gff = gff.loc[gff['type'] == feature]
+    return pd.DataFrame({
+        'name'  : gff['attributes'].str.extract('ID=([^;]+)', expand=False).to_numpy(),
+        'chr'   : gff['chr'].to_numpy(),
+        'start' : gff['start'].astype(np.int64).to_numpy(),
+        # GFF coordinates include the last position.
+        'end'   : gff['end'].astype(np.int64).to_numpy() + 1
+    })
+
+def tile_windows(window_size, chrom_lengths=TAIR10_LENGTHS):
+    """
+    Non-overlapping windows tiling each chromosome.
+
+    Windows are named in the same way as `sliding_window_methylation`, so that
+    the window covering positions 1 to 100 on Chr1 is 'Chr1_0_100'.
+
+    Parameters
+    ----------
+    window_size: int
+        Width of each window in base pairs.
+    chrom_lengths: dict
+        Length of each chromosome. Defaults to the TAIR10 autosomes.
+
+    Returns
+    -------
+    DataFrame with columns 'name', 'chr', 'start' and 'end'.
+    """
+    windows = []
+    for c, length in chrom_lengths.items():
+        start = np.arange(1, length + 1, window_size)
+        end   = np.minimum(start + window_size, length + 1)
+        windows.append(pd.DataFrame({
+            'name'  : [c + '_' + str(s - 1) + '_' + str(e - 1) for s, e in zip(start, end)],
+            'chr'   : c,
+            'start' : start,
+            'end'   : end
+        }))
+    return pd.concat(windows, ignore_index=True)
+
+class RegionCounter:
+    """
+    Running sums of methylated and total reads in each sequence context over
+    a set of regions, updated one chunk at a time.
+
+    Parameters
+    ----------
+    regions: DataFrame
+        Regions with columns 'name', 'chr', 'start' and 'end'.
+    context_lookup: array
+        Table giving the index in `CONTEXTS` of each trinucleotide code, with
+        values of 3 or more for cytosines to ignore.
+    """
+    def __init__(self, regions, context_lookup=CONTEXT_LOOKUP):
+        self.regions = regions.reset_index(drop=True)
+        self.context_lookup = context_lookup
+        self.counts = np.zeros((self.regions.shape[0], len(COUNT_COLUMNS)), dtype=np.int64)
+        # For each chromosome, regions sorted by start position, plus the
+        # running maximum of end positions, so that regions overlapping a
+        # chunk can be found by binary search.
+        self.by_chr = {}
+        for c, ix in self.regions.groupby('chr').indices.items():
+            ix = ix[np.argsort(self.regions['start'].to_numpy()[ix], kind='stable')]
+            end = self.regions['end'].to_numpy()[ix]
+            self.by_chr[c] = {
+                'rows'   : ix,
+                'start'  : self.regions['start'].to_numpy()[ix],
+                'end'    : end,
+                'maxend' : np.maximum.accumulate(end)
+            }
+
+    def add(self, chunk):
+        """
+        Add reads from a chunk returned by `read_allc`.
+        """
+        context = self.context_lookup[chunk['context'].to_numpy()]
+        pos       = chunk['pos'].to_numpy()
+        mC_reads  = chunk['mC_reads'].to_numpy()
+        all_reads = chunk['all_reads'].to_numpy()
+        for c, ix in chunk.groupby('chr', observed=True).indices.items():
+            if c not in self.by_chr.keys():
+                continue
+            ix = ix[context[ix] < len(CONTEXTS)]
+            if len(ix) == 0:
+                continue
+            ix = ix[np.argsort(pos[ix], kind='stable')]
+            r = self.by_chr[c]
+            # Regions that could contain cytosines in this chunk.
+            first = np.searchsorted(r['maxend'], pos[ix[0]], side='right')
+            last  = np.searchsorted(r['start'], pos[ix[-1]], side='right')
+            if first >= last:
+                continue
+            # Cumulative reads in each context, with a row of zeros at the start.
+            rows = np.arange(len(ix))
+            reads = np.zeros((len(ix) + 1, len(COUNT_COLUMNS)), dtype=np.int64)
+            reads[rows + 1, context[ix]] = mC_reads[ix]
+            reads[rows + 1, context[ix] + len(CONTEXTS)] = all_reads[ix]
+            np.cumsum(reads, axis=0, out=reads)
+            lo = np.searchsorted(pos[ix], r['start'][first:last], side='left')
+            hi = np.searchsorted(pos[ix], r['end'][first:last],   side='left')
+            self.counts[r['rows'][first:last]] += reads[hi] - reads[lo]
+
+    def result(self):
+        """
+        DataFrame of regions with columns for methylated and total reads in
+        each context.
+        """
+        output = self.regions[['name', 'chr', 'start', 'end']].copy()
+        for i, k in enumerate(COUNT_COLUMNS):
+            output[k] = self.counts[:, i]
+        return output
+
+def aggregate_regions(path, region_sets, genome_wide=True, chunksize=1000000, context_lookup=CONTEXT_LOOKUP):
+    """
+    Count reads over several sets of regions from a single pass over an allc
+    file.
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped allc file from the methylpy pipeline, or to a
+        cytosine store (see `cytosine_store.py`).
+    region_sets: dict
+        Dictionary of DataFrames of regions, each with columns 'name', 'chr',
+        'start' and 'end'.
+    genome_wide: bool
+        If True, also return genome-wide sums for each chromosome type.
+    chunksize: int
+        Number of rows of the allc file to read at once.
+    context_lookup: array
+        Table giving the index in `CONTEXTS` of each trinucleotide code, with
+        values of 3 or more for cytosines to ignore. Only used for regions.
+
+    Returns
+    -------
+    Dictionary with an entry for each set of regions (see
+    `RegionCounter.result`), plus an entry 'genome_wide' (see
+    `GenomeWideCounter.result`) if `genome_wide` is True.
+    """
+    counters = {k: RegionCounter(v, context_lookup) for k, v in region_sets.items()}
+    if genome_wide:
+        counters['genome_wide'] = GenomeWideCounter()
+    for chunk in read_allc(path, chunksize):
+        for counter in counters.values():
+            counter.add(chunk)
+    return {k: v.result() for k, v in counters.items()}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Count methylated and total reads over sets of regions from a single pass over an allc file')
+    parser.add_argument('-i', '--input', help = 'Path to allc file from the methylpy pipeline', required = True)
+    parser.add_argument('-o', '--output', help = 'Prefix for output files.', required = True)
+    parser.add_argument('--te', help = 'Annotation file of TEs giving TE name, start and end.', required = False)
+    parser.add_argument('--gff', help = 'GFF3 file of gene models.', required = False)
+    parser.add_argument('--bed', help = 'BED file of regions. Can be given more than once.', action = 'append', default = [])
+    parser.add_argument('--windows', help = 'Window size in base pairs. Can be given more than once.', type = int, action = 'append', default = [])
+    parser.add_argument('--genome_wide', help = 'Also write genome-wide weighted means.', action = 'store_true')
+    parser.add_argument('--chunksize', help = 'Number of rows of the allc file to read at once.', type = int, default = 1000000)
+    args = parser.parse_args()
+
+    region_sets = {}
+    if args.te:
+        region_sets['TEs'] = read_te_annotation(args.te)
+    if args.gff:
+        region_sets['genes'] = read_gff(args.gff)
+    for path in args.bed:
+        region_sets[os.path.basename(path).split('.')[0]] = read_bed(path)
+    for w in args.windows:
+        region_sets['windows_' + str(w)] = tile_windows(w)
+
+    output = aggregate_regions(args.input, region_sets, args.genome_wide, args.chunksize)
+    for k, v in output.items():
+        if k == 'genome_wide':
+            with open(args.output + '_genome_wide.csv', 'w') as out:
+                out.writelines(format_weighted_means(os.path.basename(args.input), v))
+        else:
+            v.to_csv(args.output + '_' + k + '.tsv', sep="\t", index=False)
@@ -0,0 +1,268 @@
+"""
+Tom Ellis, August 2021
+
+Link sequencing files to plates, well positions, intended genotypes and
+SNPmatch results.
+
+Each library is named after its barcode key
+`<flowcell>_<lane>#<sample ID>_<adaptor tags>`, for example
+`CDN24ANXX_4#95927_TAGCGCTCACATATCG.bam`, and the sequencing facility supplies
+a JSON file for each lane with a record for each library giving the adaptors
+used. The adaptor numbers give the row and column of the library in the index
+set, and so its position on the plate. The key is parsed out of each filename
+once, and the same key is built from each JSON record, so files and records are
+matched with a join on the key rather than by searching every filename for
+every record. Plates are looked up in a dictionary of codes, which may be
+either a flowcell ID (when a plate filled a flowcell to itself) or a sample ID
+(when several plates were multiplexed on one flowcell).
+
+`001.get_plate_positions.py` in `003.scripts/004.align_phenotypes` uses this to
+write the table of SNPmatch results to check by hand.
+
+Example
+-------
+barcodes = read_barcodes(glob('002.unzipped_bams/1*/*barcodes.json'))
+sheet = sample_sheet(glob('002.unzipped_bams/1*/*bam'), barcodes, index_sets, {'CDN24ANXX' : '144'})
+check_plates(sheet, ['144'])
+"""
+
+import pandas as pd
+import json
+import os
+import warnings
+
+BARCODE_PATTERN = r'([A-Za-z0-9]+_[0-9]+#[0-9]+_[A-Za-z]+)'
+
+def barcode_keys(files):
+    """
+    Barcode key parsed from each filename.
+
+    Parameters
+    ----------
+    files: list
+        Paths to files named after their barcode key.
+
+    Returns
+    -------
+    Series of barcode keys indexed by filename without the directory or
+    extension, with NaN for files whose names contain no barcode key.
+    """
+    names = pd.Series([os.path.basename(x) for x in files], dtype = str)
+    names = names.str.replace(r'\.bam$', '', regex = True)
+    keys = names.str.extract(BARCODE_PATTERN, expand = False)
+    keys.index = names
+    return keys
+
+def barcode_set_number(barcode_set):
+    """
+    Number of the index set from the adaptor type in JSON records, with the
+    Nextera XT set as 0.
+    """
+    return barcode_set.\
+    str.replace("Nordborg Nextera INDEX set", "", regex = False).\
+    str.replace("Nextera XT", '0', regex = False).\
+    astype(int)
+
+def read_barcodes(json_files):
+    """
+    Adaptors used for each library, from the JSON files for each lane.
+
+    Parameters
+    ----------
+    json_files: list
+        Paths to JSON files, each holding a list of records with entries
+        'vendor_id', 'unit_id', 'sample_id', 'adaptor_tag',
+        'adaptor_secondary_tag', 'adaptor_number', 'adaptor_secondary_number'
+        and 'adaptor_type'.
+
+    Returns
+    -------
+    DataFrame indexed by barcode key, with columns 'seqlane_id', 'row_id',
+    'col_id' and 'barcode_set'.
+    """
+    records = []
+    for path in json_files:
+        with open(path, 'r') as f:
+            records += json.load(f)
+    records = pd.DataFrame(records, columns = [
+        'vendor_id', 'unit_id', 'sample_id', 'adaptor_tag', 'adaptor_secondary_tag',
+        'adaptor_number', 'adaptor_secondary_number', 'adaptor_type'
+    ]).astype(str)
+    seqlane_id = records['vendor_id'] + "_" + records['unit_id'] + "#"
+    return pd.DataFrame({
+        'seqlane_id'  : seqlane_id.to_numpy(),
+        'row_id'      : records['adaptor_number'].to_numpy(),
+        'col_id'      : records['adaptor_secondary_number'].to_numpy(),
+        'barcode_set' : records['adaptor_type'].to_numpy()
+    }, index = pd.Index(
+        seqlane_id + records['sample_id'] + '_' + records['adaptor_tag'] + records['adaptor_secondary_tag'],
+        name = 'key'
+    ))
+
+def plate_labels(keys, plate_codes):
+    """
+    Plate of each library, from the flowcell or sample ID in its barcode key.
+
+    Parameters
+    ----------
+    keys: Series
+        Barcode keys from `barcode_keys`.
+    plate_codes: dict
+        Dictionary giving the plate for each flowcell ID or sample ID.
+
+    Returns
+    -------
+    Series of plate labels with the same index as `keys`, with NaN where
+    neither code is in `plate_codes`.
+    """
+    parts = keys.str.extract(r'^([A-Za-z0-9]+)_[0-9]+#([0-9]+)_')
+    plate_codes = pd.Series(plate_codes, dtype = str)
+    # A flowcell code is used unless the sample ID has a code of its own.
+    return parts[1].map(plate_codes).fillna(parts[0].map(plate_codes))
+
+def sample_sheet(files, barcodes, index_sets, plate_codes):
+    """
+    Well position and plate of each sequenced library.
+
+    Parameters
+    ----------
+    files: list
+        Paths to files for each library, named after their barcode key.
+    barcodes: DataFrame
+        Adaptors used for each barcode key, from `read_barcodes`.
+    index_sets: DataFrame
+        Plate row ('ROW') and column ('COL') for each combination of adaptor
+        numbers 'row_id' and 'col_id', all as strings.
+    plate_codes: dict
+        Dictionary giving the plate for each flowcell ID or sample ID.
+
+    Returns
+    -------
+    DataFrame indexed by filename without the extension, with columns
+    'seqlane_id', 'row_id', 'col_id', 'barcode_set', 'ROW', 'COL' and
+    'plate', sorted by lane and row.
+    """
+    keys = barcode_keys(files)
+    # The same record can appear in more than one JSON file; keep one copy.
+    barcodes = barcodes.reset_index().drop_duplicates().set_index('key')
+    conflicting = barcodes.index[barcodes.index.duplicated()].unique()
+    if len(conflicting) > 0:
+        used = conflicting.intersection(keys.to_numpy())
+        if len(used) > 0:
+            raise ValueError("Barcode keys have conflicting JSON records: {}".format(list(used[:5])))
+        warnings.warn("Barcode keys with conflicting JSON records match no file and are ignored: {}".format(
+            list(conflicting[:5])
+        ))
+        barcodes = barcodes.loc[~barcodes.index.isin(conflicting)]
+    sheet = barcodes.reindex(keys.to_numpy())
+    sheet.index = pd.Index(keys.index, name = 'file')
+    missing = sheet['seqlane_id'].isna()
+    if missing.any():
+        raise ValueError("No JSON record matches files {}.".format(list(sheet.index[missing][:5])))
+    sheet['barcode_set'] = barcode_set_number(sheet['barcode_set'])
+    sheet = sheet.\
+    reset_index().\
+    merge(index_sets, how = "left", on = ['row_id', 'col_id']).\
+    set_index('file').\
+    sort_values(['seqlane_id', 'row_id'])
+    sheet['plate'] = plate_labels(keys, plate_codes).reindex(sheet.index).to_numpy()
+    return sheet
+
+def check_plates(sheet, plates, n_wells = 96):
+    """
+    Check that every library has a plate, and each plate a library in every
+    well.
+
+    Parameters
+    ----------
+    sheet: DataFrame
+        Sample sheet from `sample_sheet`.
+    plates: list
+        Plate labels expected in `sheet`.
+    n_wells: int
+        Number of wells on each plate.
+
+    Returns
+    -------
+    Nothing; ValueError is raised if the check fails.
+    """
+    unlabelled = ~sheet['plate'].isin(plates)
+    if unlabelled.any():
+        raise ValueError("Files {} have no plate.".format(list(sheet.index[unlabelled][:5])))
+    counts = sheet['plate'].value_counts().reindex(plates, fill_value = 0)
+    if (counts != n_wells).any():
+        raise ValueError("Plates do not have {} libraries each: {}".format(n_wells, counts[counts != n_wells].to_dict()))
+
+def read_snpmatch(path):
+    """
+    SNPmatch results, indexed by barcode key.
+
+    Parameters
+    ----------
+    path: str
+        CSV file of SNPmatch results with the path of each input file in the
+        first column, as `<prefix>.<prefix>.<barcode key>...`.
+
+    Returns
+    -------
+    DataFrame of SNPmatch results, all as strings.
+    """
+    snp_match = pd.read_csv(path, dtype = str).\
+    rename(columns = {'Unnamed: 0' : 'file'}).\
+    set_index('file')
+    snp_match.index = snp_match.index.str.split(".").str[2]
+    return snp_match
+
+def read_master_list(master_list, plates):
+    """
+    Intended genotype and field position of the sample in each well.
+
+    Parameters
+    ----------
+    master_list: str
+        CSV file of the field experiment with columns 'label', 'lines',
+        'Site' and 'position'.
+    plates: str
+        CSV file giving the plate, row and column of each label ('id').
+
+    Returns
+    -------
+    DataFrame with a row for each well, all as strings.
+    """
+    return pd.read_csv(master_list, dtype = str).\
+    filter(items = ['label', 'lines', 'Site', 'position']).\
+    merge(
+        pd.read_csv(plates),
+        left_on = 'label', right_on = 'id', how = 'right'
+    ).astype(str)
+
+def match_genotypes(sheet, snp_match, master_list):
+    """
+    Line up the intended genotype of each sample with results from SNPmatch.
+
+    Parameters
+    ----------
+    sheet: DataFrame
+        Sample sheet from `sample_sheet`.
+    snp_match: DataFrame
+        SNPmatch results from `read_snpmatch`.
+    master_list: DataFrame
+        Wells and genotypes from `read_master_list`.
+
+    Returns
+    -------
+    DataFrame with a row for each file in `snp_match`, and a column 'match'
+    which is True if the intended genotype is among the top three SNPmatch
+    hits.
+    """
+    return sheet.\
+    merge(snp_match, how = "right", left_index = True, right_index = True).\
+    filter(items = ['row_id', 'seqlane_id', 'plate', 'ROW', 'COL', 'TopHitAccession', 'NextHit', 'ThirdHit', 'Score']).\
+    rename_axis('file').reset_index().\
+    merge(
+        master_list,
+        how = 'left',
+        left_on = ['plate', 'ROW', 'COL'], right_on = ['plate', 'row', 'col']
+    ).\
+    sort_values(['plate', 'seqlane_id', 'COL', 'ROW']).\
+    assign(match = lambda x: (x.lines == x.TopHitAccession) | (x.lines == x.NextHit) | (x.lines == x.ThirdHit))
@@ -4,128 +4,283 @@
 Script to run marginal GWAS
 
 Pieter Clauw
+
+Several phenotypes can be mapped in one run, either by passing more than one
+phenotype file or a file with one column per trait. Genotypes and the kinship
+matrix are then read once for all traits, and traits measured on the same set
+of accessions share a single eigendecomposition of the kinship matrix, so each
+extra trait only costs the scan itself. Decompositions are cached next to the
+genotype directory (see `genotype_store.py`), so later runs on the same
+accessions skip the decomposition too.
+
+SNPs are read from the HDF5 file in blocks, filtered for minor allele
+frequency and scanned one block at a time, and results for each block are
+appended to the output file, so memory depends on the block size rather than
+the number of SNPs. Results for every trait are written to a single HDF5 file
+`gwas_results_{maf}.h5` (see `gwas_results.py`); use --csv to also write a CSV
+file for each trait. Manhattan and QQ plots are drawn with `gwas_plots.py`;
+use --no_plots to skip them, and run `gwas_plots.py` on the results later.
+
+With --permutations N, each trait is also scanned with N permutations of its
+phenotype, and the genome-wide threshold from these (see `gwas_permutations.py`)
+is saved in the results file and drawn on the Manhattan plot in place of the
+Bonferroni threshold.
 '''
 
-from limix.qtl import scan
 import pandas as pd
 import numpy as np
-import h5py
-from bisect import bisect
-from limix import plot
-import random
-from sklearn.decomposition import PCA
+from limix.stats import lrt_pvalues
 import argparse
 import os
-from statsmodels.stats import multitest
-import math
-
-# Parameters
-parser = argparse.ArgumentParser(description = 'Parse parameters for multilocus GWAS')
-parser.add_argument('-p', '--phenotype',help = 'Path to phenotype file. CSV file with accession ID in forst column, phenptype values in second column. Filename is used as phenotype name.', required = True)
-parser.add_argument('-g', '--genotype', help = 'Path to genotype directory.This directory should contain boht the SNP and kinship matrix. Versions are the same as used for PyGWAS.', required = True)
-parser.add_argument('-m', '--maf', help = 'Specify the minor allele frequecny cut-off. Default is set to 0.05', default = 0.05)
-parser.add_argument('-o', '--outDir', help = 'Specify the output directory. All results will be saved in this directory.', required = True)
-parser.add_argument('-c', '--covariates', help = 'Path to matrix of covariates', required=False, type=str)
-parser.add_argument('-l', '--link', help = 'Link function for the GLM', required=False, default="normal", type=str)
-args = parser.parse_args()
-
-# Phenotype (Y)
-pheno = pd.read_csv(args.phenotype, index_col = 0)
-trait = os.path.basename(args.phenotype)[:-4] 
-# remove NA values
-pheno = pheno[np.isfinite(pheno[pheno.keys()[0]])]
-# enocde pheno.index to UTF8, for complemetarity with SNP matrix accessions
-pheno.index = pheno.index.map(lambda x: str(x).encode('UTF8'))
-acnNrInitial = len(pheno.index)
-
-# Genotype (G)
-genoFile = f'{args.genotype}/all_chromosomes_binary.hdf5'
-geno_hdf = h5py.File(genoFile, 'r')
-
-acn_indices = [np.where(geno_hdf['accessions'][:] == acn)[0][0] for acn in pheno.index]
-acn_indices.sort()
-acn_order = geno_hdf['accessions'][acn_indices]
-G = geno_hdf['snps'][:, acn_indices]
-# subset pheno in case of non-genotyped accessions
-if len(acn_indices) != len(pheno.index):
-    acns = list(set(pheno.index) & set(geno_hdf['accessions'][:]))
-    pheno = pheno[acns]
-# select only SNPs with minor allele frequecny above threshold
-AC1 = G.sum(axis = 1)
-AC0 = G.shape[1] - AC1
-AC = np.vstack((AC0, AC1))
-MAC = np.min(AC, axis = 0)
-MAF = MAC/G.shape[1]
-SNP_indices =  np.where(MAF >= float(args.maf))[0]
-SNPs_MAF = MAF[SNP_indices]
-G = G[SNP_indices, :]
-print(f'Of the {acnNrInitial} phenotyped accessions, {len(acn_indices)} accessions were present in the SNP matrix.')
-print(f'{len(SNP_indices)} SNPs had a minor allele frequency higher than {args.maf}')
-# transpose G matrix into the required acccessions x SNPs format
-G = G.transpose()
-
-# Kinship (K)
-kinFile = f'{args.genotype}/kinship_ibs_binary_mac5.h5py'
-kin_hdf = h5py.File(kinFile, 'r')
-# select kinship only for phenotyped and genotyped accessions
-acn_indices = [np.where(kin_hdf['accessions'][:] == acn)[0][0] for acn in pheno.index]
-acn_indices.sort()
-K = kin_hdf['kinship'][acn_indices, :][:, acn_indices]
-kin_hdf.close()
-
-# get phenotype in correct order
-pheno = pheno.loc[acn_order]
-Y = pheno.to_numpy()
-
-# Covariates (M)
-if args.covariates:
-  covars = pd.read_csv(args.covariates, index_col = 0)
-  # TODO: test if limix can handle NAs. if so, make this optional
-  # remove NA values
-  covars = covars.dropna(axis = 0, how = 'any')
-  # enocde covars.index to UTF8, for complemetarity with SNP matrix accessions
-  covars.index = covars.index.map(lambda x: str(x).encode('UTF8'))
-else:
-  covars=None
-  
-# scan
-r = scan(G, Y, K = K, lik = args.link, M = covars, verbose = True)
-
-# save results
-# Make sure the output directory exists
-os.makedirs(args.outDir, exist_ok=True)
-# link chromosome and positions to p-values and effect sizes
-geno_hdf = h5py.File(genoFile, 'r')
-chrIdx = geno_hdf['positions'].attrs['chr_regions']
-chrom = [bisect(chrIdx[:, 1], snpIdx) + 1 for snpIdx in SNP_indices]
-positions = geno_hdf['positions'][:]
-pos = [positions[snp] for snp in SNP_indices]
-pvalues = r.stats.pv20.tolist()
-effsizes = r.effsizes['h2']['effsize'][r.effsizes['h2']['effect_type'] == 'candidate'].to_list() 
-Bonferroni = multitest.multipletests(pvalues, alpha = 0.05, method = 'fdr_bh')[3]
-
-gwas_tuples = list(zip(chrom, pos, pvalues))
-gwas_results = pd.DataFrame(gwas_tuples, columns = ['chrom', 'pos', 'pv'])
-
-# plot results
-# Manhattan plot
-plot.manhattan(gwas_results)
-plt = plot.get_pyplot() 
-_ = plt.axhline(-math.log(Bonferroni, 10), color='red')  
-plt.savefig(f'{args.outDir}/manhattanPlot_{trait}_{args.maf}.png')
-plt.close()
-
-# QQ-plot
-plot.qqplot(gwas_results.pv)
-plt = plot.get_pyplot()
-plt.savefig(f'{args.outDir}/qqPlot_{trait}_{args.maf}.png')
-plt.close()
-
-# Save results
-gwas_results['maf'] = SNPs_MAF
-gwas_results['mac'] = gwas_results.maf * len(acn_indices) 
-gwas_results.mac = gwas_results.mac.astype(int)   
-gwas_results['GVE'] = effsizes 
-gwas_results.columns.values[0] = 'chr' 
-gwas_results.columns.values[2] = 'pvalue'
-gwas_results.to_csv(f'{args.outDir}/{trait}_{args.maf}.csv', index = False)
+from genotype_store import GenotypeStore, maf_filter
+from gwas_results import ResultsWriter, export_csv, snp_chromosomes, write_permutations
+from gwas_permutations import permutation_models, permutation_test, permutation_threshold
+from gwas_plots import plot_trait
+
+# Traits measured on fewer accessions than this are not mapped.
+MIN_ACCESSIONS = 10
+
+def read_phenotypes(paths):
+    """
+    Import one or more phenotype files as a single matrix of traits.
+
+    Each file is a CSV file with accession IDs in the first column and
+    phenotype values in the remaining columns. If a file has a single
+    phenotype column, the file name is used as the trait name (as for a
+    single-trait run); otherwise the column names are used.
+
+    Parameters
+    ----------
+    paths: list
+        Paths to phenotype files.
+
+    Returns
+    -------
+    DataFrame with a column for each trait, indexed by accession ID encoded
+    to UTF8 for complementarity with the SNP matrix. Accessions missing from
+    a file are NaN.
+    """
+    traits = []
+    for path in paths:
+        pheno = pd.read_csv(path, index_col = 0)
+        if pheno.shape[1] == 1:
+            pheno.columns = [os.path.basename(path)[:-4]]
+        traits.append(pheno)
+    pheno = pd.concat(traits, axis = 1)
+    if pheno.columns.duplicated().any():
+        raise ValueError(f'Trait names are not unique: {list(pheno.columns[pheno.columns.duplicated()])}')
+    pheno.index = pheno.index.map(lambda x: str(x).encode('UTF8'))
+    return pheno
+
+def read_covariates(path):
+    """
+    Import a matrix of covariates, with accession IDs in the first column.
+
+    Accessions with any missing covariate are removed, and the index is
+    encoded to UTF8 for complementarity with the SNP matrix.
+    """
+    # TODO: test if limix can handle NAs. if so, make this optional
+    covars = pd.read_csv(path, index_col = 0)
+    covars = covars.dropna(axis = 0, how = 'any')
+    covars.index = covars.index.map(lambda x: str(x).encode('UTF8'))
+    return covars
+
+def accession_groups(pheno, min_accessions = MIN_ACCESSIONS):
+    """
+    Group traits by the accessions that have a phenotype value.
+
+    Traits with a value for fewer than `min_accessions` accessions (including
+    traits with no values at all) are skipped with a warning.
+
+    Parameters
+    ----------
+    pheno: DataFrame
+        Trait matrix with a row for each accession that is present in the SNP
+        matrix (and in any other input, such as the kinship matrix and
+        covariates), as from `GenotypeStore.phenotypes`.
+    min_accessions: int
+        Smallest number of accessions on which a trait can be mapped.
+
+    Returns
+    -------
+    List of tuples giving (1) indices of rows of `pheno` with a phenotype
+    value, in ascending order and (2) the list of traits measured on exactly
+    those accessions.
+    """
+    groups = {}
+    for trait in pheno.columns:
+        ix = np.where(np.isfinite(pheno[trait].to_numpy(dtype = float)))[0]
+        if len(ix) < min_accessions:
+            print(f'Warning: {trait} has values for {len(ix)} accessions in the SNP matrix, fewer than {min_accessions}; skipping this trait.')
+            continue
+        groups.setdefault(ix.tobytes(), (ix, []))[1].append(trait)
+    return list(groups.values())
+
+def null_model(y, M, QS, lik = 'normal'):
+    """
+    Fit the null model for one trait using a precomputed eigendecomposition
+    of the kinship matrix.
+
+    This does the same as `limix.qtl.scan` does for a single trait before
+    testing SNPs, but takes the output of `numpy_sugar.linalg.economic_qs`
+    instead of the kinship matrix, so that the decomposition can be shared
+    between traits.
+
+    Parameters
+    ----------
+    y: array
+        Phenotype values for each accession.
+    M: array
+        Matrix of covariates for each accession, including an intercept.
+    QS: tuple
+        Eigendecomposition of the kinship matrix from `economic_qs`.
+    lik: str
+        Likelihood for the residuals: 'normal', or a likelihood accepted by
+        `glimix_core.glmm.GLMMExpFam` such as 'bernoulli' or 'poisson'.
+
+    Returns
+    -------
+    A glimix-core FastScanner, to pass to `scan_snps`.
+    """
+    if lik == 'normal':
+        from glimix_core.lmm import LMM
+        model = LMM(y, M, QS, restricted = False)
+        model.fit(verbose = False)
+    else:
+        from glimix_core.glmm import GLMMExpFam, GLMMNormal
+        glmm = GLMMExpFam(y, lik, M, QS)
+        glmm.fit(verbose = False)
+        model = GLMMNormal(glmm.site.eta, glmm.site.tau, M, QS)
+        model.fit(verbose = False)
+    return model.get_fast_scanner()
+
+def scan_snps(scanner, G):
+    """
+    Test each SNP in a block against the null model from `null_model`.
+
+    Parameters
+    ----------
+    scanner: FastScanner
+        Null model for a trait, from `null_model`.
+    G: array
+        Matrix of accessions x SNPs.
+
+    Returns
+    -------
+    Tuple of p-values and effect sizes for each SNP.
+    """
+    r = scanner.fast_scan(G, verbose = False)
+    pvalues = lrt_pvalues(scanner.null_lml(), r['lml'])
+    return pvalues, r['effsizes1'].ravel()
+
+def results_file(outDir, maf):
+    """
+    Path to the HDF5 file of results for all traits in a run.
+    """
+    return f'{outDir}/gwas_results_{maf}.h5'
+
+if __name__ == '__main__':
+    # Parameters
+    parser = argparse.ArgumentParser(description = 'Parse parameters for multilocus GWAS')
+    parser.add_argument('-p', '--phenotype',help = 'Path to one or more phenotype files. CSV files with accession ID in first column, phenotype values in the other columns. If a file has a single phenotype column, the filename is used as phenotype name; otherwise column names are used.', required = True, nargs = '+')
+    parser.add_argument('-g', '--genotype', help = 'Path to genotype directory.This directory should contain boht the SNP and kinship matrix. Versions are the same as used for PyGWAS.', required = True)
+    parser.add_argument('-m', '--maf', help = 'Specify the minor allele frequecny cut-off. Default is set to 0.05', default = 0.05)
+    parser.add_argument('-o', '--outDir', help = 'Specify the output directory. All results will be saved in this directory.', required = True)
+    parser.add_argument('-c', '--covariates', help = 'Path to matrix of covariates', required=False, type=str)
+    parser.add_argument('-l', '--link', help = 'Link function for the GLM', required=False, default="normal", type=str)
+    parser.add_argument('--cache', help = 'Folder in which to cache kinship matrices and their eigendecompositions for sets of accessions. Defaults to the genotype directory with .cache appended.', required=False, type=str)
+    parser.add_argument('-b', '--block_size', help = 'Number of SNPs to read and scan at once. Memory use is roughly proportional to this. Default is 50000.', required=False, default=50000, type=int)
+    parser.add_argument('--permutations', help = 'Number of phenotype permutations used to find a genome-wide significance threshold for each trait. Only for the normal likelihood. Default is 0 (no permutations).', required=False, default=0, type=int)
+    parser.add_argument('--alpha', help = 'Genome-wide false-positive rate for the permutation threshold. Default is 0.05.', required=False, default=0.05, type=float)
+    parser.add_argument('--seed', help = 'Seed for the random number generator used to permute phenotypes.', required=False, type=int)
+    parser.add_argument('-w', '--workers', help = 'Number of worker processes for permutations. Default is 1.', required=False, default=1, type=int)
+    parser.add_argument('--csv', help = 'Also write results for each trait to a CSV file {trait}_{maf}.csv, as well as the HDF5 file of results.', action = 'store_true')
+    parser.add_argument('--min_accessions', help = f'Skip traits with values for fewer than this many accessions. Default is {MIN_ACCESSIONS}.', required=False, default=MIN_ACCESSIONS, type=int)
+    parser.add_argument('--no_plots', help = 'Do not draw Manhattan and QQ plots. These can be drawn later with gwas_plots.py.', action = 'store_true')
+    args = parser.parse_args()
+
+    # Phenotypes (Y)
+    pheno = read_phenotypes(args.phenotype)
+    # Covariates (M)
+    covars = read_covariates(args.covariates) if args.covariates else None
+
+    # Accessions in the SNP matrix, and in the kinship matrix and covariates,
+    # with a value for at least one trait, in the order of the SNP matrix
+    store = GenotypeStore(args.genotype, cache_dir = args.cache)
+    phenotyped = pheno.index[pheno.notna().any(axis = 1)]
+    if covars is not None:
+        phenotyped = phenotyped.intersection(covars.index)
+    acn_indices = store.align(phenotyped)
+    print(f'Of the {pheno.shape[0]} phenotyped accessions, {len(acn_indices)} accessions were present in the SNP matrix.')
+    # Phenotypes and covariates in the order of the SNP matrix
+    pheno = store.phenotypes(pheno, acn_indices)
+    if covars is not None:
+        covars = store.phenotypes(covars, acn_indices)
+
+    # Fit the null model for each trait, using one (cached) decomposition of
+    # the kinship matrix (K) for all traits on the same accessions.
+    if args.permutations > 0 and args.link != 'normal':
+        raise ValueError('Permutations are only implemented for the normal likelihood.')
+    rng = np.random.default_rng(args.seed)
+    groups = []
+    permutation_groups = []
+    trait_groups = accession_groups(pheno, args.min_accessions)
+    if len(trait_groups) == 0:
+        raise ValueError(f'No trait has values for at least {args.min_accessions} accessions.')
+    for ix, traits in trait_groups:
+        QS = store.economic_qs(acn_indices[ix])
+        if covars is not None:
+            M = covars.iloc[ix].to_numpy(dtype = float)
+        else:
+            M = np.ones((len(ix), 1))
+        scanners = {}
+        nulls = {}
+        for trait in traits:
+            Y = pheno[trait].iloc[ix].to_numpy(dtype = float)
+            scanners[trait] = null_model(Y, M, QS, lik = args.link)
+            if args.permutations > 0:
+                nulls[trait] = permutation_models(Y, M, QS, args.permutations, rng)
+        groups.append((ix, scanners))
+        permutation_groups.append((ix, QS, nulls))
+        print(f'{len(traits)} traits were measured on {len(ix)} accessions.')
+
+    # Make sure the output directory exists
+    os.makedirs(args.outDir, exist_ok=True)
+    writer = ResultsWriter(results_file(args.outDir, args.maf), {trait : len(ix) for ix, scanners in groups for trait in scanners.keys()}, args.maf)
+
+    # Scan SNPs in blocks
+    n_SNPs = np.zeros(len(groups), dtype = int)
+    for start, G_block, positions in store.iter_snp_blocks(acn_indices, args.block_size):
+        for i, (ix, scanners) in enumerate(groups):
+            # select only SNPs with minor allele frequecny above threshold
+            G = G_block[:, ix]
+            SNP_indices, SNPs_MAF = maf_filter(G, args.maf)
+            n_SNPs[i] += len(SNP_indices)
+            # transpose G matrix into the required acccessions x SNPs format
+            G = G[SNP_indices, :].transpose().astype(float)
+            # link chromosome and positions to p-values and effect sizes
+            chrom = snp_chromosomes(store.chr_regions, start + SNP_indices)
+            pos = positions[SNP_indices]
+            for trait, scanner in scanners.items():
+                pvalues, effsizes = scan_snps(scanner, G)
+                writer.append(trait, chrom, pos, pvalues, effsizes, SNPs_MAF)
+    writer.close()
+
+    # Genome-wide thresholds from permutations
+    if args.permutations > 0:
+        max_logp = permutation_test(store, acn_indices, permutation_groups, args.maf, args.block_size, args.workers)
+        thresholds = []
+        for trait, logp in max_logp.items():
+            threshold = permutation_threshold(logp, args.alpha)
+            write_permutations(results_file(args.outDir, args.maf), trait, logp, args.alpha, threshold)
+            thresholds.append({'trait' : trait, 'permutations' : args.permutations, 'alpha' : args.alpha, 'threshold' : threshold, 'threshold_logp' : -np.log10(threshold)})
+        pd.DataFrame(thresholds).to_csv(f'{args.outDir}/permutation_thresholds_{args.maf}.csv', index = False)
+
+    for (ix, scanners), n in zip(groups, n_SNPs):
+        print(f'{n} SNPs had a minor allele frequency higher than {args.maf} in the {len(ix)} accessions measured for {len(scanners)} traits')
+        for trait in scanners.keys():
+            # plot results
+            if not args.no_plots:
+                plot_trait(results_file(args.outDir, args.maf), trait, args.outDir)
+            if args.csv:
+                export_csv(results_file(args.outDir, args.maf), trait, f'{args.outDir}/{trait}_{args.maf}.csv')
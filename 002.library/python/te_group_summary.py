@@ -0,0 +1,205 @@
+"""
+Tom Ellis, August 2021, following R code by Eriko Sasaki
+
+Summarise methylation over groups of TEs for every sample in a cohort file
+from `cohort_matrix.py`. This does the same job as
+`003.scripts/003.methylation_levels/003.RdDM_CMT2_TEs.R`, but for any number
+of groups: named lists of TEs (such as CMT2- and RdDM-targeted TEs) and/or
+every family or superfamily in the TE annotation.
+
+For each group, sample and sequence context this gives:
+1. The mean over TEs of the proportion of methylated reads on each TE, rounded
+    to three decimal places, ignoring TEs with no reads (as in the R script).
+2. The weighted mean: methylated reads summed over TEs divided by total reads
+    summed over TEs.
+Group membership is stored as a sparse matrix of groups by TEs, so all groups
+are summarised with one sparse matrix product per block of samples, rather
+than a loop over groups.
+
+Parameters
+----------
+input: str
+    Cohort HDF5 file from `cohort_matrix.py`.
+output: str
+    Path to the output CSV file.
+group: str
+    A named list of TEs, given as NAME=PATH, where PATH is a file with one TE
+    name per line in the first column. Can be given more than once.
+annotation: str
+    Optional TE annotation file (tab-separated, TE name in the first column).
+    If given with `label_column`, every distinct label in that column becomes
+    a group.
+label_column: int
+    Column of `annotation` (counting from zero) giving the family or
+    superfamily of each TE.
+
+Returns
+-------
+CSV file with a row for each group and sample, giving the file name, group
+name (`TE_type`), mean proportions for CG, CHG and CHH, and weighted means in
+columns CG_weighted, CHG_weighted and CHH_weighted. A group 'all' with every
+TE always comes first.
+
+Example
+-------
+groups = {
+    'CMT2' : read_te_list('001.data/002.reference_genome/CMT2_target_TEs.txt'),
+    'RdDM' : read_te_list('001.data/002.reference_genome/RdDM_target_TEs.txt')
+}
+summarise_te_groups('reads_on_each_TE.h5', groups)
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import h5py
+from scipy import sparse
+from cohort_matrix import read_cohort, SAMPLE_BLOCK
+from region_methylation import CONTEXTS
+
+def read_te_list(path):
+    """
+    Import a list of TE names from the first column of a file with no header.
+    """
+    return pd.read_csv(path, header=None, usecols=[0], dtype=str)[0].str.strip().to_list()
+
+def groups_from_annotation(path, label_column):
+    """
+    Group TEs by the values in one column of a TE annotation file.
+
+    Parameters
+    ----------
+    path: str
+        Tab-separated TE annotation with TE names in the first column.
+    label_column: int
+        Column giving the label (e.g. superfamily) of each TE, counting from
+        zero.
+
+    Returns
+    -------
+    Dictionary giving a list of TE names for each label.
+    """
+    annotation = pd.read_csv(path, sep="\t", header=None, usecols=[0, label_column], dtype=str)
+    annotation = annotation.loc[annotation[0].str.contains('AT[1-5]')]
+    return {k: v.to_list() for k, v in annotation.groupby(label_column)[0]}
+
+def membership_matrix(groups, regions):
+    """
+    Sparse matrix with a row for each group and a column for each region,
+    with ones where the region belongs to the group.
+
+    Names in a group that are not in `regions` are ignored.
+
+    Parameters
+    ----------
+    groups: dict
+        Dictionary giving a list of region names for each group.
+    regions: list
+        Names of the regions, in the order of the cohort file.
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix of shape (groups, regions).
+    """
+    regions = pd.Index(regions)
+    rows = []
+    cols = []
+    for i, names in enumerate(groups.values()):
+        ix = regions.get_indexer(names)
+        ix = ix[ix >= 0]
+        rows.append(np.full(len(ix), i))
+        cols.append(ix)
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    return sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape=(len(groups), len(regions))
+    )
+
+def summarise_te_groups(path, groups, block=SAMPLE_BLOCK):
+    """
+    Mean and weighted-mean methylation over groups of TEs for every sample.
+
+    Parameters
+    ----------
+    path: str
+        Cohort HDF5 file from `cohort_matrix.py`.
+    groups: dict
+        Dictionary giving a list of TE names for each group. A group 'all'
+        with every TE is added at the start, so no group may be called 'all'.
+    block: int
+        Number of samples to read at once.
+
+    Returns
+    -------
+    DataFrame with a row for each group and sample; see the module
+    docstring.
+    """
+    with h5py.File(path, 'r') as f:
+        regions = list(f['regions'][:].astype(str))
+        samples = list(f['samples'].asstr()[:])
+    if 'all' in groups:
+        raise ValueError("'all' is reserved for the group of every TE; give the group another name.")
+    groups = {'all' : regions, **groups}
+    M = membership_matrix(groups, regions)
+    n = len(CONTEXTS)
+
+    output = []
+    for i in range(0, len(samples), block):
+        counts, _, these_samples = read_cohort(path, samples=samples[i:i + block])
+        counts = counts.astype(np.float64)
+        mC    = counts[:, :, :n].reshape(len(regions), -1)
+        total = counts[:, :, n:].reshape(len(regions), -1)
+        # Proportion of methylated reads on each TE, NaN where there are no reads.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratio = np.round(mC / total, 3)
+        has_reads = np.isfinite(ratio)
+        ratio[~has_reads] = 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_ratio = (M @ ratio) / (M @ has_reads.astype(np.float64))
+            weighted   = (M @ mC) / (M @ total)
+        # Reshape to groups x samples x contexts.
+        mean_ratio = mean_ratio.reshape(len(groups), len(these_samples), n)
+        weighted   = weighted.reshape(len(groups), len(these_samples), n)
+
+        for g, name in enumerate(groups.keys()):
+            this_group = pd.DataFrame({'file' : these_samples, 'TE_type' : name})
+            for k, context in enumerate(CONTEXTS):
+                this_group[context] = mean_ratio[g, :, k]
+            for k, context in enumerate(CONTEXTS):
+                this_group[context + '_weighted'] = weighted[g, :, k]
+            output.append(this_group)
+
+    output = pd.concat(output, ignore_index=True)
+    # Order rows by group, then sample, as in the R script.
+    output['TE_type'] = pd.Categorical(output['TE_type'], categories=list(groups.keys()))
+    output = output.sort_values(['TE_type', 'file'], kind='stable').reset_index(drop=True)
+    output['TE_type'] = output['TE_type'].astype(str)
+    return output
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Summarise methylation over groups of TEs for every sample')
+    parser.add_argument('-i', '--input', help = 'Cohort HDF5 file from cohort_matrix.py.', required = True)
+    parser.add_argument('-o', '--output', help = 'Path to the output CSV file.', required = True)
+    parser.add_argument('-g', '--group', help = 'Named list of TEs as NAME=PATH. Can be given more than once.', action = 'append', default = [])
+    parser.add_argument('-a', '--annotation', help = 'TE annotation file, to group TEs by family or superfamily.', required = False)
+    parser.add_argument('--label_column', help = 'Column of the annotation giving the label to group by, counting from zero.', type = int, required = False)
+    args = parser.parse_args()
+
+    groups = {}
+    for g in args.group:
+        name, path = g.split('=', 1)
+        if name in groups:
+            raise ValueError("Group {} is given more than once.".format(name))
+        groups[name] = read_te_list(path)
+    if args.annotation:
+        if args.label_column is None:
+            raise ValueError("--label_column is needed to group TEs in the annotation.")
+        labelled = groups_from_annotation(args.annotation, args.label_column)
+        duplicated = set(groups).intersection(labelled)
+        if len(duplicated) > 0:
+            raise ValueError("Groups {} are given with --group and as labels in the annotation.".format(sorted(duplicated)))
+        groups.update(labelled)
+
+    summarise_te_groups(args.input, groups).to_csv(args.output, index=False)
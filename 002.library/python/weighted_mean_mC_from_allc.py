@@ -1,12 +1,14 @@
 """
 Tom Ellis, June 2021
 
-Get the weighted mean methylation (i.e. the sum of methylated reads divided by the 
+Get the weighted mean methylation (i.e. the sum of methylated reads divided by the
 sum of all reads) over cytosines within an allc file from the methylpy pipeline
 (https://github.com/yupenghe/methylpy).
 
 Since allc files are very large, they are read into memory chunks by pandas.read_csv,
-and number of reads summed over chunks.
+and number of reads summed over chunks. Only one chunk is held in memory at a
+time, so peak memory depends on `chunksize` and not on the size of the genome or
+coverage.
 
 Parameters
 ----------
@@ -20,80 +22,622 @@ chunks_to_test: None or int
     Optional parameter to allow testing on a small number of chunks. If an integer
     less than the number of chunks is given, the function will  be run on these
     chunks only.
+qc: str
+    Optional path to a file to which quality-control metrics should be
+    appended, calculated in the same pass over the allc file (see `QCCounter`).
+levels: str
+    Optional path to a file to which estimators based on the methylation level
+    of each cytosine should be appended, calculated in the same pass over the
+    allc file (see `SiteLevelCounter`).
+min_coverage: int
+    Cytosines with fewer reads than this are ignored by these estimators.
+non_conversion: float
+    Optional non-conversion rate for the binomial test of each cytosine.
+    Defaults to the rate estimated from the chloroplast in the same file.
+alpha: float
+    Significance level for the binomial test.
 
 Returns
 -------
 `output` is appended with the name of the input file, followed by weighted-
-mean methylation levels for the CG, CHG and CHH sequence contexts.
+mean methylation levels for the CG, CHG and CHH sequence contexts. If `output`,
+`qc` or `levels` already has rows for the input file nothing more is written
+to that file, to avoid duplicate rows.
 """
 
 import pandas as pd
 import numpy as np
 import argparse
 import os
+import sys
+from scipy.stats import binom
 
-# Script input parameters
-parser = argparse.ArgumentParser(description = 'Parse parameters for multilocus GWAS')
-parser.add_argument('-i', '--input', help = 'Path to allc file from the methylpy pipeline', required = True)
-parser.add_argument('-o', '--output', help = 'Path to the file to which results should be appended.', required = True)
-args = parser.parse_args()
-
-# Import and allc file for cytosines in all contexts.
-allc = pd.read_csv(
-    args.input,
-    compression='gzip',
-    sep="\t",
-    names = ["chr", "pos", "strand", "seq", "mC_reads", "all_reads", "signif"]
+# Chromosome groups to summarise, and the rows of the summary for each.
+CHR_TYPES = {
+    'autosomes'  : ['Chr1', 'Chr2', 'Chr3', 'Chr4', 'Chr5'],
+    'organelles' : ['ChrC', 'ChrM']
+}
+SUMMARY_ROWS = ['CG', 'CHG', 'CHH', 'coverage']
+
+# Quality control: the chloroplast is unmethylated, so methylated reads there
+# estimate the bisulphite non-conversion rate. Coverage is tabulated up to
+# QC_MAX_DEPTH reads, with deeper cytosines counted in the last bin.
+CONVERSION_CONTROL = 'ChrC'
+CONTEXT_NAMES = ['CG', 'CHG', 'CHH', 'other']
+QC_THRESHOLDS = (1, 5, 10)
+QC_MAX_DEPTH = 50
+QC_HEADER = "file,metric,group,value\n"
+
+# Estimators based on the methylation level of each cytosine.
+MIN_COVERAGE = 5
+METHYLATION_ALPHA = 0.05
+LEVELS_HEADER = "file,chr_type,estimator,CG,CHG,CHH\n"
+# Read counts are packed into a single integer key with this many values each.
+COUNT_LIMIT = 2 ** 24
+
+# Trinucleotides are packed into a single integer from 0 to 124, with each
+# position coded as A, C, G, T or anything else (usually N).
+NUCLEOTIDES = 'ACGT'
+UNKNOWN_TRINUCLEOTIDE = 124
+
+def encode_trinucleotide(seq):
+    """
+    Pack a single trinucleotide string into an integer between 0 and 124.
+
+    Strings that are not three characters long are given the code for 'NNN'.
+    """
+    if not isinstance(seq, str) or len(seq) != 3:
+        return UNKNOWN_TRINUCLEOTIDE
+    code = 0
+    for base in seq:
+        code = code * 5 + (NUCLEOTIDES.index(base) if base in NUCLEOTIDES else 4)
+    return code
+
+def decode_trinucleotide(code):
+    """
+    Convert an integer from `encode_trinucleotide` back to a string.
+    """
+    alphabet = NUCLEOTIDES + 'N'
+    return alphabet[code // 25] + alphabet[(code // 5) % 5] + alphabet[code % 5]
+
+def encode_trinucleotides(seq):
+    """
+    Pack a vector of trinucleotide strings into integer codes.
+
+    Each distinct string is only decoded once, so this is much faster than
+    matching patterns against every element of `seq`.
+
+    Parameters
+    ----------
+    seq: pandas.Series
+        Trinucleotide strings, such as the 'seq' column of an allc file.
+        Categorical series are used as they are.
+
+    Returns
+    -------
+    Array of uint8 codes between 0 and 124.
+    """
+    seq = seq.astype('category')
+    # The last entry of the lookup table catches missing values, which have code -1.
+    lookup = np.array(
+        [encode_trinucleotide(x) for x in seq.cat.categories] + [UNKNOWN_TRINUCLEOTIDE],
+        dtype=np.uint8
     )
+    return lookup[seq.cat.codes.to_numpy()]
+
+def _context_lookup():
+    """
+    Table giving the index in `SUMMARY_ROWS` of the sequence context of each
+    trinucleotide code, with 3 for anything that is not CG, CHG or CHH.
+    This reproduces matching the patterns 'CG.', 'C[ACT]G' and 'C[ACT][ACT]'.
+    """
+    lookup = np.full(UNKNOWN_TRINUCLEOTIDE + 1, 3, dtype=np.uint8)
+    for code in range(UNKNOWN_TRINUCLEOTIDE + 1):
+        seq = decode_trinucleotide(code)
+        if seq[0] != 'C':
+            continue
+        if seq[1] == 'G':
+            lookup[code] = 0
+        elif seq[1] in 'ACT' and seq[2] == 'G':
+            lookup[code] = 1
+        elif seq[1] in 'ACT' and seq[2] in 'ACT':
+            lookup[code] = 2
+    return lookup
+
+CONTEXT_LOOKUP = _context_lookup()
+
+def read_allc(path, chunksize=1000000, chunks_to_test=None):
+    """
+    Iterate over an allc file in chunks of rows.
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped allc file from the methylpy pipeline, or to a
+        folder created from one by `cytosine_store.build_store`.
+    chunksize: int
+        Number of rows (cytosines) to read in each chunk.
+    chunks_to_test: None or int
+        If an integer is given, stop after this many chunks.
+
+    Returns
+    -------
+    Generator of DataFrames with columns 'chr' (categorical), 'pos', 'context'
+    (trinucleotide codes from `encode_trinucleotides`), 'mC_reads',
+    'all_reads' and 'signif'. 'signif' is the last column of the allc file,
+    which methylpy sets to 1 for cytosines that are significantly methylated
+    and 0 otherwise, with -1 where it is missing.
+    """
+    if os.path.isdir(path):
+        from cytosine_store import CytosineStore
+        yield from CytosineStore(path).iter_chunks(chunksize, chunks_to_test)
+        return
+
+    reader = pd.read_csv(
+        path,
+        compression='gzip',
+        sep="\t",
+        names = ["chr", "pos", "strand", "seq", "mC_reads", "all_reads", "signif"],
+        usecols = ["chr", "pos", "seq", "mC_reads", "all_reads", "signif"],
+        dtype = {'chr' : 'category', 'pos' : np.int64, 'seq' : 'category', 'mC_reads' : np.int64, 'all_reads' : np.int64, 'signif' : np.float32},
+        chunksize = int(chunksize)
+    )
+    with reader:
+        for i, chunk in enumerate(reader):
+            if chunks_to_test is not None and i >= chunks_to_test:
+                break
+            chunk['context'] = encode_trinucleotides(chunk.pop('seq'))
+            chunk['signif'] = chunk['signif'].fillna(-1).astype(np.int8)
+            yield chunk
+
+def chromosome_codes(chrom, chr_types=CHR_TYPES):
+    """
+    Give each cytosine the index of its entry in `chr_types`, or
+    `len(chr_types)` for chromosomes not listed.
+
+    Parameters
+    ----------
+    chrom: pandas.Series
+        Chromosome labels. Categorical series are used as they are.
+    chr_types: dict
+        Dictionary mapping group names to lists of chromosome labels.
+
+    Returns
+    -------
+    Array of integer codes.
+    """
+    chrom = chrom.astype('category')
+    group_of = {c: i for i, chrs in enumerate(chr_types.values()) for c in chrs}
+    lookup = np.array(
+        [group_of.get(c, len(chr_types)) for c in chrom.cat.categories] + [len(chr_types)],
+        dtype=np.intp
+    )
+    return lookup[chrom.cat.codes.to_numpy()]
+
+class GenomeWideCounter:
+    """
+    Running sums of methylated and total reads in each sequence context on
+    each chromosome type, updated one chunk at a time.
+
+    Every cytosine in a chunk is labelled with a single integer combining its
+    chromosome type and sequence context, and reads are summed for all
+    combinations at once with `np.bincount`.
+
+    Example
+    -------
+    counter = GenomeWideCounter()
+    for chunk in read_allc('allc_sample.tsv.gz'):
+        counter.add(chunk)
+    counter.result()
+    """
+    def __init__(self):
+        # Rows are chromosome types plus one for other chromosomes; columns
+        # are CG, CHG, CHH and other contexts.
+        self.n_groups = (len(CHR_TYPES) + 1) * 4
+        self.mC_reads  = np.zeros(self.n_groups, dtype=np.int64)
+        self.all_reads = np.zeros(self.n_groups, dtype=np.int64)
+        self.n_cytosines = 0
+
+    def add(self, chunk):
+        """
+        Add reads from a chunk returned by `read_allc`.
+        """
+        self.n_cytosines += chunk.shape[0]
+        group = chromosome_codes(chunk['chr']) * 4 + CONTEXT_LOOKUP[chunk['context'].to_numpy()]
+        self.mC_reads  += np.bincount(group, weights=chunk['mC_reads'],  minlength=self.n_groups).round().astype(np.int64)
+        self.all_reads += np.bincount(group, weights=chunk['all_reads'], minlength=self.n_groups).round().astype(np.int64)
+
+    def result(self):
+        """
+        Dictionary with a DataFrame for each entry in `CHR_TYPES`. Rows are
+        CG, CHG, CHH and coverage; columns are 'mC_reads' and 'all_reads'. For
+        the coverage row these are the number of reads on that chromosome type
+        and the number of cytosines in the whole file.
+        """
+        mC_reads  = self.mC_reads.reshape(-1, 4)
+        all_reads = self.all_reads.reshape(-1, 4)
+        output = {}
+        for i, k in enumerate(CHR_TYPES.keys()):
+            output[k] = pd.DataFrame({
+                'mC_reads'  : np.append(mC_reads[i, :3],  all_reads[i].sum()),
+                'all_reads' : np.append(all_reads[i, :3], self.n_cytosines)
+            }, index=SUMMARY_ROWS)
+        return output
+
+class QCCounter:
+    """
+    Running quality-control metrics for an allc file, updated one chunk at a
+    time alongside `GenomeWideCounter`.
+
+    Parameters
+    ----------
+    thresholds: list
+        Numbers of reads for which to report the fraction of cytosines with at
+        least that many reads.
+    max_depth: int
+        Largest number of reads given its own bin in the coverage histogram.
+    control: str
+        Chromosome used to estimate the non-conversion rate.
+
+    Example
+    -------
+    counters = [GenomeWideCounter(), QCCounter()]
+    stream_allc('allc_sample.tsv.gz', counters)
+    counters[1].result()
+    """
+    def __init__(self, thresholds=QC_THRESHOLDS, max_depth=QC_MAX_DEPTH, control=CONVERSION_CONTROL):
+        self.thresholds = list(thresholds)
+        self.max_depth = int(max_depth)
+        self.control = control
+        # Cytosines in each context with 0 to max_depth reads.
+        self.histogram = np.zeros((len(CONTEXT_NAMES), self.max_depth + 1), dtype=np.int64)
+        # Methylated and total reads on the control chromosome in each context.
+        self.control_mC  = np.zeros(len(CONTEXT_NAMES), dtype=np.int64)
+        self.control_all = np.zeros(len(CONTEXT_NAMES), dtype=np.int64)
+        # Cytosines and reads on each chromosome, in the order they appear.
+        self.chr_cytosines = {}
+        self.chr_reads = {}
+
+    def add(self, chunk):
+        """
+        Add cytosines from a chunk returned by `read_allc`.
+        """
+        context = CONTEXT_LOOKUP[chunk['context'].to_numpy()].astype(np.intp)
+        all_reads = chunk['all_reads'].to_numpy()
+        depth = np.minimum(all_reads, self.max_depth)
+        self.histogram += np.bincount(
+            context * (self.max_depth + 1) + depth, minlength=self.histogram.size
+        ).reshape(self.histogram.shape)
+
+        chrom = chunk['chr'].astype('category')
+        codes = chrom.cat.codes.to_numpy()
+        n_chr = len(chrom.cat.categories)
+        cytosines = np.bincount(codes[codes >= 0], minlength=n_chr)
+        reads = np.bincount(codes[codes >= 0], weights=all_reads[codes >= 0], minlength=n_chr)
+        for i, c in enumerate(chrom.cat.categories):
+            if cytosines[i] > 0:
+                self.chr_cytosines[c] = self.chr_cytosines.get(c, 0) + int(cytosines[i])
+                self.chr_reads[c] = self.chr_reads.get(c, 0) + int(round(reads[i]))
+
+        if self.control in chrom.cat.categories:
+            on_control = codes == chrom.cat.categories.get_loc(self.control)
+            self.control_mC  += np.bincount(context[on_control], weights=chunk['mC_reads'].to_numpy()[on_control], minlength=len(CONTEXT_NAMES)).round().astype(np.int64)
+            self.control_all += np.bincount(context[on_control], weights=all_reads[on_control], minlength=len(CONTEXT_NAMES)).round().astype(np.int64)
+
+    def result(self):
+        """
+        DataFrame with columns 'metric', 'group' and 'value', with rows for:
+        1. 'non_conversion': methylated reads divided by all reads on the
+            control chromosome, for each context and for all contexts ('all').
+        2. 'n_cytosines' and 'depth': number of cytosines on each chromosome,
+            and the mean number of reads mapping to them.
+        3. 'frac_coverage_ge_<N>': fraction of cytosines in each context with
+            at least N reads, for each entry in `thresholds`.
+        4. 'coverage_<k>': number of cytosines in each context with k reads,
+            where the last bin ('coverage_<max_depth>+') includes all
+            cytosines with more reads.
+        Values are NaN where there are no reads or cytosines.
+        """
+        rows = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            non_conversion = self.control_mC / self.control_all
+            rows += [('non_conversion', k, v) for k, v in zip(CONTEXT_NAMES[:3], non_conversion[:3])]
+            rows.append(('non_conversion', 'all', self.control_mC.sum() / self.control_all.sum()))
+            for c, n in self.chr_cytosines.items():
+                rows.append(('n_cytosines', c, n))
+                rows.append(('depth', c, self.chr_reads[c] / n))
+            n_context = self.histogram.sum(axis=1)
+            at_least = self.histogram[:, ::-1].cumsum(axis=1)[:, ::-1]
+            for t in self.thresholds:
+                frac = at_least[:, t] / n_context if t <= self.max_depth else np.full(len(CONTEXT_NAMES), np.nan)
+                rows += [('frac_coverage_ge_' + str(t), k, v) for k, v in zip(CONTEXT_NAMES, frac)]
+        for d in range(self.max_depth + 1):
+            label = 'coverage_' + str(d) + ('+' if d == self.max_depth else '')
+            rows += [(label, k, v) for k, v in zip(CONTEXT_NAMES, self.histogram[:, d])]
+        return pd.DataFrame(rows, columns=['metric', 'group', 'value'], dtype=object)
+
+class SiteLevelCounter:
+    """
+    Methylation estimators based on the level of each cytosine rather than on
+    pooled reads, updated one chunk at a time alongside `GenomeWideCounter`.
+
+    Cytosines are counted for each combination of chromosome type, sequence
+    context, total reads and methylated reads. There are few distinct
+    combinations, so the estimators below are calculated from these counts at
+    the end, and the binomial test is only done once for each combination.
+    Because the counts are kept, the non-conversion rate for the test can be
+    estimated from the control chromosome in the same pass.
+
+    Parameters
+    ----------
+    min_coverage: int
+        Cytosines with fewer reads than this are ignored.
+    non_conversion: float
+        Optional rate at which unmethylated cytosines appear methylated.
+        Defaults to methylated reads divided by all reads on `control`.
+    alpha: float
+        Cytosines are called methylated if the probability of at least as
+        many methylated reads from non-conversion alone is below this.
+    control: str
+        Chromosome used to estimate the non-conversion rate.
+
+    Example
+    -------
+    counters = [GenomeWideCounter(), SiteLevelCounter(min_coverage=5)]
+    stream_allc('allc_sample.tsv.gz', counters)
+    counters[1].result()
+    """
+    def __init__(self, min_coverage=MIN_COVERAGE, non_conversion=None, alpha=METHYLATION_ALPHA, control=CONVERSION_CONTROL):
+        self.min_coverage = int(min_coverage)
+        self.non_conversion = non_conversion
+        self.alpha = alpha
+        self.control = control
+        self.n_groups = (len(CHR_TYPES) + 1) * 4
+        # Number of cytosines for each key combining group, total and methylated reads.
+        self.counts = pd.Series(dtype=np.int64)
+        # Covered cytosines with a methylpy call, and those called methylated.
+        self.signif_sites = np.zeros(self.n_groups, dtype=np.int64)
+        self.signif_methylated = np.zeros(self.n_groups, dtype=np.int64)
+        self.control_mC = 0
+        self.control_all = 0
+
+    def add(self, chunk):
+        """
+        Add cytosines from a chunk returned by `read_allc`.
+        """
+        group = chromosome_codes(chunk['chr']) * 4 + CONTEXT_LOOKUP[chunk['context'].to_numpy()]
+        mC_reads = chunk['mC_reads'].to_numpy().astype(np.int64)
+        all_reads = chunk['all_reads'].to_numpy().astype(np.int64)
+        if (all_reads >= COUNT_LIMIT).any():
+            raise ValueError("Cytosines with {} or more reads are not supported.".format(COUNT_LIMIT))
+        keys, n = np.unique((group.astype(np.int64) * COUNT_LIMIT + all_reads) * COUNT_LIMIT + mC_reads, return_counts=True)
+        self.counts = self.counts.add(pd.Series(n, index=keys), fill_value=0).astype(np.int64)
+
+        if 'signif' in chunk.columns:
+            signif = chunk['signif'].to_numpy()
+            called = (all_reads >= self.min_coverage) & (signif >= 0)
+            self.signif_sites += np.bincount(group[called], minlength=self.n_groups)
+            self.signif_methylated += np.bincount(group[called & (signif == 1)], minlength=self.n_groups)
+
+        on_control = (chunk['chr'] == self.control).to_numpy()
+        self.control_mC += int(mC_reads[on_control].sum())
+        self.control_all += int(all_reads[on_control].sum())
+
+    def rate(self):
+        """
+        Non-conversion rate used for the binomial test.
+        """
+        if self.non_conversion is not None:
+            return self.non_conversion
+        return self.control_mC / self.control_all if self.control_all > 0 else np.nan
+
+    def result(self):
+        """
+        Dictionary with a DataFrame for each entry in `CHR_TYPES`. Rows are
+        CG, CHG and CHH; columns are:
+        1. 'mean_level': unweighted mean of methylated reads divided by all
+            reads over cytosines with at least `min_coverage` reads.
+        2. 'n_sites': number of cytosines with at least `min_coverage` reads.
+        3. 'frac_methylated': fraction of those cytosines called methylated
+            by a binomial test against the non-conversion rate.
+        4. 'frac_signif': fraction of those cytosines called methylated by
+            methylpy, or NaN if the allc file has no calls.
+        """
+        keys = self.counts.index.to_numpy(dtype=np.int64)
+        n = self.counts.to_numpy().astype(np.float64)
+        mC_reads = keys % COUNT_LIMIT
+        all_reads = (keys // COUNT_LIMIT) % COUNT_LIMIT
+        group = keys // COUNT_LIMIT ** 2
+        covered = (all_reads >= max(self.min_coverage, 1))
+        # P(at least mC_reads methylated reads | non-conversion only)
+        pvalues = binom.sf(mC_reads - 1, all_reads, self.rate())
+        methylated = covered & (pvalues < self.alpha)
+
+        n_sites = np.bincount(group[covered], weights=n[covered], minlength=self.n_groups)
+        level_sums = np.bincount(group[covered], weights=n[covered] * mC_reads[covered] / all_reads[covered], minlength=self.n_groups)
+        n_methylated = np.bincount(group[methylated], weights=n[methylated], minlength=self.n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns = {
+                'mean_level'      : level_sums / n_sites,
+                'n_sites'         : n_sites.astype(np.int64),
+                'frac_methylated' : n_methylated / n_sites if not np.isnan(self.rate()) else np.full(self.n_groups, np.nan),
+                'frac_signif'     : self.signif_methylated / self.signif_sites
+            }
+        output = {}
+        for i, k in enumerate(CHR_TYPES.keys()):
+            output[k] = pd.DataFrame(
+                {c: v.reshape(-1, 4)[i, :3] for c, v in columns.items()},
+                index=SUMMARY_ROWS[:3]
+            )
+        return output
+
+def stream_allc(path, counters, chunksize=1000000, chunks_to_test=None):
+    """
+    Read an allc file once, adding each chunk to every counter.
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped allc file from the methylpy pipeline, or to a
+        cytosine store.
+    counters: list
+        Objects with a method `add` taking a chunk from `read_allc`, such as
+        `GenomeWideCounter` and `QCCounter`.
+    chunksize: int
+        Number of rows (cytosines) to read in each chunk.
+    chunks_to_test: None or int
+        If an integer is given, stop after this many chunks.
+
+    Returns
+    -------
+    `counters`, updated.
+    """
+    for chunk in read_allc(path, chunksize, chunks_to_test):
+        for counter in counters:
+            counter.add(chunk)
+    return counters
+
+def sum_allc_reads(path, chunksize=1000000, chunks_to_test=None):
+    """
+    Sum methylated and total reads in each sequence context over an allc file.
+
+    Parameters
+    ----------
+    path: str
+        Path to a gzipped allc file from the methylpy pipeline, or to a
+        cytosine store.
+    chunksize: int
+        Number of rows (cytosines) to read in each chunk.
+    chunks_to_test: None or int
+        If an integer is given, stop after this many chunks.
+
+    Returns
+    -------
+    Dictionary with a DataFrame for each entry in `CHR_TYPES`; see
+    `GenomeWideCounter.result`.
+    """
+    counter, = stream_allc(path, [GenomeWideCounter()], chunksize, chunks_to_test)
+    return counter.result()
+
+def format_weighted_means(filename, sums):
+    """
+    Format weighted-mean methylation for each chromosome type as CSV lines.
+
+    Parameters
+    ----------
+    filename: str
+        Label for the sample, written in the first column.
+    sums: dict
+        Output of `sum_allc_reads`.
+
+    Returns
+    -------
+    List of strings, one line for each chromosome type.
+    """
+    lines = []
+    for k, sum_mC in sums.items():
+        weighted_means = (sum_mC['mC_reads'] / sum_mC['all_reads']).round(5).astype(str).to_list()
+        lines.append(filename + ',' + k + ',' + ','.join(weighted_means) + '\n')
+    return lines
+
+def format_site_levels(filename, levels):
+    """
+    Format estimators from `SiteLevelCounter` as CSV lines.
+
+    Parameters
+    ----------
+    filename: str
+        Label for the sample, written in the first column.
+    levels: dict
+        Output of `SiteLevelCounter.result`.
+
+    Returns
+    -------
+    List of strings, one line for each chromosome type and estimator, with
+    values for CG, CHG and CHH.
+    """
+    lines = []
+    for k, df in levels.items():
+        for estimator in df.columns:
+            values = df[estimator].round(5) if estimator != 'n_sites' else df[estimator]
+            lines.append(filename + ',' + k + ',' + estimator + ',' + ','.join(values.astype(str)) + '\n')
+    return lines
+
+def format_qc(filename, qc):
+    """
+    Format quality-control metrics as CSV lines.
+
+    Parameters
+    ----------
+    filename: str
+        Label for the sample, written in the first column.
+    qc: DataFrame
+        Output of `QCCounter.result`.
+
+    Returns
+    -------
+    List of strings, one line for each metric and group.
+    """
+    return [
+        '{},{},{},{}\n'.format(filename, m, g, round(v, 6) if isinstance(v, float) else v)
+        for m, g, v in qc.itertuples(index=False)
+    ]
+
+def already_in_output(filename, output):
+    """
+    True if `output` exists and has a row whose first column is `filename`.
+    """
+    if not os.path.exists(output):
+        return False
+    with open(output) as f:
+        return any(line.split(',', 1)[0] == filename for line in f)
+
+if __name__ == '__main__':
+    # Script input parameters
+    parser = argparse.ArgumentParser(description = 'Weighted-mean methylation from an allc file')
+    parser.add_argument('-i', '--input', help = 'Path to allc file from the methylpy pipeline', required = True)
+    parser.add_argument('-o', '--output', help = 'Path to the file to which results should be appended.', required = True)
+    parser.add_argument('--chunksize', help = 'Number of rows of the allc file to read at once.', type = int, default = 1000000)
+    parser.add_argument('--chunks_to_test', help = 'Optional number of chunks to run before stopping, for testing.', type = int, required = False)
+    parser.add_argument('--qc', help = 'Optional path to a file to which quality-control metrics should be appended.', required = False)
+    parser.add_argument('--levels', help = 'Optional path to a file to which estimators based on the methylation level of each cytosine should be appended.', required = False)
+    parser.add_argument('--min_coverage', help = 'Cytosines with fewer reads than this are ignored by the estimators in --levels. Default is {}.'.format(MIN_COVERAGE), type = int, default = MIN_COVERAGE)
+    parser.add_argument('--non_conversion', help = 'Optional non-conversion rate for the binomial test of each cytosine. Defaults to the rate on the chloroplast.', type = float, required = False)
+    parser.add_argument('--alpha', help = 'Significance level for the binomial test of each cytosine. Default is {}.'.format(METHYLATION_ALPHA), type = float, default = METHYLATION_ALPHA)
+    args = parser.parse_args()
+
+    filename = os.path.basename(args.input)
+    # Only write to files that do not already have results for this input, so
+    # that reruns do not write duplicate rows.
+    outputs = {'means' : args.output, 'qc' : args.qc, 'levels' : args.levels}
+    outputs = {k: path for k, path in outputs.items() if path}
+    for k, path in list(outputs.items()):
+        if already_in_output(filename, path):
+            print("{} already has results for {}; not writing duplicate rows.".format(path, filename))
+            del outputs[k]
+    if len(outputs) == 0:
+        print("All outputs already have results for {}; skipping.".format(filename))
+        sys.exit(0)
 
-# Empty dataframe to store read counts for methylated un unmethylated cytosines.
-sum_mC = pd.DataFrame({
-    'mC_reads' : [0,0,0,0],
-    'all_reads' : [0,0,0,0]
-},index=['CG', "CHG", "CHH", 'coverage']
-)
-
-# Weighted mean methylation over cytosines on autosomes.
-autosomes = allc.loc[allc['chr'].isin(['Chr1', 'Chr2', 'Chr3', 'Chr4', 'Chr5'])]
-sum_mC = pd.DataFrame({
-        'CG' : autosomes[['mC_reads', "all_reads"]].\
-            loc[autosomes['seq'].str.match('CG.')].\
-                sum(0),
-        'CHG' : autosomes[['mC_reads', "all_reads"]].\
-            loc[autosomes['seq'].str.match('C[ACT]G')].\
-                sum(0),
-        'CHH' : autosomes[['mC_reads', "all_reads"]].\
-            loc[autosomes['seq'].str.match('C[ACT][ACT]')].\
-                sum(0),
-        'coverage' : np.array([ autosomes['all_reads'].sum(), allc.shape[0] ])
-    }).T
-
-weighted_means = (sum_mC['mC_reads'] / sum_mC['all_reads']).round(5).astype(str).to_list()
-# Write input file name plus weighted means for autosomes to disk.
-out= open(args.output, 'a') 
-out.write(
-    os.path.basename(args.input) + ',autosomes,' + ','.join(weighted_means) + '\n'
-)
-out.close()
-
-# Weighted mean methylation over cytosines on mitochondria and chloroplasts.
-organelles = allc.loc[allc['chr'].isin(['ChrC', 'ChrM'])]
-sum_mC = pd.DataFrame({
-        'CG' : organelles[['mC_reads', "all_reads"]].\
-            loc[organelles['seq'].str.match('CG.')].\
-                sum(0),
-        'CHG' : organelles[['mC_reads', "all_reads"]].\
-            loc[organelles['seq'].str.match('C[ACT]G')].\
-                sum(0),
-        'CHH' : organelles[['mC_reads', "all_reads"]].\
-            loc[organelles['seq'].str.match('C[ACT][ACT]')].\
-                sum(0),
-        'coverage' : np.array([ organelles['all_reads'].sum(), allc.shape[0] ])
-    }).T
-weighted_means = (sum_mC['mC_reads'] / sum_mC['all_reads']).round(5).astype(str).to_list()
-# Write input file name plus weighted means for organelles to disk.
-out= open(args.output, 'a') 
-out.write(
-    os.path.basename(args.input) + ',organelles,' + ','.join(weighted_means) + '\n'
-)
-out.close()
\ No newline at end of file
+    counters = {}
+    if 'means' in outputs:
+        counters['means'] = GenomeWideCounter()
+    if 'qc' in outputs:
+        counters['qc'] = QCCounter()
+    if 'levels' in outputs:
+        counters['levels'] = SiteLevelCounter(args.min_coverage, args.non_conversion, args.alpha)
+    stream_allc(args.input, counters.values(), args.chunksize, args.chunks_to_test)
+    # Write input file name plus weighted means for autosomes and organelles to disk.
+    if 'means' in outputs:
+        out = open(args.output, 'a')
+        out.writelines(format_weighted_means(filename, counters['means'].result()))
+        out.close()
+    extras = [
+        (QC_HEADER, format_qc, 'qc'),
+        (LEVELS_HEADER, format_site_levels, 'levels')
+    ]
+    for header, format_lines, k in extras:
+        if k in outputs:
+            new_file = not os.path.exists(outputs[k])
+            with open(outputs[k], 'a') as out:
+                out.writelines(([header] if new_file else []) + format_lines(filename, counters[k].result()))
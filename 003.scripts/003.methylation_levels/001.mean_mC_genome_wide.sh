@@ -1,25 +1,37 @@
 #!/usr/bin/env bash
 
 # SLURM
-#SBATCH --job-name=mean_mC_jobarray
+#SBATCH --job-name=mean_mC_genome_wide
 #SBATCH --output=mean_mC_genome_wide.log
-#SBATCH --mem-per-cpu=16GB
+#SBATCH --mem-per-cpu=2GB
 #SBATCH --qos=medium
 #SBATCH --time=12:00:00
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=16
 
 # Tom Ellis, June 2021
-# SLURM script to calculate weighted-mean methylation levels in CG, 
+# SLURM script to calculate weighted-mean methylation levels in CG,
 # CHG and CHH sequence contexts for a folder of allc files generated
 # by the methylpy pipeline.
-# 
+#
 # Methylation is calculated for both autosomes and organelles
 # (mitochondria and chloroplasts).
 #
-# This loops over each allc file, calculates numbers, and sends them
-# to an output summary file. This would be faster as a job array, but 
-# I wanted to be sure that the output file was created and updated
-# within a single script.
+# Files are processed in parallel by `batch_weighted_mean_mC.py`, which
+# runs `weighted_mean_mC_from_allc.py` on each allc file on a pool of
+# workers. Only the main process writes the output file, once all files
+# are done, so it is safe to run files in parallel within a single script.
+# Finished files are recorded in `$OUT.manifest`, so if the job dies it
+# can be resubmitted and will only summarise files that are not done yet.
+#
+# allc files are streamed in chunks of `--chunksize` rows, so memory
+# does not depend on the size of each file.
+#
+# Quality-control metrics for each library (non-conversion rate on the
+# chloroplast, coverage in each context and depth on each chromosome)
+# are calculated in the same pass and written to `$QC`, along with the
+# unweighted mean level of cytosines with at least 5 reads and the
+# fraction of those called methylated, written to `$LEVELS`.
 
 # ENVIRONMENT #
 module load anaconda3/2019.03
@@ -29,13 +41,14 @@ source $EBROOTANACONDA3/etc/profile.d/conda.sh
 ALLC='004.output/001.methylseq/methylpy/'
 # Where to save the output
 OUT='004.output/003.methylation_levels/mean_mC_genome_wide.csv'
+QC='004.output/003.methylation_levels/allc_qc.csv'
+LEVELS='004.output/003.methylation_levels/site_levels_genome_wide.csv'
 
-# Create an empty file with a header
-echo "file,chr_type,CG,CHG,CHH,coverage" > $OUT
-
-FILES=($ALLC/'allc_*.tsv.gz')
-for f in $FILES; do
-  python3 002.library/python/weighted_mean_mC_from_allc.py \
-  --input $f \
-  --output $OUT
-done
\ No newline at end of file
+python3 002.library/python/batch_weighted_mean_mC.py \
+--input $ALLC \
+--output $OUT \
+--workers $SLURM_CPUS_PER_TASK \
+--chunksize 1000000 \
+--qc $QC \
+--levels $LEVELS \
+--min_coverage 5
@@ -3,20 +3,25 @@
 # Tom Ellis, July 2021, modifying code from Eriko Sasaki
 #
 # For a folder of allc files from the methylpy pipeline, this runs
-# `002.library/perl/001.methylation_levels.pl` to count methylated
+# `002.library/python/methylation_on_TEs.py` to count methylated
 # and total reads on each annotated TE in a sample's genome, and 
 # saves a `.tsv.gz` file for each sample.
+#
+# The Python script gives the same output as the original Perl script
+# `002.library/perl/001.methylation_levels.pl`, but stores cytosines as
+# sorted arrays instead of hashes, so it needs much less memory.
 
 #SBATCH --nodes=1
 #SBATCH --ntasks=4
 #SBATCH --cpus-per-task=1
-#SBATCH --mem-per-cpu=10G
+#SBATCH --mem-per-cpu=4G
 #SBATCH --output=./003.scripts/methylation_on_TEs.log
 #SBATCH --qos=medium
 #SBATCH --time=12:00:00
 #SBATCH --array=0-479
 
-module load perl/5.28.0-gcccore-7.3.0
+module load anaconda3/2019.03
+source $EBROOTANACONDA3/etc/profile.d/conda.sh
 
 # Where the data are
 ALLC=004.output/001.methylseq/methylpy
@@ -34,4 +39,7 @@ do
 done
 
 Fname=${ID[$SLURM_ARRAY_TASK_ID]}
-perl 002.library/perl/001.methylation_levels.pl ${ALLC} ${INFO} ${OUT} ${Fname}
\ No newline at end of file
+python3 002.library/python/methylation_on_TEs.py \
+--input ${ALLC}/${Fname} \
+--annotation ${INFO} \
+--output ${OUT}/${Fname}
\ No newline at end of file
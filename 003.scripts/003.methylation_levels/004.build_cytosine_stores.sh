@@ -0,0 +1,35 @@
+#!/usr/bin/env bash
+
+# Tom Ellis, August 2021
+#
+# For a folder of allc files from the methylpy pipeline, this runs
+# `002.library/python/cytosine_store.py` to convert each allc file to a
+# folder of memory-mappable NumPy arrays. This only needs to be done
+# once. Afterwards, the scripts that read allc files can be given the
+# path to a store (or a glob matching stores) instead, and skip
+# decompressing and parsing the text files.
+
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem-per-cpu=2G
+#SBATCH --output=./003.scripts/build_cytosine_stores.log
+#SBATCH --qos=medium
+#SBATCH --time=02:00:00
+#SBATCH --array=0-479
+
+module load anaconda3/2019.03
+source $EBROOTANACONDA3/etc/profile.d/conda.sh
+
+# Where the data are
+ALLC=004.output/001.methylseq/methylpy
+# Where to save the output
+OUT=004.output/001.methylseq/cytosine_stores
+
+mkdir -p $OUT
+
+FILES=($ALLC/allc_*.tsv.gz)
+f=${FILES[$SLURM_ARRAY_TASK_ID]}
+python3 002.library/python/cytosine_store.py \
+--input $f \
+--output $OUT/`basename $f .tsv.gz`
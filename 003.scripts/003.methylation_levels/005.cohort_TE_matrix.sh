@@ -0,0 +1,27 @@
+#!/usr/bin/env bash
+
+# Tom Ellis, August 2021
+#
+# Collect the per-sample files created by `002.methylation_on_TEs.sh`
+# into a single HDF5 file giving methylated and total reads on each TE
+# for every sample, using `002.library/python/cohort_matrix.py`.
+#
+# Samples already in the file are skipped, so this can be rerun to add
+# new samples as they are finished.
+
+#SBATCH --mem=8G
+#SBATCH --output=./003.scripts/cohort_TE_matrix.log
+#SBATCH --qos=short
+#SBATCH --time=01:00:00
+
+module load anaconda3/2019.03
+source $EBROOTANACONDA3/etc/profile.d/conda.sh
+
+# Where the data are
+DATA=004.output/003.methylation_levels/reads_on_each_TE
+# Where to save the output
+OUT=004.output/003.methylation_levels/reads_on_each_TE.h5
+
+python3 002.library/python/cohort_matrix.py \
+--input "$DATA/*.tsv.gz" \
+--output $OUT
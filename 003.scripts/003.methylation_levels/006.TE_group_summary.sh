@@ -0,0 +1,34 @@
+#!/usr/bin/env bash
+
+# Tom Ellis, August 2021
+#
+# Mean methylation over groups of TEs for every sample, from the cohort
+# file created by `005.cohort_TE_matrix.sh`. This gives the same means
+# as `003.RdDM_CMT2_TEs.R` for all, CMT2- and RdDM-targeted TEs, plus
+# weighted means, and the same for every TE superfamily in the
+# Araport11 annotation.
+
+#SBATCH --mem=4G
+#SBATCH --output=./003.scripts/TE_group_summary.log
+#SBATCH --qos=short
+#SBATCH --time=01:00:00
+
+module load anaconda3/2019.03
+source $EBROOTANACONDA3/etc/profile.d/conda.sh
+
+REF=001.data/002.reference_genome
+# Cohort file of reads on each TE
+DATA=004.output/003.methylation_levels/reads_on_each_TE.h5
+# Where to save the output
+OUT=004.output/003.methylation_levels/mean_mC_TE_groups.csv
+
+# Column of the TE annotation giving superfamilies, counting from zero.
+SUPERFAMILY_COLUMN=4
+
+python3 002.library/python/te_group_summary.py \
+--input $DATA \
+--output $OUT \
+--group CMT2=$REF/CMT2_target_TEs.txt \
+--group RdDM=$REF/RdDM_target_TEs.txt \
+--annotation $REF/Araport11_transposons_class.201606.txt \
+--label_column $SUPERFAMILY_COLUMN
@@ -10,9 +10,158 @@ from os import listdir
 from warnings import warn
 from time import time, strftime
 from pprint import pprint
+from hashlib import sha1
+from os.path import basename
 from scipy.stats import binom
 
-def weighted_mean_methylation(mc_class, mc_count, total, patterns=None):
+# Each base of a trinucleotide is coded as A, C, G, T or anything else, so that
+# a trinucleotide can be packed into an integer from 0 to 124.
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for i, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = i
+N_TRINUCLEOTIDES = 125
+
+def encode_trinucleotides(mc_class):
+    """
+    Pack an array of trinucleotide (byte) strings into integers from 0 to 124.
+
+    This is a single table lookup on the raw bytes of the array, so it is much
+    faster than comparing strings.
+
+    Parameters
+    ----------
+    mc_class: vector of strings
+        Array of (byte) strings indicating a cytosine and the two
+        following nucleotides.
+
+    Returns
+    -------
+    Array of integer codes.
+    """
+    mc_class = np.asarray(mc_class)
+    if mc_class.dtype.kind in 'UO':
+        mc_class = np.char.encode(mc_class.astype('U3'), 'ascii')
+    raw = np.frombuffer(np.ascontiguousarray(mc_class.astype('S3')).tobytes(), dtype=np.uint8)
+    codes = BASE_CODES[raw.reshape(-1, 3)].astype(np.intp)
+    return codes[:, 0] * 25 + codes[:, 1] * 5 + codes[:, 2]
+
+class CompiledPatterns:
+    """
+    Lookup tables for a dictionary of sequence contexts, built once and reused
+    for every chunk.
+
+    Parameters
+    ----------
+    patterns: dict
+        Dictionary of sequence contexts, with a list of (byte) strings for
+        the trinucleotides in each. Contexts may overlap.
+
+    Attributes
+    ----------
+    names: list
+        Names of the contexts, in the order given.
+    membership: array
+        Boolean array with a row for each context and a column for each
+        trinucleotide code, showing which trinucleotides are in each context.
+    """
+    def __init__(self, patterns):
+        self.names = list(patterns.keys())
+        self.membership = np.zeros((len(self.names), N_TRINUCLEOTIDES), dtype=bool)
+        for i, v in enumerate(patterns.values()):
+            self.membership[i, encode_trinucleotides(list(v))] = True
+
+    def masks(self, codes):
+        """
+        Dictionary giving a boolean array for each context, showing whether
+        each trinucleotide code is in that context.
+        """
+        return {k: self.membership[i][codes] for i, k in enumerate(self.names)}
+
+    def count(self, codes, mc_count, total):
+        """
+        Methylated reads, total reads and number of cytosines in each context.
+
+        Reads are summed for each of the 125 trinucleotide codes with one
+        `np.bincount` each, and then added up over the trinucleotides in each
+        context, so the cost barely depends on the number of contexts.
+
+        Returns
+        -------
+        List of three dictionaries as for `weighted_mean_methylation`.
+        """
+        sums = [
+            np.bincount(codes, weights=mc_count, minlength=N_TRINUCLEOTIDES),
+            np.bincount(codes, weights=total,    minlength=N_TRINUCLEOTIDES),
+            np.bincount(codes,                   minlength=N_TRINUCLEOTIDES)
+        ]
+        output = []
+        for x in sums:
+            x = np.rint(self.membership @ x).astype(np.int64)
+            output.append({k: x[i] for i, k in enumerate(self.names)})
+        return output
+
+    def count_levels(self, codes, mc_count, total, min_coverage, non_conversion=None, alpha=0.05):
+        """
+        Cytosines with at least `min_coverage` reads, the sum of their
+        methylation levels and the number called methylated, in each context.
+
+        A cytosine is called methylated if the probability of seeing at least
+        as many methylated reads from non-conversion alone is below `alpha`.
+        The test is done once for each distinct pair of read counts.
+
+        Returns
+        -------
+        List of three dictionaries with entries for each context, as for
+        `weighted_mean_methylation`. Methylated cytosines are NaN if
+        `non_conversion` is `None`.
+        """
+        mc_count = np.asarray(mc_count, dtype=np.int64)
+        total = np.asarray(total, dtype=np.int64)
+        covered = total >= max(min_coverage, 1)
+        codes, mc_count, total = codes[covered], mc_count[covered], total[covered]
+        sums = [
+            np.bincount(codes, minlength=N_TRINUCLEOTIDES),
+            np.bincount(codes, weights=mc_count / total, minlength=N_TRINUCLEOTIDES)
+        ]
+        if non_conversion is None:
+            sums.append(np.full(N_TRINUCLEOTIDES, np.nan))
+        else:
+            pairs, inverse = np.unique(np.stack([mc_count, total]), axis=1, return_inverse=True)
+            methylated = (binom.sf(pairs[0] - 1, pairs[1], non_conversion) < alpha)[inverse.ravel()]
+            sums.append(np.bincount(codes[methylated], minlength=N_TRINUCLEOTIDES))
+        output = []
+        for x in sums:
+            x = self.membership @ x
+            output.append({k: x[i] for i, k in enumerate(self.names)})
+        output[0] = {k: int(v) for k, v in output[0].items()}
+        return output
+
+def compile_patterns(patterns=None):
+    """
+    Build lookup tables for a dictionary of sequence contexts.
+
+    Parameters
+    ----------
+    patterns: dict or CompiledPatterns
+        Dictionary of sequence contexts to compare. If `None`, the default is
+        CG, CHG and CHH. Patterns that are already compiled are returned as
+        they are.
+
+    Returns
+    -------
+    CompiledPatterns object.
+    """
+    if isinstance(patterns, CompiledPatterns):
+        return patterns
+    if patterns is None:
+        patterns = {
+            "CG"  : [b'CGA', b'CGC', b'CGG', b'CGT'],
+            "CHG" : [b'CAG', b'CGG', b'CTG'],
+            "CHH" : [b'CAA', b'CAG', b'CAT', b'CGA', b'CGG', b'CGT', b'CTA', b'CTG',b'CTT']
+        }
+    return CompiledPatterns(patterns)
+
+def weighted_mean_methylation(mc_class, mc_count, total, patterns=None, min_coverage=None, non_conversion=None, alpha=0.05):
     """
     Calculate mean methylation (weighted by coverage) on a chunk 
     of sequence from methylpy output.
@@ -27,9 +176,20 @@ def weighted_mean_methylation(mc_class, mc_count, total, patterns=None):
         Number of methylated reads mapping to each cytosine.
     total: vector of integers
         Number of total reads mapping to each cytosine.
-    patterns: dict
+    patterns: dict or CompiledPatterns
         Dictionary of sequence contexts to compare. If `None`, the
-        default is CG, CHG and CHH.
+        default is CG, CHG and CHH. When calling this function on many
+        chunks, pass the output of `compile_patterns` to avoid building the
+        lookup tables each time.
+    min_coverage: int
+        Optional minimum number of reads. If given, estimators based on the
+        methylation level of each cytosine with at least this many reads are
+        also returned.
+    non_conversion: float
+        Optional rate at which unmethylated cytosines appear methylated, used
+        to call each cytosine methylated with a binomial test.
+    alpha: float
+        Significance level for the binomial test.
     
     Returns
     -------
@@ -37,6 +197,11 @@ def weighted_mean_methylation(mc_class, mc_count, total, patterns=None):
     0. Number of reads mapping to methylated cytosines.
     1. Number of reads mapping to all cytosines.
     2. Number of cytosines in each sequence context.
+    If `min_coverage` is given, three more dictionaries follow:
+    3. Number of cytosines with at least `min_coverage` reads.
+    4. Sum of methylated reads divided by all reads over those cytosines.
+    5. Number of those cytosines called methylated by the binomial test (NaN
+        if `non_conversion` is not given).
     
     Example
     -------
@@ -65,30 +230,222 @@ def weighted_mean_methylation(mc_class, mc_count, total, patterns=None):
         }
     weighted_mean_methylation(seq, meth, reads, patterns)
     """
-    if patterns is None:
-        patterns = {
-            "CG"  : [b'CGA', b'CGC', b'CGG', b'CGT'],
-            "CHG" : [b'CAG', b'CGG', b'CTG'],
-            "CHH" : [b'CAA', b'CAG', b'CAT', b'CGA', b'CGG', b'CGT', b'CTA', b'CTG',b'CTT']
-        }
-    
-    # Indices for each context
-    ix = {k: np.isin(mc_class, v) for k,v in patterns.items()}
-    
-    meth   = {k : mc_count[v].sum() for k,v in ix.items()}
-    total  = {k :    total[v].sum() for k,v in ix.items()}
-    nC     = {k :          v .sum() for k,v in ix.items()}
+    patterns = compile_patterns(patterns)
+    codes = encode_trinucleotides(mc_class)
+    output = patterns.count(codes, mc_count, total)
+    if min_coverage is not None:
+        output += patterns.count_levels(codes, mc_count, total, min_coverage, non_conversion, alpha)
+    return output
+
+def iter_chunks(file, keys, chunk_size=None, align=False):
+    """
+    Iterate over consecutive, non-overlapping slices of datasets in an HDF5
+    file from the methylpy pipeline.
+
+    Only one chunk of each dataset is read into memory at a time, and each
+    row of the file is read exactly once.
+
+    Parameters
+    ----------
+    file: HDF5
+        File from the methylpy pipeline. All datasets in `keys` should have
+        the same length as `pos`.
+    keys: list
+        Names of the datasets to read, e.g. ['mc_class', 'mc_count', 'total'].
+    chunk_size: int
+        Number of rows to read at once. If `None`, the value stored in
+        `file['chunk_size']` is used.
+    align: bool
+        If True, round `chunk_size` up to a multiple of the native HDF5 chunk
+        length of the datasets, so that every read starts and ends on a
+        chunk boundary and no HDF5 chunk is decompressed twice.
+
+    Returns
+    -------
+    Generator of tuples giving the first row of the slice, the row after the
+    last row, and a dictionary with an array for each dataset in `keys`.
+
+    Example
+    -------
+    fle = h5.File(filename, 'r')
+    for start, stop, chunk in iter_chunks(fle, ['mc_count', 'total'], align=True):
+        print(start, stop, chunk['mc_count'].sum() / chunk['total'].sum())
+    """
+    end = file['pos'].shape[0]
+    if chunk_size is None:
+        chunk_size = file['chunk_size'][0]
+    chunk_size = int(chunk_size)
+    if chunk_size < 1:
+        raise ValueError("chunk_size should be a positive integer.")
+
+    if align:
+        native = [file[k].chunks[0] for k in keys if file[k].chunks is not None]
+        if len(native) > 0:
+            step = int(np.lcm.reduce(native))
+            chunk_size = step * max(1, -(-chunk_size // step))
+
+    for start in range(0, end, chunk_size):
+        stop = min(start + chunk_size, end)
+        yield start, stop, {k: file[k][start:stop] for k in keys}
+
+def sample_key(name):
+    """
+    Integer key for a sample name, used to give each sample its own stream of
+    random numbers.
+    """
+    return int.from_bytes(sha1(name.encode()).digest()[:8], 'little')
+
+def total_reads(file, chunk_size=None):
+    """
+    Total number of reads mapping to all cytosines in an HDF5 file from the
+    methylpy pipeline, reading only the `total` dataset.
+    """
+    return sum(int(chunk['total'].sum()) for _, _, chunk in iter_chunks(file, ['total'], chunk_size))
+
+class Downsampler:
+    """
+    Downsample methylated and unmethylated reads at each cytosine to one or
+    more proportions, with reproducible random numbers.
+
+    Methylated and unmethylated reads are each sampled from a binomial
+    distribution with *n* as the number of observed reads and p as the
+    proportion kept. Random numbers for each chunk of a file come from a
+    `numpy.random.Generator` seeded from `seed`, the sample name, the
+    proportion, the replicate and the first row of the chunk. Results for a
+    sample therefore do not depend on which other samples, proportions or
+    replicates are run alongside it, or on the order in which files or chunks
+    are processed, but do depend on the chunk size.
 
-    return [meth, total, nC]
+    Parameters
+    ----------
+    fractions: list
+        Proportions of reads to keep, each between 0 and 1. `None` (or 0 or
+        1) gives the observed reads.
+    replicates: int
+        Number of independent draws for each proportion. Observed reads are
+        only returned once.
+    seed: int
+        Seed for the random number generator. If `None`, fresh entropy is
+        drawn from the operating system, so results differ between runs; this
+        value is kept in `seed` so a run can be repeated.
+    sample: str
+        Name of the sample, such as the name of the HDF5 file.
+
+    Attributes
+    ----------
+    targets: dict
+        Target total number of reads for each proportion from `to_coverage`.
 
-def genome_wide_methylation(file, patterns=None, downsample=None):
+    Example
+    -------
+    fle = h5.File(filename, 'r')
+    ds = Downsampler([None, 0.5, 0.25], replicates = 10, seed = 1, sample = basename(filename))
+    for start, stop, chunk in iter_chunks(fle, ['mc_count', 'total']):
+        for fraction, replicate, meth, w in ds.sample(start, chunk['mc_count'], chunk['total']):
+            print(fraction, replicate, meth.sum() / w.sum())
+    """
+    def __init__(self, fractions=(None,), replicates=1, seed=None, sample=''):
+        for d in fractions:
+            if d and ((d > 1) or (d < 0)):
+                raise ValueError("downsample should be between zero and one.")
+        if int(replicates) < 1:
+            raise ValueError("replicates should be a positive integer.")
+        # Repeated proportions would be summed twice by callers.
+        self.fractions = list(dict.fromkeys(fractions))
+        self.replicates = int(replicates)
+        self.seed = np.random.SeedSequence(seed).entropy
+        self.sample_key = sample_key(sample)
+        self.targets = {}
+        # Proportion and replicate of each draw
+        self.draws = [
+            (d, r) for d in self.fractions
+            for r in (range(self.replicates) if self.downsampled(d) else [0])
+        ]
+
+    @classmethod
+    def to_coverage(cls, nreads, targets, fractions=(None,), replicates=1, seed=None, sample=''):
+        """
+        Downsampler keeping a proportion of reads that gives a target total
+        number of reads on average.
+
+        Parameters
+        ----------
+        nreads: int
+            Observed total number of reads over all cytosines, for example
+            from `total_reads`.
+        targets: list
+            Target total numbers of reads. Targets at or above the number of
+            observed reads are dropped with a warning, because they would
+            repeat the observed reads.
+        fractions: list
+            Proportions of reads to keep alongside the targets. Defaults to
+            the observed reads.
+        replicates, seed, sample:
+            As for `Downsampler`.
+        """
+        kept = {}
+        for t in targets:
+            if t >= nreads:
+                warn("{} has {} reads, which is not more than the target of {}; this target is skipped.".format(sample, nreads, t))
+            else:
+                kept.setdefault(t / nreads, t)
+        ds = cls(list(fractions) + list(kept.keys()), replicates, seed, sample)
+        ds.targets = kept
+        return ds
+
+    @staticmethod
+    def downsampled(fraction):
+        return bool(fraction) and fraction < 1
+
+    def rng(self, fraction, replicate, start):
+        """
+        Random number generator for one proportion, replicate and chunk.
+        """
+        # The bits of the float identify the proportion exactly.
+        fraction_key = int(np.float64(fraction).view(np.uint64))
+        return np.random.default_rng(
+            np.random.SeedSequence(self.seed, spawn_key=(self.sample_key, fraction_key, replicate, int(start)))
+        )
+
+    def sample(self, start, meth, w):
+        """
+        Downsample reads in one chunk for each proportion and replicate.
+
+        Parameters
+        ----------
+        start: int
+            First row of the chunk in the file.
+        meth: array
+            Number of methylated reads mapping to each cytosine.
+        w: array
+            Number of reads mapping to each cytosine.
+
+        Returns
+        -------
+        Generator of tuples giving the proportion, replicate, and arrays of
+        methylated and total reads. Observed reads are returned unchanged.
+        """
+        unmeth = None
+        for d, r in self.draws:
+            if not self.downsampled(d):
+                yield d, r, meth, w
+                continue
+            if unmeth is None:
+                unmeth = w - meth
+            rng = self.rng(d, r, start)
+            new_meth = rng.binomial(meth, d)
+            yield d, r, new_meth, new_meth + rng.binomial(unmeth, d)
+
+def genome_wide_methylation(file, patterns=None, downsample=None, chunk_size=None, align_chunks=False, seed=None,
+                            min_coverage=None, non_conversion=None, alpha=0.05):
     """
     Calculate average methylation over all cytosines in a genome, weighted
     by the number of reads mapping to each.
     
     This calculates the numerator and denominator of the weighted average
     function for each chunk in a genome, and adds them up at the end to
-    claculate a single weighted average.
+    claculate a single weighted average. Chunks are read with `iter_chunks`,
+    so I/O is proportional to the size of the file and memory to `chunk_size`.
     
     Parameters
     ----------
@@ -109,7 +466,24 @@ def genome_wide_methylation(file, patterns=None, downsample=None):
     downsample: float between 0 and 1
         Optional proportion by which to downsample reads. Methylated and
         unmethylated reads will be sampled from a binomial distribution with
-        *n* as the number of observed reads and p as this proporiton.
+        *n* as the number of observed reads and p as this proporiton. See
+        `Downsampler`.
+    chunk_size: int
+        Number of cytosines to read at once. If `None`, the value stored in
+        `file['chunk_size']` is used.
+    align_chunks: bool
+        If True, align reads to the native HDF5 chunk layout of the file.
+        See `iter_chunks`.
+    seed: int
+        Optional seed for downsampling. Draws are reproducible for the same
+        seed, file name and chunk size.
+    min_coverage: int
+        Optional minimum number of reads for the estimators based on the
+        methylation level of each cytosine.
+    non_conversion: float
+        Optional non-conversion rate for calling each cytosine methylated.
+    alpha: float
+        Significance level for calling cytosines methylated.
     
     Returns
     -------
@@ -118,6 +492,12 @@ def genome_wide_methylation(file, patterns=None, downsample=None):
         methylation status and number of reads mapping to each cytosine).
     1. Number of reads mapping to each cytosine.
     2. Number of cytosines in each sequence context.
+    If `min_coverage` is given, three more dictionaries follow:
+    3. Unweighted mean methylation level of cytosines with at least
+        `min_coverage` reads.
+    4. Number of cytosines with at least `min_coverage` reads.
+    5. Fraction of those cytosines called methylated by a binomial test
+        against `non_conversion` (NaN if it is not given).
     
     Examples
     --------
@@ -142,57 +522,72 @@ def genome_wide_methylation(file, patterns=None, downsample=None):
             "CHG" : [b'CAG', b'CGG', b'CTG'],
             "CHH" : [b'CAA', b'CAG', b'CAT', b'CGA', b'CGG', b'CGT', b'CTA', b'CTG',b'CTT']
         }
-    # Book keeping for HDF5 files.
-    start = 0
-    end = file['pos'].shape[0]
-    chunk_size = file['chunk_size'][0]
+    downsampler = Downsampler([downsample], seed=seed, sample=basename(file.filename))
+    # Build lookup tables for the sequence contexts once for all chunks.
+    compiled = compile_patterns(patterns)
 
     # Empty dictionaries to store output for each chunk on
     # Methylated sites * number of reads
     # Number of reads
     # Number of cytosines.
-    mean_mC = nreads = nC = {k:0 for k in patterns.keys()}
+    mean_mC = {k:0 for k in patterns.keys()}
+    nreads  = {k:0 for k in patterns.keys()}
+    nC      = {k:0 for k in patterns.keys()}
+    # Covered cytosines, sum of their methylation levels, and methylated cytosines
+    n_sites     = {k:0 for k in patterns.keys()}
+    level_sums  = {k:0 for k in patterns.keys()}
+    methylated  = {k:0 for k in patterns.keys()}
 
     # Run weighted_mean_methylation() on each chunk.
-    for i in range(start, end, chunk_size):
-        stop_i = np.min([i + chunk_size, end])
-        # Import a chunk
-        seq =  file['mc_class'][start:stop_i]
-        meth = file['mc_count'][start:stop_i]
-        w =    file['total'][start:stop_i]
+    chunks = iter_chunks(file, ['mc_class', 'mc_count', 'total'], chunk_size, align_chunks)
+    for start, stop, chunk in chunks:
+        seq  = chunk['mc_class']
         
         # # If there is downsampling to be done, subsample methylated and unmethylated reads.
-        if downsample:
-            if (downsample > 1) or (downsample < 0):
-                raise ValueError("downsample should be between zero and one.")
-            new_unmeth = binom.rvs(w - meth, p=downsample)
-            meth = binom.rvs(meth, p=downsample)
-            w = meth + new_unmeth
+        _, _, meth, w = next(downsampler.sample(start, chunk['mc_count'], chunk['total']))
             
         # Get weighted mean methylation for this chunk
         chunk_meth = weighted_mean_methylation(
             mc_class = seq, 
             mc_count = meth, 
             total = w,
-            patterns = patterns
+            patterns = compiled,
+            min_coverage = min_coverage,
+            non_conversion = non_conversion,
+            alpha = alpha
         )
 
         # Send results to output dictionaries
         mean_mC = {k: mean_mC[k] + chunk_meth[0][k] for k in patterns.keys()}
         nreads  = {k: nreads[k]  + chunk_meth[1][k] for k in patterns.keys()}
         nC      = {k: nC[k]      + chunk_meth[2][k] for k in patterns.keys()}
+        if min_coverage is not None:
+            n_sites    = {k: n_sites[k]    + chunk_meth[3][k] for k in patterns.keys()}
+            level_sums = {k: level_sums[k] + chunk_meth[4][k] for k in patterns.keys()}
+            methylated = {k: methylated[k] + chunk_meth[5][k] for k in patterns.keys()}
     
     output = [
         {k: mean_mC[k] / nreads[k] for k in patterns.keys()}, # weighted mean methylation
         nreads,
         nC
     ]
+    if min_coverage is not None:
+        output += [
+            {k: level_sums[k] / n_sites[k] if n_sites[k] > 0 else np.nan for k in patterns.keys()}, # unweighted mean level
+            n_sites,
+            {k: methylated[k] / n_sites[k] if n_sites[k] > 0 else np.nan for k in patterns.keys()}
+        ]
     return output
 
-def sliding_window_methylation(file, window_size, patterns=None, downsample=None):
+def sliding_window_methylation(file, window_size, patterns=None, downsample=None, seed=None):
     """
     Sliding window quantification of methylation across a single genome
 
+    Each cytosine is assigned to a window once, by integer division of its
+    position by `window_size`. Reads in each window are then summed for each
+    sequence context with a single `np.bincount` per chromosome, rather than
+    selecting the cytosines in each window one at a time.
+
     Parameters
     ----------
     file: HDF5
@@ -204,7 +599,7 @@ def sliding_window_methylation(file, window_size, patterns=None, downsample=None
             reads mapping to each cytosine.
         3. `total`: Vector of integers giving the number of reads mapping to
             each cytosine.
-        4. `chunk_size`: Size of each chunk. Integer.
+        4. `chr`: Vector of chromosome labels for each cytosine.
         5. `pos`: Vector of coordinate positions for each cytosine.
     window_size: int
         Width of the window in nucleotides
@@ -214,16 +609,22 @@ def sliding_window_methylation(file, window_size, patterns=None, downsample=None
     downsample: float between 0 and 1
         Optional proportion by which to downsample reads. Methylated and
         unmethylated reads will be sampled from a binomial distribution with
-        *n* as the number of observed reads and p as this proporiton.
+        *n* as the number of observed reads and p as this proporiton. See
+        `Downsampler`; the whole file is downsampled as a single chunk.
+    seed: int
+        Optional seed for downsampling.
 
     Returns
     -------
-    A CSV file with rows indexing windows giving:
-    1. filename of the HDF5 file
-    2. A string showing chomosome and first and last cytosines in the window
+    A DataFrame with a row for each window and sequence context giving:
+    1. A string showing chomosome and first and last positions in the window
+    2. sequence context
     3. weighted mean methylation
     4. number of reads mapping to cytosines in the window
     5. total number of cytosines in the window.
+    Windows span (start, end] and tile each chromosome from zero up to the
+    largest position in the genome. Windows with no reads have a weighted
+    mean of zero.
 
     Examples
     --------
@@ -232,7 +633,7 @@ def sliding_window_methylation(file, window_size, patterns=None, downsample=None
     filename = path + 'allc_CDN2BANXX_6#89662_ATGCGCAGrandom.hdf5'
     fle = h5.File(filename, 'r')
 
-    genome_wide_methylation(fle)
+    sliding_window_methylation(fle, window_size = 100)
 
     # Example with different set of patterns splitting up CHH
     patterns = {
@@ -240,7 +641,7 @@ def sliding_window_methylation(file, window_size, patterns=None, downsample=None
             "CHG" : [b'CAG', b'CGG', b'CTG'],
             "CHT" : [b'CAT', b'CGT', b'CTT']
     }
-    genome_wide_methylation(fle, patterns)
+    sliding_window_methylation(fle, 100, patterns)
     """
     if patterns is None:
         patterns = {
@@ -248,56 +649,368 @@ def sliding_window_methylation(file, window_size, patterns=None, downsample=None
             "CHG" : [b'CAG', b'CGG', b'CTG'],
             "CHH" : [b'CAA', b'CAG', b'CAT', b'CGA', b'CGG', b'CGT', b'CTA', b'CTG',b'CTT']
         }
-    # Book keeping for HDF5 files.
-    start = 0
-    end = file['pos'].shape[0]
+    chromosomes = [b'Chr1', b'Chr2', b'Chr3', b'Chr4', b'Chr5']
+
+    downsampler = Downsampler([downsample], seed=seed, sample=basename(file.filename))
+
+    # Read each dataset from disk once.
+    pos  = file['pos'][()]
+    chrs = file['chr'][()]
+    seq  = file['mc_class'][()]
+    meth = file['mc_count'][()]
+    w    = file['total'][()]
+    _, _, meth, w = next(downsampler.sample(0, meth, w))
+
+    # Windows (start, end] from zero up to the largest position.
+    edges = np.arange(0, pos.max(), window_size)
+    n_windows = max(len(edges) - 1, 0)
+    window = (pos.astype(np.int64) - 1) // window_size
+    in_window = (pos > 0) & (window < n_windows)
+    ix = compile_patterns(patterns).masks(encode_trinucleotides(seq))
+
+    # Arrays indexed by chromosome, window and context.
+    shape = (len(chromosomes), n_windows, len(patterns))
+    mC_reads = np.zeros(shape)
+    nreads   = np.zeros(shape)
+    nC       = np.zeros(shape, dtype=np.int64)
+    for i, cx in enumerate(chromosomes):
+        on_chr = np.where(in_window & (chrs == cx))[0]
+        window_chr = window[on_chr]
+        for j, k in enumerate(patterns.keys()):
+            sel = ix[k][on_chr]
+            mC_reads[i, :, j] = np.bincount(window_chr[sel], weights=meth[on_chr][sel], minlength=n_windows)
+            nreads[i, :, j]   = np.bincount(window_chr[sel], weights=w[on_chr][sel],    minlength=n_windows)
+            nC[i, :, j]       = np.bincount(window_chr[sel], minlength=n_windows)
+
+    mean_meth = np.divide(mC_reads, nreads, out=np.zeros(shape), where=nreads > 0)
+    labels = np.array([
+        cx.decode() + "_" + str(start) + "_" + str(start + window_size)
+        for cx in chromosomes for start in edges[:n_windows]
+    ])
+    return pd.DataFrame({
+        'pos'       : np.repeat(labels, len(patterns)),
+        'context'   : np.tile(list(patterns.keys()), len(labels)),
+        'mean_meth' : mean_meth.ravel(),
+        'nreads'    : nreads.ravel().astype(np.int64),
+        'nC'        : nC.ravel()
+    })
+
+CHROMOSOMES = [b'Chr1', b'Chr2', b'Chr3', b'Chr4', b'Chr5']
+
+class GenomeWideSums:
+    """
+    Running sums of reads and cytosines in each sequence context over the
+    whole genome, updated one chunk at a time.
+
+    Parameters
+    ----------
+    patterns: CompiledPatterns
+        Sequence contexts, from `compile_patterns`.
+    min_coverage: int
+        Optional minimum number of reads for the estimators based on the
+        methylation level of each cytosine, as for `genome_wide_methylation`.
+    non_conversion: float
+        Optional non-conversion rate for calling each cytosine methylated.
+    alpha: float
+        Significance level for calling cytosines methylated.
+    """
+    def __init__(self, patterns, min_coverage=None, non_conversion=None, alpha=0.05):
+        self.patterns = patterns
+        self.min_coverage = min_coverage
+        self.non_conversion = non_conversion
+        self.alpha = alpha
+        self.sums = np.zeros((3, len(patterns.names)), dtype=np.int64)
+        # Covered cytosines, sum of their methylation levels, and methylated cytosines
+        self.level_sums = np.zeros((3, len(patterns.names)))
+
+    def add(self, codes, meth, w, chrs, pos):
+        """
+        Add a chunk of trinucleotide codes, methylated reads, total reads,
+        chromosome labels and positions.
+        """
+        counts = self.patterns.count(codes, meth, w)
+        self.sums += np.array([[x[k] for k in self.patterns.names] for x in counts])
+        if self.min_coverage is not None:
+            levels = self.patterns.count_levels(codes, meth, w, self.min_coverage, self.non_conversion, self.alpha)
+            self.level_sums += np.array([[x[k] for k in self.patterns.names] for x in levels])
+
+    def result(self):
+        """
+        DataFrame with a row for each context as for `summarise_methylation`,
+        with region 'genome'. If `min_coverage` is given, columns
+        'mean_level', 'n_sites' and 'frac_methylated' are added as for
+        `genome_wide_methylation`.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_meth = self.sums[0] / self.sums[1]
+        output = pd.DataFrame({
+            'region'    : 'genome',
+            'context'   : self.patterns.names,
+            'mean_meth' : mean_meth,
+            'nreads'    : self.sums[1],
+            'nC'        : self.sums[2]
+        })
+        if self.min_coverage is not None:
+            n_sites = self.level_sums[0]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                output['mean_level'] = np.where(n_sites > 0, self.level_sums[1] / n_sites, np.nan)
+                output['n_sites'] = n_sites.astype(np.int64)
+                output['frac_methylated'] = np.where(n_sites > 0, self.level_sums[2] / n_sites, np.nan)
+        return output
+
+class WindowSums:
+    """
+    Running sums of reads and cytosines in each sequence context in
+    non-overlapping windows along Chr1 to Chr5, updated one chunk at a time.
+
+    Windows are the same as for `sliding_window_methylation`, so the result
+    is identical to calling that function on the whole file.
+
+    Parameters
+    ----------
+    window_size: int
+        Width of the window in nucleotides.
+    patterns: CompiledPatterns
+        Sequence contexts, from `compile_patterns`.
+    """
+    def __init__(self, window_size, patterns):
+        self.window_size = int(window_size)
+        self.patterns = patterns
+        self.sums = {c: np.zeros((0, 3, len(patterns.names))) for c in CHROMOSOMES}
+        self.max_pos = 0
+
+    def add(self, codes, meth, w, chrs, pos):
+        """
+        Add a chunk of trinucleotide codes, methylated reads, total reads,
+        chromosome labels and positions.
+        """
+        if len(pos) == 0:
+            return
+        self.max_pos = max(self.max_pos, int(pos.max()))
+        window = (pos.astype(np.int64) - 1) // self.window_size
+        for c in CHROMOSOMES:
+            on_chr = np.where((pos > 0) & (chrs == c))[0]
+            if len(on_chr) == 0:
+                continue
+            window_chr = window[on_chr]
+            n = int(window_chr.max()) + 1
+            if n > self.sums[c].shape[0]:
+                grown = np.zeros((n, 3, len(self.patterns.names)))
+                grown[:self.sums[c].shape[0]] = self.sums[c]
+                self.sums[c] = grown
+            for j in range(len(self.patterns.names)):
+                sel = self.patterns.membership[j][codes[on_chr]]
+                self.sums[c][:n, 0, j] += np.bincount(window_chr[sel], weights=meth[on_chr][sel], minlength=n)
+                self.sums[c][:n, 1, j] += np.bincount(window_chr[sel], weights=w[on_chr][sel],    minlength=n)
+                self.sums[c][:n, 2, j] += np.bincount(window_chr[sel], minlength=n)
+
+    def result(self):
+        """
+        DataFrame with a row for each window and context as for
+        `summarise_methylation`, with regions labelled as for
+        `sliding_window_methylation`.
+        """
+        # Windows (start, end] from zero up to the largest position.
+        edges = np.arange(0, self.max_pos, self.window_size)
+        n_windows = max(len(edges) - 1, 0)
+        sums = np.zeros((len(CHROMOSOMES), n_windows, 3, len(self.patterns.names)))
+        for i, c in enumerate(CHROMOSOMES):
+            n = min(n_windows, self.sums[c].shape[0])
+            sums[i, :n] = self.sums[c][:n]
+        mean_meth = np.divide(sums[:, :, 0], sums[:, :, 1], out=np.zeros(sums[:, :, 0].shape), where=sums[:, :, 1] > 0)
+        labels = np.array([
+            cx.decode() + "_" + str(start) + "_" + str(start + self.window_size)
+            for cx in CHROMOSOMES for start in edges[:n_windows]
+        ])
+        return pd.DataFrame({
+            'region'    : np.repeat(labels, len(self.patterns.names)),
+            'context'   : np.tile(self.patterns.names, len(labels)),
+            'mean_meth' : mean_meth.ravel(),
+            'nreads'    : sums[:, :, 1].ravel().astype(np.int64),
+            'nC'        : sums[:, :, 2].ravel().astype(np.int64)
+        })
+
+class RegionSums:
+    """
+    Running sums of reads and cytosines in each sequence context over a set
+    of regions, updated one chunk at a time.
+
+    Within each chunk, cytosines on each chromosome are sorted by position and
+    cumulative sums are taken, so reads in every region are found with two
+    calls to `np.searchsorted`. Regions may overlap each other and chunk
+    boundaries.
+
+    Parameters
+    ----------
+    regions: DataFrame
+        Regions with columns 'name', 'chr', 'start' and 'end', including
+        cytosines from `start` up to but not including `end` (as returned by
+        the readers in `002.library/python/region_methylation.py`).
+    patterns: CompiledPatterns
+        Sequence contexts, from `compile_patterns`.
+    """
+    def __init__(self, regions, patterns):
+        self.regions = regions.reset_index(drop=True)
+        self.patterns = patterns
+        self.sums = np.zeros((self.regions.shape[0], 3 * len(patterns.names)), dtype=np.int64)
+        # For each chromosome, regions sorted by start, plus the running
+        # maximum of end positions to find regions overlapping a chunk.
+        self.by_chr = {}
+        for c, ix in self.regions.groupby('chr').indices.items():
+            ix = ix[np.argsort(self.regions['start'].to_numpy()[ix], kind='stable')]
+            end = self.regions['end'].to_numpy()[ix]
+            self.by_chr[str(c).encode()] = {
+                'rows'   : ix,
+                'start'  : self.regions['start'].to_numpy()[ix],
+                'end'    : end,
+                'maxend' : np.maximum.accumulate(end)
+            }
+
+    def add(self, codes, meth, w, chrs, pos):
+        """
+        Add a chunk of trinucleotide codes, methylated reads, total reads,
+        chromosome labels and positions.
+        """
+        n_ctx = len(self.patterns.names)
+        for c, r in self.by_chr.items():
+            ix = np.where(chrs == c)[0]
+            if len(ix) == 0:
+                continue
+            ix = ix[np.argsort(pos[ix], kind='stable')]
+            first = np.searchsorted(r['maxend'], pos[ix[0]], side='right')
+            last  = np.searchsorted(r['start'], pos[ix[-1]], side='right')
+            if first >= last:
+                continue
+            # Cumulative reads and cytosines in each context, with a row of zeros at the start.
+            member = self.patterns.membership[:, codes[ix]].T
+            reads = np.zeros((len(ix) + 1, 3 * n_ctx), dtype=np.int64)
+            reads[1:, :n_ctx]          = member * meth[ix, None]
+            reads[1:, n_ctx:2 * n_ctx] = member * w[ix, None]
+            reads[1:, 2 * n_ctx:]      = member
+            np.cumsum(reads, axis=0, out=reads)
+            lo = np.searchsorted(pos[ix], r['start'][first:last], side='left')
+            hi = np.searchsorted(pos[ix], r['end'][first:last],   side='left')
+            self.sums[r['rows'][first:last]] += reads[hi] - reads[lo]
 
-    # Label each site with a window bin.
-    window = pd.cut(
-        file['pos'][()],
-        bins = np.arange(0, file['pos'][()].max(), window_size)
-    )
+    def result(self):
+        """
+        DataFrame with a row for each region and context as for
+        `summarise_methylation`, with regions labelled by name.
+        """
+        n_ctx = len(self.patterns.names)
+        mC_reads = self.sums[:, :n_ctx]
+        nreads   = self.sums[:, n_ctx:2 * n_ctx]
+        mean_meth = np.divide(mC_reads, nreads, out=np.zeros(mC_reads.shape), where=nreads > 0)
+        return pd.DataFrame({
+            'region'    : np.repeat(self.regions['name'].to_numpy(), n_ctx),
+            'context'   : np.tile(self.patterns.names, self.regions.shape[0]),
+            'mean_meth' : mean_meth.ravel(),
+            'nreads'    : nreads.ravel(),
+            'nC'        : self.sums[:, 2 * n_ctx:].ravel()
+        })
+
+def summarise_methylation(file, windows=(), regions=None, downsample=(None,), patterns=None, chunk_size=None, align_chunks=False, replicates=1, seed=None,
+                          min_coverage=None, non_conversion=None, alpha=0.05):
+    """
+    Genome-wide methylation, methylation in windows and over sets of regions,
+    for observed and downsampled reads, from a single pass over an HDF5 file.
+
+    Each chunk of `mc_class`, `mc_count`, `total`, `chr` and `pos` is read
+    once. Trinucleotides are encoded once per chunk and reads are downsampled
+    once per chunk for each fraction and replicate, and every requested
+    summary is updated from the same arrays.
+
+    Parameters
+    ----------
+    file: HDF5
+        Chunked file from the methylpy pipeline; see `genome_wide_methylation`
+        and `sliding_window_methylation`.
+    windows: list
+        Window sizes in nucleotides. Windows are as for
+        `sliding_window_methylation`.
+    regions: dict
+        Optional dictionary of DataFrames of regions, each with columns 'name',
+        'chr', 'start' and 'end'.
+    downsample: list or Downsampler
+        Proportions by which to downsample reads, as for
+        `genome_wide_methylation`. Use `None` for the observed reads. This can
+        also be a `Downsampler`, for example from `Downsampler.to_coverage`,
+        in which case `replicates` and `seed` are ignored.
+    patterns: dict
+        Dictionary of sequence contexts to compare. If `None`, the default is
+        CG, CHG and CHH.
+    chunk_size: int
+        Number of cytosines to read at once. If `None`, the value stored in
+        `file['chunk_size']` is used.
+    align_chunks: bool
+        If True, align reads to the native HDF5 chunk layout of the file.
+        See `iter_chunks`.
+    replicates: int
+        Number of independent draws for each downsampling proportion.
+    seed: int
+        Optional seed for downsampling; see `Downsampler`.
+    min_coverage, non_conversion, alpha:
+        Optional options for the genome-wide estimators based on the
+        methylation level of each cytosine; see `genome_wide_methylation`.
+
+    Returns
+    -------
+    DataFrame with columns:
+    1. `output`: 'genome_wide', 'windows_<size>' or the name of a set of
+        regions.
+    2. `downsample`: proportion of reads kept (1 for observed reads).
+    3. `target_coverage`: target total number of reads, if the proportion
+        comes from `Downsampler.to_coverage`, otherwise NaN.
+    4. `replicate`: number of the downsampling replicate (0 for observed
+        reads).
+    5. `region`: 'genome', the label of a window, or the name of a region.
+    6. `context`: sequence context.
+    7. `mean_meth`: weighted mean methylation.
+    8. `nreads`: number of reads mapping to cytosines.
+    9. `nC`: number of cytosines.
+    If `min_coverage` is given, columns `mean_level`, `n_sites` and
+    `frac_methylated` are added for genome-wide rows, as for
+    `genome_wide_methylation`, and are NaN for other rows.
+
+    Example
+    -------
+    fle = h5.File(filename, 'r')
+    summarise_methylation(fle, windows = [100, 1000], downsample = [None, 0.5, 0.25], replicates = 10, seed = 1)
+    # Downsample to 10 million reads
+    summarise_methylation(fle, downsample = Downsampler.to_coverage(total_reads(fle), [1e7], sample = basename(filename)))
+    """
+    if not isinstance(downsample, Downsampler):
+        downsample = Downsampler(downsample, replicates, seed, basename(file.filename))
+    compiled = compile_patterns(patterns)
+    if regions is None:
+        regions = {}
+
+    # Accumulators for each downsampling fraction and replicate
+    sums = {}
+    for d in downsample.draws:
+        sums[d] = {'genome_wide' : GenomeWideSums(compiled, min_coverage, non_conversion, alpha)}
+        for ws in windows:
+            sums[d]['windows_' + str(ws)] = WindowSums(ws, compiled)
+        for k, v in regions.items():
+            sums[d][k] = RegionSums(v, compiled)
+
+    chunks = iter_chunks(file, ['mc_class', 'mc_count', 'total', 'chr', 'pos'], chunk_size, align_chunks)
+    for start, stop, chunk in chunks:
+        codes = encode_trinucleotides(chunk['mc_class'])
+        for d, r, meth, w in downsample.sample(start, chunk['mc_count'], chunk['total']):
+            for s in sums[d, r].values():
+                s.add(codes, meth, w, chunk['chr'], chunk['pos'])
 
     output = []
-    for cx in [b'Chr1', b'Chr2', b'Chr3', b'Chr4', b'Chr5']:
-        for wx in window.categories:
-            pos_label = cx.decode() + "_" + str(wx).split(',')[0][1:] + "_" + str(wx).split(',')[1][1:-1]
-                
-            ix = (window == wx) & (file['chr'][()] == cx)
-            ix = list(np.where(ix)[0])
-            
-            # If there is at least one cytosine in the bin calculate mean methylation
-            if len(ix) > 0:
-                # Run weighted_mean_methylation() on each window.
-                # Import a chunk
-                seq =  file['mc_class'][ix]
-                meth = file['mc_count'][ix]
-                w =    file['total'][ix]
-                # Get weighted mean methylation for this chunk
-                this_window = weighted_mean_methylation(
-                    mc_class = seq, 
-                    mc_count = meth, 
-                    total = w,
-                    patterns = patterns
-                )
-
-                o = [[pos_label, k, this_window[0][k], this_window[1][k], this_window[2][k]] for k in patterns.keys()]
-                output.append(
-                    pd.DataFrame(o, columns= ['pos','context', 'mean_meth', 'nreads', 'nC'])
-                )
-            # If there are no methylated cytosines, return zeros.
-            else:
-                output.append(
-                    pd.DataFrame({
-                        'pos': pos_label,
-                        "context" : list(patterns.keys()),
-                        "mean_meth" : 0,
-                        "nreads" : 0,
-                        "nC" : 0
-                    })
-                )
-
-    return pd.concat(output)
+    for d, r in downsample.draws:
+        for k, s in sums[d, r].items():
+            this_output = s.result()
+            this_output.insert(0, 'replicate', r)
+            this_output.insert(0, 'target_coverage', downsample.targets.get(d, np.nan))
+            this_output.insert(0, 'downsample', d if Downsampler.downsampled(d) else 1.0)
+            this_output.insert(0, 'output', k)
+            output.append(this_output)
+    return pd.concat(output, ignore_index=True)
 
 def compile_methylation(input_folder, output_folder, patterns = None, downsample = None):
     """
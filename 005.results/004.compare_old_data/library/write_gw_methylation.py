@@ -1,11 +1,29 @@
 from argparse import ArgumentParser
 from meth_from_wma_araport import *
-from os.path import basename
+from os.path import basename, dirname, abspath, exists, join
+from os import replace
+import sys
+
+# Record of HDF5 files already summarised, shared with 002.library/python.
+sys.path.append(join(dirname(abspath(__file__)), '../../../002.library/python'))
+from checkpoint import Manifest
+from region_methylation import read_te_annotation, read_bed, read_gff
 
 parser = ArgumentParser(description = "Parse parameters for weighted-mean methylation over a whole genome")
 parser.add_argument("-f", "--filename",  help="Input HDF5 file.")
 parser.add_argument("-o", "--output", help="Folder to output results.")
 parser.add_argument("-d", "--downsample", help="Optional proportion by which to downsample reads.", type=float, required=False)
+parser.add_argument("-w", "--windows", help="Optional window size in nucleotides for methylation in windows. Can be given more than once.", type=int, action="append", default=[])
+parser.add_argument("-r", "--regions", help="Optional set of regions as NAME=PATH, where PATH is a BED file, a GFF3 file of genes or a TE annotation file. Can be given more than once.", action="append", default=[])
+parser.add_argument("--fractions", help="Optional proportions by which to downsample reads, each summarised alongside the observed reads.", type=float, nargs="+", default=[])
+parser.add_argument("--coverage", help="Optional target total numbers of reads to downsample to, each summarised alongside the observed reads.", type=float, nargs="+", default=[])
+parser.add_argument("--replicates", help="Number of independent draws for each downsampling proportion. Default is 1.", type=int, default=1)
+parser.add_argument("--seed", help="Optional seed for downsampling. Draws are reproducible for the same seed and file name.", type=int, required=False)
+parser.add_argument("--min_coverage", help="Optional minimum number of reads. If given, genome-wide output also gives the unweighted mean methylation level of cytosines with at least this many reads, the number of such cytosines, and the fraction called methylated.", type=int, required=False)
+parser.add_argument("--non_conversion", help="Optional non-conversion rate for calling cytosines methylated with a binomial test.", type=float, required=False)
+parser.add_argument("--alpha", help="Significance level for calling cytosines methylated. Default is 0.05.", type=float, default=0.05)
+parser.add_argument("--align_chunks", help="Align reads to the native HDF5 chunk layout of the file.", action="store_true")
+parser.add_argument("--force", help="Summarise the file even if the manifest says it is already done.", action="store_true")
 args = parser.parse_args()
 
 if args.output[-1] != "/":
@@ -13,7 +31,23 @@ if args.output[-1] != "/":
     # warn("output did not end with a '/'. This will be added automatically.")
 
 if not args.filename.endswith('.hdf5'):
-    warn("The current file is not an HDF5 and will be skipped: {}\n".format(filename))
+    warn("The current file is not an HDF5 and will be skipped: {}\n".format(args.filename))
+
+# If windows, regions, downsampling fractions or replicates are requested, all outputs
+# are computed in one pass and written to a single summary file per sample.
+# Otherwise write genome-wide means only, as before.
+summary = len(args.windows) > 0 or len(args.regions) > 0 or len(args.fractions) > 0 or len(args.coverage) > 0 or args.replicates > 1
+prefix = 'summary_' if summary else 'genomewide_'
+
+# Skip files that have already been summarised with the same options and have
+# not changed since.
+output_file = args.output + prefix + basename(args.filename).split('.')[0] + ".csv"
+options = {k: v for k, v in vars(args).items() if k not in ['filename', 'output', 'force']}
+record = {'output' : output_file, 'options' : options}
+manifest = Manifest(join(args.output, '.manifest'))
+if not args.force and manifest.result(args.filename) == record and exists(output_file):
+    print("{} has already been summarised in {}; skipping.".format(args.filename, output_file))
+    sys.exit(0)
 
 # Load the HDF5 file.
 fle = h5.File(args.filename, 'r')
@@ -27,21 +61,61 @@ patterns = {
     "CHG" : [b'CAG', b'CCG', b'CTG']
     # "CHT" : [b'CAT', b'CCT', b'CTT']
     }
-this_meth = genome_wide_methylation(fle, patterns = patterns, downsample = args.downsample)
-# Transpose this_meth to use sequence context as a key.
-this_meth = {k: [basename(args.filename), this_meth[0][k], this_meth[1][k], this_meth[2][k]] for k in patterns.keys()}
-
-# Transpose
-output = pd.DataFrame(
-    list(this_meth.values()),
-    columns=['filename', 'mean_meth', 'nreads', 'nC']
-)
-output.insert(1, 'context', this_meth.keys())
-# Write to disk
+if summary:
+    regions = {}
+    for r in args.regions:
+        name, path = r.split('=', 1)
+        if '.bed' in path:
+            regions[name] = read_bed(path)
+        elif '.gff' in path:
+            regions[name] = read_gff(path)
+        else:
+            regions[name] = read_te_annotation(path)
+    # Observed reads are always summarised, alongside any downsampled reads.
+    fractions = [None] + [d for d in [args.downsample] + args.fractions if d is not None]
+    downsample = Downsampler(fractions, args.replicates, args.seed, basename(args.filename))
+    if len(args.coverage) > 0:
+        downsample = Downsampler.to_coverage(
+            total_reads(fle), args.coverage, downsample.fractions, args.replicates, downsample.seed, basename(args.filename)
+        )
+    output = summarise_methylation(
+        fle,
+        windows = args.windows,
+        regions = regions,
+        downsample = downsample,
+        patterns = patterns,
+        align_chunks = args.align_chunks,
+        min_coverage = args.min_coverage,
+        non_conversion = args.non_conversion,
+        alpha = args.alpha
+    )
+    output.insert(0, 'filename', basename(args.filename))
+else:
+    this_meth = genome_wide_methylation(
+        fle, patterns = patterns, downsample = args.downsample, align_chunks = args.align_chunks, seed = args.seed,
+        min_coverage = args.min_coverage, non_conversion = args.non_conversion, alpha = args.alpha
+    )
+    # Transpose this_meth to use sequence context as a key.
+    this_meth = {k: [basename(args.filename)] + [x[k] for x in this_meth] for k in patterns.keys()}
+
+    # Transpose
+    columns = ['filename', 'mean_meth', 'nreads', 'nC']
+    if args.min_coverage is not None:
+        columns += ['mean_level', 'n_sites', 'frac_methylated']
+    output = pd.DataFrame(
+        list(this_meth.values()),
+        columns=columns
+    )
+    output.insert(1, 'context', this_meth.keys())
+# Write to disk, via a temporary file so that a half-written file is never
+# mistaken for a finished one. Summary files have a header, because they have
+# more columns; genome-wide files do not, so they can be concatenated.
 output.to_csv(
-    args.output + 'genomewide_' + basename(args.filename).split('.')[0] + ".csv",
+    output_file + '.tmp',
     index=False,
-    header=False
+    header=summary
 )
+replace(output_file + '.tmp', output_file)
+manifest.add(args.filename, record)
 
 fle.close()
\ No newline at end of file